@@ -0,0 +1,48 @@
+#! /bin/bash
+#
+# Checks the output of a MrBayes task run by wq_mb.sh. It is passed the
+# same absolute bayes block file name as the task, and exits nonzero if
+# any run's .t file is missing or has fewer samples than the mcmc
+# settings in the bayes block call for. Give it to wq.py as the check
+# command so an incomplete run counts as a failure and is retried.
+
+FILE=$1
+DIR=`dirname ${FILE}`
+
+cd $DIR
+
+# Pull the settings from the bayes block, using the MrBayes defaults
+# for any not given. Later mcmcp/mcmc lines override earlier ones.
+
+setting () {
+   VALUE=`grep -io "\b$1 *= *[0-9]*" ${FILE} | tail -1 | grep -o '[0-9]*$'`
+   echo ${VALUE:-$2}
+}
+
+NGEN=`setting ngen 1000000`
+NRUNS=`setting nruns 2`
+FREQ=`setting samplefreq 500`
+NEX=`grep -io 'execute *[^;]*' ${FILE} | head -1 | awk '{print $2}'`
+
+# One tree is sampled at generation 0 and then every FREQ generations.
+
+EXPECT=$(( NGEN / FREQ + 1 ))
+
+for RUN in `seq 1 ${NRUNS}` ; do
+   if [ ${NRUNS} -eq 1 ] ; then
+      TFILE=${NEX}.t
+   else
+      TFILE=${NEX}.run${RUN}.t
+   fi
+   if [ ! -r ${TFILE} ] ; then
+      echo "wq_check_mb: ${DIR}/${TFILE} is missing"
+      exit 1
+   fi
+   SAMPLES=`grep -c '^ *tree gen\.' ${TFILE}`
+   if [ ${SAMPLES} -lt ${EXPECT} ] ; then
+      echo "wq_check_mb: ${DIR}/${TFILE} has ${SAMPLES} of ${EXPECT} samples"
+      exit 1
+   fi
+done
+
+exit 0
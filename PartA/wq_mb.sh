@@ -16,11 +16,13 @@ FILE=$1
 DIR=`dirname ${FILE}`
 BASE=`basename ${FILE}`
 
-# Maybe run multiprocess (on one node only!). Here we are going to run 16
-# per task, so create a list with the local hostname appearing 16 times.
-# Just append the name, with a separating ",", then trim off any final ",".
+# Maybe run multiprocess (on one node only!). When the workers share the
+# node's cores, wq.py passes the number given this task in WQ_CORES.
+# Otherwise we are going to run 16 per task. Create a list with the local
+# hostname appearing that many times. Just append the name, with a
+# separating ",", then trim off any final ",".
 
-PROCS=16
+PROCS=${WQ_CORES:-16}
 HOSTNAME=`uname -n`
 HOSTLIST=""
 for i in `seq 1 ${PROCS}`; do
@@ -1,5 +1,9 @@
 #!/bin/bash
 
-for p in $(cat MRCLogList); do
-python checkConvergence.py $p >> notConverged.txt
-done
+# Number of processes to spread the logs across. Defaults to the number
+# of cores PBS assigned to the job.
+
+PROCS=${PBS_NUM_PPN:-1}
+
+python checkConvergence.py --batch MRCLogList --procs $PROCS \
+    --table convergenceTable.txt >> notConverged.txt
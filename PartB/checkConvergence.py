@@ -1,33 +1,135 @@
 #!/usr/bin/env python
 
 ###Usage: ./checkConvergence.py path/to/mrconverge.log
-###Batch Usage: if you have a DataList file that contains the file paths to the mrconverge.log files, then run batchCheckConvergence.sh and look for the output in notConverged.txt
+###Batch Usage: ./checkConvergence.py --batch MRCLogList|"glob" [--procs n] [--table tableFile]
+###  MRCLogList is a file listing the paths to the mrconverge.log files, one per line, or give a
+###  quoted glob (e.g. "*/SeqOutfiles/*/mrconverge.log" for Part E) or a directory to search all
+###  the way down for mrconverge.log files. The logs are parsed in one process, or spread across
+###  n processes (default 1), and a line per log is written to tableFile (default
+###  convergenceTable.txt): locus, replicate (Part E), Opt Burn for each criterion, MaxBppCI,
+###  whether it converged and the log path. batchCheckConvergence.sh runs it on MRCLogList.
 ###Output: if the MaxBppCI for the statistic corresponding to the maximum Opt Burn value is greater than 0.1 then the MaxBppCI and the path to the mrconverge.log file will be output.
 ###Otherwise there not be any output unless you remove the hash marks from the lines at the bottom of the script pertaining to the else statement.
 
 import os
 import sys
+import getopt
+import glob
+import time
+from multiprocessing import Pool
 
+ciCutoff = .10
 
-if len(sys.argv) ==1:
-	print 'you need the filename as an argument'
-	sys.exit(-1)
-else:
-	file = sys.argv[1]
-
-mrc = open(file, 'r')
-line = mrc.readline()
-while ( 'Opt Burn' not in line ):
-  line = mrc.readline()
-OptBurn = line.split()
-OptBurn = map(int, OptBurn[2:4])
-BurnCrit = OptBurn.index(max(OptBurn))
-while ( 'MaxBppCI' not in line ):
-  line = mrc.readline()
-MaxBppCI = line.split()
-MaxBppCIfloats = map(float, MaxBppCI[1:])
-maxCI = MaxBppCIfloats[BurnCrit]
-if maxCI >= .10:
-  print maxCI,file
-#else:
- # print "MaxBppCI is less than 0.1:", maxCI
+def readConvergence( file ):
+	"""
+	Reads the Opt Burn values for each criterion and the MaxBppCI line from mrconverge.log,
+	stopping once both are found. Returns the Opt Burn values and the MaxBppCI for the
+	criterion with the largest Opt Burn.
+	"""
+	OptBurn = None
+	maxCI = None
+	mrc = open(file, 'r')
+	for line in mrc:
+		if OptBurn is None and 'Opt Burn' in line:
+			OptBurn = map(int, line.split()[2:4])
+			BurnCrit = OptBurn.index(max(OptBurn))
+		elif OptBurn is not None and 'MaxBppCI' in line:
+			MaxBppCIfloats = map(float, line.split()[1:])
+			maxCI = MaxBppCIfloats[BurnCrit]
+			break
+	mrc.close()
+	if maxCI is None:
+		raise ValueError("no Opt Burn and MaxBppCI lines")
+	return OptBurn,maxCI
+
+def locusReplicate( file ):
+	"""
+	Names the analysis a log belongs to: locus/mrconverge.log for Part B, or
+	locus/SeqOutfiles/replicate/mrconverge.log for Part E.
+	"""
+	dirs = os.path.dirname(os.path.abspath(file)).split(os.sep)
+	if len(dirs) > 2 and dirs[-2] == "SeqOutfiles":
+		return dirs[-3],dirs[-1]
+	return dirs[-1],""
+
+def checkTask( file ):
+	"""
+	Pool task for one log. Returns its table row, and the error that stopped it, if any.
+	"""
+	locus,replicate = locusReplicate(file)
+	try:
+		OptBurn,maxCI = readConvergence(file)
+	except (IOError,ValueError,IndexError), err:
+		return [locus,replicate,"NA","NA","NA","NA",file],"%s: %s" % (file,err)
+	converged = {True:"yes",False:"no"}[maxCI < ciCutoff]
+	return [locus,replicate] + map(str,OptBurn) + [str(maxCI),converged,file],None
+
+def findLogs( batch ):
+	"""
+	The logs named in a list file, matched by a glob, or found under a directory.
+	"""
+	if os.path.isdir(batch):
+		logs = []
+		for root,dirs,files in os.walk(batch):
+			if "mrconverge.log" in files:
+				logs.append(os.path.join(root,"mrconverge.log"))
+		return sorted(logs)
+	if os.path.isfile(batch):
+		return [l.strip() for l in open(batch) if l.strip() != ""]
+	return sorted(glob.glob(batch))
+
+def runBatch( logs,procs,tableFile ):
+	"""
+	Checks every log, printing those that may not have converged as the per-file check does,
+	and writes the table.
+	"""
+	batchStart = time.time()
+	table = open(tableFile,'w')
+	table.write("#locus\treplicate\tOptBurn1\tOptBurn2\tMaxBppCI\tconverged\tlog\n")
+	pool = Pool(procs)
+	failed = 0
+	for row,err in pool.imap(checkTask,logs,64):
+		table.write("\t".join(row) + "\n")
+		if err is not None:
+			sys.stderr.write("Not checked: %s\n" % err)
+			failed += 1
+		elif row[5] == "no":
+			print row[4],row[6]
+	pool.close()
+	pool.join()
+	table.close()
+	sys.stderr.write("Checked %d of %d logs in %.2f secs with %d processes\n" % (len(logs) - failed,len(logs),time.time() - batchStart,procs))
+
+if __name__ == "__main__":
+
+	try:
+		opts,args = getopt.getopt(sys.argv[1:],"b:n:t:",["batch=","procs=","table="])
+	except getopt.GetoptError, err:
+		print str(err)
+		sys.exit(2)
+	batch = ""
+	procs = 1
+	tableFile = "convergenceTable.txt"
+	for o,a in opts:
+		if o in ("-b","--batch"):
+			batch = a
+		elif o in ("-n","--procs"):
+			procs = int(a)
+		elif o in ("-t","--table"):
+			tableFile = a
+
+	if batch != "":
+		runBatch(findLogs(batch),procs,tableFile)
+		sys.exit(0)
+
+	if len(args) == 0:
+		print 'you need the filename as an argument'
+		sys.exit(-1)
+	else:
+		file = args[0]
+
+	OptBurn,maxCI = readConvergence(file)
+	if maxCI >= ciCutoff:
+	  print maxCI,file
+	#else:
+	 # print "MaxBppCI is less than 0.1:", maxCI
@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+
+###Usage: python mbConverge.py [options] path/to/mrc.conblock|analysisDir ...
+###Batch Usage: python mbConverge.py --batch MRC_DataList [--procs n] [options]
+###Convergence diagnostics for MrBayes runs, in place of MrConverge (requires NumPy). Reads the
+###MrConverge block for the log name, nruns and filename, then reads the run files straight from
+###the analysis directory (filename.nex.runN.t/.p, filename.runN.t/.p or the filename_rN.t/.p
+###copies made for MrConverge), or the filename.nex.mb.npz store written by mbStore.py, so there
+###is no jar or _rN copies to set up. A directory is taken as having a mrc.conblock in it.
+###For burnins of 0, 5, ..., 50% of each run it works out the average standard deviation of split
+###frequencies (ASDSF) across runs and the largest PSRF of the .p parameters. The Opt Burn of the
+###Splits criterion is the first burnin with ASDSF below --asdsf (default 0.01), and of the Params
+###criterion the first with every PSRF below --psrf (default 1.01); the best one seen if none is.
+###At each, it reports the smallest summed ESS of any parameter and MaxBppCI, the widest 95%
+###interval on a split's posterior probability, from batch means over --batches batches per run
+###(default 10). A single run is split in half to compare its halves. The log has the "Opt Burn"
+###and "MaxBppCI" lines checkConvergence.py reads and the "Determining" and "BURNIN" lines
+###stationaryPlan.py reads, with BURNIN set to the larger Opt Burn.
+###Options: [-r nruns] [--asdsf x] [--psrf x] [--batches n]
+###MRC_DataList lists the paths to the mrc.conblock files, one per line, spread over n processes.
+###PartB/mbConverge.py and PartE/mbConverge.py are identical copies, as wq.py is in Parts A, B
+###and E; apply any change to both.
+
+import sys
+import os
+import getopt
+import re
+import time
+from multiprocessing import Pool
+import numpy as np
+
+burnFractions = [i * 0.05 for i in range(11)]
+minSplitFreq = 0.1	# Splits rarer than this in every run are left out of the ASDSF, as in MrBayes
+
+brlenPattern = re.compile(r":[^,();\[\]]*")
+tokenPattern = re.compile(r"[(),]|[^(),;\s]+")
+
+def readConblock( conblock ):
+	"""
+	Reads the log name, nruns and filename from the MrConverge block.
+	"""
+	settings = {'log':"mrconverge.log",'nruns':2,'filename':"data"}
+	for line in open(conblock):
+		fields = line.strip().rstrip(";").split()
+		if len(fields) == 2 and fields[0].lower() == "log" and fields[1].lower() != "stop":
+			settings['log'] = fields[1]
+		elif len(fields) == 2 and fields[0].lower() == "set" and "=" in fields[1]:
+			key,value = fields[1].split("=",1)
+			if key.lower() == "nruns":
+				settings['nruns'] = int(value)
+			elif key.lower() == "filename":
+				settings['filename'] = value
+	return settings
+
+def findRuns( dirName,filename,nruns ):
+	"""
+	Finds the analysis's runs. Returns ("store",storeFile) or ("text",[(tFile,pFile),...]),
+	where pFile is None if a run has no .p file.
+	"""
+	for stem in (filename + ".nex",filename):
+		storeFile = os.path.join(dirName,stem + ".mb.npz")
+		if os.path.exists(storeFile):
+			return "store",storeFile
+	for form in ("%s.nex.run%d","%s.run%d","%s_r%d"):
+		names = [os.path.join(dirName,form % (filename,r)) for r in range(1,nruns + 1)]
+		if all([os.path.exists(n + ".t") for n in names]):
+			break
+	else:
+		names = [os.path.join(dirName,stem) for stem in (filename + ".nex",filename)]
+		names = [n for n in names if os.path.exists(n + ".t")][:1]
+		if nruns != 1 or len(names) == 0:
+			raise IOError("no run files for %s in %s" % (filename,dirName))
+	return "text",[(n + ".t",{True:n + ".p",False:None}[os.path.exists(n + ".p")]) for n in names]
+
+def readParams( pFile ):
+	"""
+	Reads a .p file into {column: array}, leaving out Gen.
+	"""
+	names = None
+	rows = []
+	for line in open(pFile):
+		fields = line.split()
+		if len(fields) > 0 and fields[0].isdigit():
+			rows.append(fields)
+		elif len(rows) == 0 and len(fields) > 0 and not line.startswith("["):
+			names = fields
+	values = np.array(rows,dtype=np.float64).reshape(len(rows),len(names))
+	return dict([(names[i],values[:,i]) for i in range(1,len(names))])
+
+def readTextRuns( runFiles ):
+	"""
+	Reads the trees of each run as indexes into a table of the distinct topologies, and
+	the .p columns. Returns the table, the index arrays and the column dicts (None for a run
+	without a .p file).
+	"""
+	topologies = {}
+	runIds = []
+	runParams = []
+	for tFile,pFile in runFiles:
+		ids = []
+		for line in open(tFile):
+			fields = line.split()
+			if len(fields) > 1 and fields[0].lower() == "tree":
+				topology = brlenPattern.sub("",line[line.index("("):]).strip()
+				ids.append(topologies.setdefault(topology,len(topologies)))
+		runIds.append(np.array(ids,dtype=np.int64))
+		runParams.append({True:None,False:readParams(pFile)}[pFile is None])
+	table = [""] * len(topologies)
+	for topology,i in topologies.items():
+		table[i] = topology
+	return table,runIds,runParams
+
+def readStoreRuns( storeFile ):
+	"""
+	As readTextRuns, from a store written by mbStore.py.
+	"""
+	store = np.load(storeFile)
+	table = [str(t).replace(":","") for t in store["topologies"]]
+	runIds = []
+	runParams = []
+	for run in [str(r) for r in store["runs"]]:
+		runIds.append(store["t/%s/topology" % run].astype(np.int64))
+		if "p/%s/names" % run in store.files:
+			names = [str(n) for n in store["p/%s/names" % run]]
+			runParams.append(dict([(names[i],store["p/%s/%d" % (run,i)]) for i in range(1,len(names))]))
+		else:
+			runParams.append(None)
+	store.close()
+	return table,runIds,runParams
+
+def topologySplits( table ):
+	"""
+	Finds the non-trivial splits of each topology, as bitmasks of the taxa on the side away
+	from taxon 1. Returns (splitTopo,splitCol,nsplits): the topology and split number of
+	every (topology, split) pair.
+	"""
+	parsed = []
+	taxa = 0
+	for topology in table:
+		stack = [[]]
+		clades = []
+		for tok in tokenPattern.findall(topology):
+			if tok == "(":
+				stack.append([])
+			elif tok == ")":
+				mask = 0
+				for m in stack.pop():
+					mask |= m
+				clades.append(mask)
+				stack[-1].append(mask)
+			elif tok != ",":
+				bit = 1 << (int(tok) - 1)
+				taxa |= bit
+				stack[-1].append(bit)
+		parsed.append(clades)
+	ntaxa = bin(taxa).count("1")
+	columns = {}
+	splitTopo = []
+	splitCol = []
+	for t in range(len(parsed)):
+		seen = set()
+		for mask in parsed[t]:
+			if mask & 1:
+				mask = taxa ^ mask
+			if mask in seen or not 2 <= bin(mask).count("1") <= ntaxa - 2:
+				continue
+			seen.add(mask)
+			splitTopo.append(t)
+			splitCol.append(columns.setdefault(mask,len(columns)))
+	return np.array(splitTopo,dtype=np.int64),np.array(splitCol,dtype=np.int64),len(columns)
+
+class Splits(object):
+	"""
+	Split frequencies over windows of a run, from its topology indexes.
+	"""
+	def __init__( self,table ):
+		self.ntopo = len(table)
+		self.splitTopo,self.splitCol,self.nsplits = topologySplits(table)
+
+	def freqs( self,ids ):
+		counts = np.bincount(ids,minlength=self.ntopo).astype(np.float64)
+		return np.bincount(self.splitCol,weights=counts[self.splitTopo],minlength=self.nsplits) / max(len(ids),1)
+
+def asdsf( runFreqs ):
+	"""
+	Average standard deviation of split frequencies across runs, over the splits seen at
+	least minSplitFreq in some run.
+	"""
+	f = np.array(runFreqs)
+	if f.shape[1] == 0:
+		return 0.0
+	keep = f.max(axis=0) >= minSplitFreq
+	if keep.sum() == 0:
+		return 0.0
+	return float(f[:,keep].std(axis=0,ddof=1).mean())
+
+def psrf( chains ):
+	"""
+	Potential scale reduction factor of one parameter over equal length chains, as MrBayes
+	works it out, or None for a parameter that doesn't vary.
+	"""
+	x = np.array(chains)
+	m,n = x.shape
+	W = x.var(axis=1,ddof=1).mean()
+	if n < 2 or W == 0:
+		return None
+	B = n * x.mean(axis=1).var(ddof=1)
+	return float(np.sqrt(((n - 1.0) / n * W + (m + 1.0) / (m * n) * B) / W))
+
+def ess( x ):
+	"""
+	Effective sample size of one chain, summing autocorrelations (from an FFT) over Geyer's
+	initial positive sequence.
+	"""
+	n = len(x)
+	x = x - x.mean()
+	if n < 4 or not x.any():
+		return float(n)
+	f = np.fft.rfft(x,2 * n)
+	acf = np.fft.irfft(f * np.conjugate(f))[:n]
+	acf = acf / acf[0]
+	pairs = acf[:n - n % 2].reshape(-1,2).sum(axis=1)
+	k = np.argmax(pairs <= 0) if (pairs <= 0).any() else len(pairs)
+	tau = -1.0 + 2.0 * pairs[:k].sum()
+	return float(n / max(tau,1.0))
+
+def maxBppCI( splits,runIds,batches ):
+	"""
+	Width of the widest 95% interval on a split's posterior probability, with the standard
+	error from batch means over every run.
+	"""
+	means = []
+	for ids in runIds:
+		nb = min(batches,len(ids))
+		for i in range(nb):
+			means.append(splits.freqs(ids[i * len(ids) / nb:(i + 1) * len(ids) / nb]))
+	if len(means) < 2:
+		return float("nan")
+	if splits.nsplits == 0:
+		return 0.0
+	se = np.array(means).std(axis=0,ddof=1) / np.sqrt(len(means))
+	return float((2 * 1.96 * se).max())
+
+def window( runs,burnin,ntrees ):
+	"""
+	The post-burnin part of each run, or of the two halves of a single run.
+	"""
+	if len(runs) == 1:
+		half = burnin + (ntrees - burnin) / 2
+		return [runs[0][burnin:half],runs[0][half:half + (half - burnin)]]
+	return [r[burnin:ntrees] for r in runs]
+
+def diagnose( table,runIds,runParams,asdsfCutoff,psrfCutoff,batches ):
+	"""
+	Works out the statistics at every burnin on the grid and the Opt Burn of each criterion.
+	"""
+	ntrees = min([len(ids) for ids in runIds])
+	splits = Splits(table)
+	params = [p for p in runParams if p is not None]
+	names = []
+	if len(params) == len(runParams):
+		names = sorted(params[0].keys())
+		ntrees = min([ntrees] + [len(p[names[0]]) for p in params if len(names) > 0])
+
+	grid = []
+	for fraction in burnFractions:
+		burnin = int(fraction * ntrees)
+		row = {'burnin':burnin,'asdsf':float("nan"),'psrf':float("nan")}
+		windows = window(runIds,burnin,ntrees)
+		if min([len(w) for w in windows]) > 1:
+			row['asdsf'] = asdsf([splits.freqs(w) for w in windows])
+			values = [psrf(window([p[n] for p in params],burnin,ntrees)) for n in names]
+			values = [v for v in values if v is not None]
+			if len(values) > 0:
+				row['psrf'] = max(values)
+		grid.append(row)
+
+	def optBurn( key,cutoff ):
+		rows = [r for r in grid if not np.isnan(r[key])]
+		if len(rows) == 0:
+			return None
+		for r in rows:
+			if r[key] < cutoff:
+				return r
+		return min(rows,key=lambda r:r[key])
+
+	criteria = []
+	for key,cutoff in (('asdsf',asdsfCutoff),('psrf',psrfCutoff)):
+		row = optBurn(key,cutoff)
+		if row is None:
+			row = optBurn('asdsf',asdsfCutoff) or grid[0]
+		burnin = row['burnin']
+		esses = [sum([ess(p[n][burnin:ntrees]) for p in params]) for n in names]
+		criteria.append({'burnin':burnin,'asdsf':row['asdsf'],'psrf':row['psrf'],
+			'ess':min(esses) if len(esses) > 0 else float("nan"),
+			'bppci':maxBppCI(splits,window(runIds,burnin,ntrees),batches)})
+	return ntrees,grid,criteria
+
+def writeLog( logFile,filename,source,nruns,ntrees,ntopo,grid,criteria ):
+	def cols( key,form ):
+		return "".join(["%12s" % (form % c[key]) for c in criteria])
+	logOut = open(logFile,'w')
+	logOut.write("mbConverge convergence diagnostics for %s: %d runs read from %s\n" % (filename,nruns,source))
+	logOut.write("   Determining burnin for all %d trees of each run (%d distinct topologies)\n\n" % (ntrees,ntopo))
+	logOut.write("   %-12s%12s%12s\n" % ("Burnin","ASDSF","MaxPSRF"))
+	for row in grid:
+		logOut.write("   %-12d%12.5f%12.5f\n" % (row['burnin'],row['asdsf'],row['psrf']))
+	logOut.write("\n   %-12s%12s%12s\n" % ("Criterion","Splits","Params"))
+	logOut.write("   Opt Burn    %s\n" % cols('burnin',"%d"))
+	logOut.write("   ASDSF       %s\n" % cols('asdsf',"%.5f"))
+	logOut.write("   MaxPSRF     %s\n" % cols('psrf',"%.5f"))
+	logOut.write("   MinESS      %s\n" % cols('ess',"%.1f"))
+	logOut.write("   MaxBppCI    %s\n" % cols('bppci',"%.5f"))
+	logOut.write("\n   BURNIN set to %d trees\n" % max([c['burnin'] for c in criteria]))
+	logOut.close()
+
+def converge( target,nruns,asdsfCutoff,psrfCutoff,batches ):
+	"""
+	Runs the diagnostics for one mrc.conblock (or a directory holding one), writing its log
+	next to it. Returns the log name.
+	"""
+	if os.path.isdir(target):
+		target = os.path.join(target,"mrc.conblock")
+	dirName = os.path.dirname(os.path.abspath(target))
+	settings = readConblock(target)
+	if nruns > 0:
+		settings['nruns'] = nruns
+	kind,found = findRuns(dirName,settings['filename'],settings['nruns'])
+	if kind == "store":
+		table,runIds,runParams = readStoreRuns(found)
+		source = os.path.basename(found)
+	else:
+		table,runIds,runParams = readTextRuns(found)
+		source = " ".join([os.path.basename(t) for t,p in found])
+	ntrees,grid,criteria = diagnose(table,runIds,runParams,asdsfCutoff,psrfCutoff,batches)
+	logFile = os.path.join(dirName,settings['log'])
+	writeLog(logFile,settings['filename'],source,len(runIds),ntrees,len(table),grid,criteria)
+	return logFile
+
+def convergeTask( task ):
+	"""
+	Pool task for one analysis. Returns its log name, or the error that stopped it.
+	"""
+	try:
+		return converge(*task),None
+	except (IOError,ValueError,IndexError), err:
+		return None,"%s: %s" % (task[0],err)
+
+if __name__ == "__main__":
+
+	try:
+		opts,args = getopt.getopt(sys.argv[1:],"r:b:n:",["nruns=","batch=","procs=","asdsf=","psrf=","batches="])
+	except getopt.GetoptError, err:
+		print str(err)
+		sys.exit(2)
+	nruns = 0
+	batch = ""
+	procs = 1
+	asdsfCutoff = 0.01
+	psrfCutoff = 1.01
+	batches = 10
+	for o,a in opts:
+		if o in ("-r","--nruns"):
+			nruns = int(a)
+		elif o in ("-b","--batch"):
+			batch = a
+		elif o in ("-n","--procs"):
+			procs = int(a)
+		elif o == "--asdsf":
+			asdsfCutoff = float(a)
+		elif o == "--psrf":
+			psrfCutoff = float(a)
+		elif o == "--batches":
+			batches = int(a)
+
+	targets = args
+	if batch != "":
+		targets = targets + [l.strip() for l in open(batch) if l.strip() != ""]
+	if len(targets) == 0:
+		sys.exit("usage: python mbConverge.py [-r nruns] [--asdsf x] [--psrf x] [--batches n] conblock|dir ... | --batch MRC_DataList [--procs n]")
+
+	batchStart = time.time()
+	tasks = [(t,nruns,asdsfCutoff,psrfCutoff,batches) for t in targets]
+	if procs > 1:
+		pool = Pool(procs)
+		results = pool.imap(convergeTask,tasks)
+	else:
+		results = map(convergeTask,tasks)
+	failed = 0
+	for logFile,err in results:
+		if err is not None:
+			sys.stderr.write("Not checked: %s\n" % err)
+			failed += 1
+	if procs > 1:
+		pool.close()
+		pool.join()
+	if len(targets) > 1:
+		sys.stderr.write("Checked %d of %d analyses in %.2f secs with %d processes\n" % (len(targets) - failed,len(targets),time.time() - batchStart,procs))
+	if failed > 0:
+		sys.exit(1)
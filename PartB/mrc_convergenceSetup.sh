@@ -1,13 +1,22 @@
 #!/bin/bash
 
+# Convergence engine, as set in wq_mrc.sh. mbConverge.py ("python") reads
+# the run files where they are, so only MrConverge ("java") needs the jar
+# and the _rN copies.
+
+ENGINE=python
+
 for f in $(cat empDataDirectories)
 do
 base=`basename $f`
 cp mrc.conblock $f
+if [ "${ENGINE}" = "java" ] ; then
 cp MrConverge1b2.5.jar $f
+fi
 sed -i.tmp "s/set filename=data/set filename=$base/g" $f"mrc.conblock"
 done
 
+if [ "${ENGINE}" = "java" ] ; then
 for n in $(cat empDataDirectories)
 do
 cd $n
@@ -32,3 +41,4 @@ cd $n
 	done
 cd ../
 done
+fi
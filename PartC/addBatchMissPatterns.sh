@@ -1,12 +1,8 @@
 #!/bin/bash
 
-for f in $(cat empDataDirectories)
-do
-cp repMissPatternsVD.py $f
-cd $f
-base=`basename $f`
-python repMissPatternsVD.py $base.nex 
-mv SeqOutfiles simSeqOutfiles
-mv SeqOutfiles_wMiss SeqOutfiles
-cd ../
-done
+# Number of processes to spread the (locus, replicate) pairs across.
+# Defaults to the number of cores PBS assigned to the job.
+
+PROCS=${PBS_NUM_PPN:-1}
+
+python repMissPatternsVD.py --batch empDataDirectories --procs $PROCS
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+###Usage: python benchRepMissPatterns.py [-n replicates]
+###Times the per-replicate file handling overhead of repMissPatternsVD.py before and after
+###the basename fork was replaced with an in-process call. Only the .dat path is worked on,
+###so no files are touched. The output directory was (and is) made once per locus, outside
+###the replicate loop, so mkdir isn't timed. Run it on each kind of node you want to
+###compare, e.g. a login node and a compute node, since fork cost differs between them.
+
+import sys
+import os
+import getopt
+import subprocess
+import time
+
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+from repMissPatternsVD import datRoot
+
+def forkedReplicate( datFile ):
+	"""
+	File handling for one replicate as repMissPatternsVD.py used to do it.
+	"""
+	datFileRootIn = subprocess.Popen("basename %s .dat" % datFile,shell=True,stdout=subprocess.PIPE)
+	return datFileRootIn.communicate()[0].strip()
+
+def inProcessReplicate( datFile ):
+	"""
+	File handling for one replicate as repMissPatternsVD.py does it now.
+	"""
+	return datRoot(datFile)
+
+def timeReplicates( func,nreps ):
+	start = time.time()
+	for i in range(nreps):
+		root = func(os.path.join("SeqOutfiles","locus_%d.dat" % i))
+	if root != "locus_%d" % (nreps - 1):
+		sys.exit("Unexpected file root %s! Exiting..." % root)
+	return (time.time() - start) / nreps
+
+if __name__ == "__main__":
+
+	try:
+		opts,args = getopt.getopt(sys.argv[1:],"n:",["replicates="])
+	except getopt.GetoptError, err:
+		print str(err)
+		sys.exit(2)
+	nreps = 100
+	for o,a in opts:
+		if o in ("-n","--replicates"):
+			nreps = int(a)
+
+	forked = timeReplicates(forkedReplicate,nreps)
+	inProcess = timeReplicates(inProcessReplicate,nreps)
+	print "Replicates timed: %d" % (nreps)
+	print "Forked basename:        %10.1f usec per replicate" % (forked * 1e6)
+	print "In-process:             %10.1f usec per replicate" % (inProcess * 1e6)
+	print "Speedup:                %10.1fx" % (forked / max(inProcess,1e-9))
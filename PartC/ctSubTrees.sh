@@ -3,7 +3,7 @@
 for f in $(cat empDataDirectories)
 do
 base=`basename $f`
-totaltrees=`grep "gen" $f/*.t | wc -l`
+totaltrees=`python mbIndex.py --total $f/*.t`
 if [ $totaltrees != 100 ]
 then
 echo $base $totaltrees
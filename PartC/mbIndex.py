@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+
+###Usage: python mbIndex.py [-t[--total]] [-r[--rebuild]] file.t|file.p ...
+###Builds (or brings up to date) a sidecar index, file + ".idx", for each MrBayes .t or .p file
+###and prints how many samples each holds, or with --total just the sum over all the files.
+###The index records the byte offset and generation of every sample, where the header ends and,
+###for .t files, where the translate block is, so later readers can count samples, pull out a
+###window or every k-th sample, or look up a generation with a seek per sample instead of
+###reading the whole file. An index is rebuilt when its file has changed, or only extended
+###when the file has just grown, as it does while MrBayes is still running.
+###Module Usage: from mbIndex import SampleIndex
+###  idx = SampleIndex("locus.run1.t"); len(idx); idx.header(); idx.samples(burnin,None,rate)
+
+import sys
+import os
+import getopt
+import bisect
+from array import array
+
+indexVersion = "mbIndex1"
+indexSuffix = ".idx"
+
+def fileKind( fileName ):
+	"""
+	Returns ".t" or ".p" for a MrBayes tree or parameter file, including one kept under
+	another name by the subsampler (such as locus.run1.t_old), or None for anything else.
+	"""
+	ext = os.path.splitext(fileName)[1]
+	if ext[:2] in (".t",".p") and (len(ext) == 2 or not ext[2].isalnum()):
+		return ext[:2]
+	return None
+
+def sampleGen( line,kind ):
+	"""
+	Returns the generation of a sample line, or None if the line isn't a sample: a tree in a
+	.t file ("tree gen.1000 = ..."), or a row of numbers starting with the generation in a
+	.p file.
+	"""
+	fields = line.split()
+	if len(fields) == 0:
+		return None
+	if kind == ".t":
+		if fields[0].lower() != "tree" or len(fields) < 2:
+			return None
+		digits = fields[1].split(".")[-1]
+		if digits.isdigit():
+			return int(digits)
+		return -1
+	if fields[0].isdigit():
+		return int(fields[0])
+	return None
+
+class SampleIndex(object):
+	"""
+	Index of the samples in one MrBayes .t or .p file, kept in a sidecar file next to it.
+	Opening it reads the sidecar if it is current, extends it if the file has only grown,
+	and otherwise scans the file once to rebuild it. Samples are then read by seeking:
+
+	  len(idx) ........... Number of samples.
+	  idx.gens ........... Generation of each sample, in file order.
+	  idx.header() ....... Everything before the first sample.
+	  idx.translate() .... The .t file's translate block (None for .p files).
+	  idx.footer() ....... Everything after the last sample (the .t file's "end;").
+	  idx.sample(i) ...... Sample line i.
+	  idx.samples(start,stop,step) .. Sample lines start, start + step, ... before stop,
+	                       as for a slice.
+	  idx.find(gen) ...... Number of the sample for generation gen, or None.
+	"""
+	def __init__( self,fileName,rebuild=False ):
+		self.fileName = fileName
+		self.indexName = fileName + indexSuffix
+		self.kind = fileKind(fileName)
+		self.gens = array('l')
+		self.offsets = array('l')
+		self.headerEnd = None
+		self.translateSpan = None
+		self.end = 0
+		self.size = 0
+		st = os.stat(fileName)
+		if rebuild or not self._load(st):
+			self.gens = array('l')
+			self.offsets = array('l')
+			self.headerEnd = None
+			self.translateSpan = None
+			self.end = 0
+			self._scan(st)
+		elif st.st_size != self.size or int(st.st_mtime) != self.mtime:
+			if len(self) > 0 and sampleGen(self._read(self.offsets[-1],self.end),self.kind) != self.gens[-1]:
+				# Rewritten rather than grown.
+				self.gens = array('l')
+				self.offsets = array('l')
+				self.headerEnd = None
+				self.translateSpan = None
+				self.end = 0
+			self._scan(st)
+
+	def _load( self,st ):
+		"""
+		Reads the sidecar. Returns False if there isn't one, or the file has changed other
+		than by growing since it was written.
+		"""
+		if not os.path.exists(self.indexName):
+			return False
+		try:
+			indexIn = open(self.indexName,'rb')
+			fields = indexIn.readline().split()
+			if len(fields) != 10 or fields[0] != indexVersion or int(fields[1]) != self.gens.itemsize:
+				indexIn.close()
+				return False
+			self.size,self.mtime,n,headerEnd,tStart,tEnd,self.end = map(int,fields[2:9])
+			if fields[9] != self.kind or st.st_size < self.size:
+				indexIn.close()
+				return False
+			self.gens.fromfile(indexIn,n)
+			self.offsets.fromfile(indexIn,n)
+			indexIn.close()
+		except (IOError,EOFError,ValueError):
+			return False
+		if headerEnd >= 0:
+			self.headerEnd = headerEnd
+		if tStart >= 0:
+			self.translateSpan = (tStart,tEnd)
+		return True
+
+	def _scan( self,st ):
+		"""
+		Indexes the file from the end of the last sample indexed so far (the start of the
+		file for a new index), then rewrites the sidecar. A partly written last line is left
+		for the next scan.
+		"""
+		fileIn = open(self.fileName,'rb')
+		fileIn.seek(self.end)
+		offset = self.end
+		tStart = None
+		for line in fileIn:
+			if not line.endswith("\n"):
+				break
+			gen = sampleGen(line,self.kind)
+			if gen is not None:
+				if self.headerEnd is None:
+					self.headerEnd = offset
+				self.gens.append(gen)
+				self.offsets.append(offset)
+				self.end = offset + len(line)
+			elif self.headerEnd is None and self.kind == ".t":
+				if tStart is None and line.strip().lower() == "translate":
+					tStart = offset
+				elif tStart is not None and self.translateSpan is None and line.rstrip().endswith(";"):
+					self.translateSpan = (tStart,offset + len(line))
+			offset += len(line)
+		fileIn.close()
+		self.size = st.st_size
+		self.mtime = int(st.st_mtime)
+		self._save()
+
+	def _save( self ):
+		"""
+		Writes the sidecar to a temporary file and renames it into place. An index that
+		can't be written (a read-only directory, say) is just kept in memory.
+		"""
+		headerEnd = -1
+		if self.headerEnd is not None:
+			headerEnd = self.headerEnd
+		tStart,tEnd = -1,-1
+		if self.translateSpan is not None:
+			tStart,tEnd = self.translateSpan
+		tmpName = "%s.%d" % (self.indexName,os.getpid())
+		try:
+			indexOut = open(tmpName,'wb')
+			indexOut.write("%s %d %d %d %d %d %d %d %d %s\n" % (indexVersion,self.gens.itemsize,
+				self.size,self.mtime,len(self.gens),headerEnd,tStart,tEnd,self.end,self.kind))
+			self.gens.tofile(indexOut)
+			self.offsets.tofile(indexOut)
+			indexOut.close()
+			os.rename(tmpName,self.indexName)
+		except (IOError,OSError):
+			if os.path.exists(tmpName):
+				os.remove(tmpName)
+
+	def _read( self,start,stop ):
+		fileIn = open(self.fileName,'rb')
+		fileIn.seek(start)
+		if stop is None:
+			text = fileIn.read()
+		else:
+			text = fileIn.read(stop - start)
+		fileIn.close()
+		return text
+
+	def __len__( self ):
+		return len(self.offsets)
+
+	def header( self ):
+		if self.headerEnd is None:
+			return self._read(0,None)
+		return self._read(0,self.headerEnd)
+
+	def translate( self ):
+		if self.translateSpan is None:
+			return None
+		return self._read(self.translateSpan[0],self.translateSpan[1])
+
+	def footer( self ):
+		if len(self) == 0:
+			return ""
+		return self._read(self.end,None)
+
+	def _sampleEnd( self,i ):
+		if i + 1 < len(self):
+			return self.offsets[i + 1]
+		return self.end
+
+	def sample( self,i ):
+		if i < 0:
+			i += len(self)
+		if i < 0 or i >= len(self):
+			raise IndexError("sample %d of %d in %s" % (i,len(self),self.fileName))
+		return self._read(self.offsets[i],self._sampleEnd(i))
+
+	def samples( self,start=0,stop=None,step=1 ):
+		"""
+		Generator over the selected sample lines, seeking straight to each one.
+		"""
+		fileIn = open(self.fileName,'rb')
+		for i in xrange(*slice(start,stop,step).indices(len(self))):
+			fileIn.seek(self.offsets[i])
+			yield fileIn.read(self._sampleEnd(i) - self.offsets[i])
+		fileIn.close()
+
+	def find( self,gen ):
+		i = bisect.bisect_left(self.gens,gen)
+		if i < len(self.gens) and self.gens[i] == gen:
+			return i
+		return None
+
+def removeIndex( fileName ):
+	"""
+	Removes the sidecar index of a file being rewritten, if it has one.
+	"""
+	if os.path.exists(fileName + indexSuffix):
+		os.remove(fileName + indexSuffix)
+
+def hasIndex( fileName ):
+	return os.path.exists(fileName + indexSuffix)
+
+if __name__ == "__main__":
+
+	try:
+		opts,args = getopt.getopt(sys.argv[1:],"tr",["total","rebuild"])
+	except getopt.GetoptError, err:
+		print str(err)
+		sys.exit(2)
+	total = False
+	rebuild = False
+	for o,a in opts:
+		if o in ("-t","--total"):
+			total = True
+		elif o in ("-r","--rebuild"):
+			rebuild = True
+	if len(args) == 0:
+		sys.exit("usage: python mbIndex.py [-t[--total]] [-r[--rebuild]] file.t|file.p ...")
+
+	nsamples = 0
+	for fileName in args:
+		n = len(SampleIndex(fileName,rebuild))
+		nsamples += n
+		if not total:
+			print "%s\t%d" % (fileName,n)
+	if total:
+		print nsamples
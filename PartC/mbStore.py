@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+
+###Usage: python mbStore.py pack [-r[--remove]] [-n[--procs] n] dir|dirList ...
+###       python mbStore.py unpack [-b[--burnin] n] [-s[--rate] n] store.npz [outDir]
+###       python mbStore.py info store.npz ...
+###Packs the MrBayes .p and .t files of each analysis into one compressed NumPy store,
+###analysis.mb.npz, next to them (requires NumPy). Each .p column is kept as its own array,
+###so reading one trace only decompresses that column. Trees are split into a table of the
+###distinct topologies, each tree's index into it, and its branch lengths, as float64 so
+###they read back exactly as MrBayes printed them. An analysis is the set of files named
+###analysis.p/.t, or analysis.runN.p/.t for nruns > 1. Directories can be listed in a file
+###(such as empDataDirectories or a list of PPDataList directories) and are spread across
+###n processes (default 1). With --remove, the .p and .t files are deleted once the store
+###has been read back and every generation, .p value, topology and branch length found to
+###match the files. Of the Part C scripts, only stationaryPlan.py and subsampleBurn.py read
+###stores in place of removed files, so only use --remove on empDataDirectories before
+###subsampling if the files are unpacked for anything else that needs them.
+###unpack writes the files back out (to outDir, default the store's directory), keeping
+###samples burnin, burnin + rate, ... of each run as subsampleBurn.py would. Values are
+###written back as numbers, not byte for byte as MrBayes formatted them.
+###Module Usage: from mbStore import MbStore
+###  s = MbStore("locus.mb.npz"); s.runs; s.column("run1","LnL"); s.trees("run1",burnin,None,rate)
+
+import sys
+import os
+import getopt
+import glob
+import re
+import time
+from multiprocessing import Pool
+import numpy as np
+
+storeSuffix = ".mb.npz"
+
+runPattern = re.compile(r"^(.*?)(?:\.(run\d+))?\.([pt])$")
+brlenPattern = re.compile(r":([^,();:\[\]]+)")
+
+def analysisFiles( dirName ):
+	"""
+	Groups the .p and .t files in dirName by analysis. Returns {analysis: {run: {kind: file}}},
+	where run is "runN", or "run1" for a single run named analysis.p/.t.
+	"""
+	analyses = {}
+	for fileName in sorted(glob.glob(os.path.join(dirName,"*.p")) + glob.glob(os.path.join(dirName,"*.t"))):
+		m = runPattern.match(os.path.basename(fileName))
+		if m is None:
+			continue
+		analysis,run,kind = m.groups()
+		analyses.setdefault(analysis,{}).setdefault(run or "run1",{})[kind] = fileName
+	return analyses
+
+def readParams( pFile,arrays,run ):
+	"""
+	Adds a .p file's header text and one array per column to arrays, under p/run/.
+	Returns the number of samples.
+	"""
+	header = []
+	rows = []
+	pIn = open(pFile,'r')
+	for line in pIn:
+		fields = line.split()
+		if len(fields) > 0 and fields[0].isdigit():
+			rows.append(fields)
+		elif len(rows) == 0:
+			header.append(line)
+	pIn.close()
+	names = header[-1].split()
+	values = np.array(rows,dtype=np.float64).reshape(len(rows),len(names))
+	arrays["p/%s/header" % run] = np.array("".join(header))
+	arrays["p/%s/names" % run] = np.array(names)
+	arrays["p/%s/Gen" % run] = values[:,0].astype(np.int64)
+	for i in range(1,len(names)):
+		arrays["p/%s/%d" % (run,i)] = values[:,i].copy()
+	return len(rows)
+
+def readTrees( tFile,arrays,run,topologies ):
+	"""
+	Adds a .t file's header and footer text, generations, topology indexes and branch
+	lengths to arrays, under t/run/. topologies maps each distinct topology (the tree with
+	its branch lengths cut out, keeping the colons) to its index, and grows as new ones are
+	seen. Returns the number of samples.
+	"""
+	header = []
+	footer = []
+	gens = []
+	topos = []
+	brlens = []
+	nlens = []
+	prefix = None
+	tIn = open(tFile,'r')
+	for line in tIn:
+		fields = line.split()
+		if len(fields) > 1 and fields[0].lower() == "tree":
+			gen = int(fields[1].split(".")[-1])
+			start = line.index("(")
+			linePrefix = line[:start].replace(".%d " % gen,".%d ",1)
+			if prefix is None:
+				prefix = linePrefix
+			elif linePrefix != prefix:
+				raise ValueError("%s: tree lines differ in form (%s)" % (tFile,line[:start]))
+			newick = line[start:].rstrip()
+			lens = brlenPattern.findall(newick)
+			topology = brlenPattern.sub(":",newick)
+			topos.append(topologies.setdefault(topology,len(topologies)))
+			gens.append(gen)
+			brlens.extend(lens)
+			nlens.append(len(lens))
+			footer = []
+		elif len(gens) == 0:
+			header.append(line)
+		else:
+			footer.append(line)
+	tIn.close()
+	arrays["t/%s/header" % run] = np.array("".join(header))
+	arrays["t/%s/footer" % run] = np.array("".join(footer))
+	arrays["t/%s/prefix" % run] = np.array(prefix or "")
+	arrays["t/%s/gen" % run] = np.array(gens,dtype=np.int64)
+	arrays["t/%s/topology" % run] = np.array(topos,dtype=np.int32)
+	arrays["t/%s/brlens" % run] = np.array(brlens,dtype=np.float64)
+	arrays["t/%s/brlenEnds" % run] = np.cumsum(np.array(nlens,dtype=np.int64))
+	return len(gens)
+
+def packAnalysis( dirName,analysis,runs ):
+	"""
+	Writes the store for one analysis and returns its name and the samples it holds, as
+	{run: {kind: n}}.
+	"""
+	arrays = {}
+	topologies = {}
+	counts = {}
+	for run in sorted(runs):
+		counts[run] = {}
+		if "p" in runs[run]:
+			counts[run]["p"] = readParams(runs[run]["p"],arrays,run)
+		if "t" in runs[run]:
+			counts[run]["t"] = readTrees(runs[run]["t"],arrays,run,topologies)
+	table = [""] * len(topologies)
+	for topology,i in topologies.items():
+		table[i] = topology
+	arrays["runs"] = np.array(sorted(runs))
+	arrays["topologies"] = np.array(table)
+	storeName = os.path.join(dirName,analysis + storeSuffix)
+	tmpName = storeName + ".%d.npz" % os.getpid()
+	np.savez_compressed(tmpName,**arrays)
+	os.rename(tmpName,storeName)
+	return storeName,counts
+
+def sameValues( a,b ):
+	a = np.asarray(a)
+	b = np.asarray(b)
+	if a.shape != b.shape:
+		return False
+	if a.dtype.kind == "f" or b.dtype.kind == "f":
+		return bool(((a == b) | (np.isnan(a) & np.isnan(b))).all())
+	return bool((a == b).all())
+
+def verifyAnalysis( storeName,runs ):
+	"""
+	Reads the analysis's files again and checks the store decodes to the same generations,
+	.p values, topologies and branch lengths. Raises ValueError naming the first mismatch.
+	"""
+	store = MbStore(storeName)
+	try:
+		for run in sorted(runs):
+			source = {}
+			if "p" in runs[run]:
+				readParams(runs[run]["p"],source,run)
+				if not store.has(run,"p") or store.names(run) != [str(n) for n in source["p/%s/names" % run]]:
+					raise ValueError("%s: %s .p columns differ" % (storeName,run))
+				names = store.names(run)
+				if not sameValues(store.gens(run,"p"),source["p/%s/Gen" % run]):
+					raise ValueError("%s: %s .p generations differ" % (storeName,run))
+				for i in range(1,len(names)):
+					if not sameValues(store.column(run,names[i]),source["p/%s/%d" % (run,i)]):
+						raise ValueError("%s: %s .p column %s differs" % (storeName,run,names[i]))
+			if "t" in runs[run]:
+				topologies = {}
+				readTrees(runs[run]["t"],source,run,topologies)
+				table = [""] * len(topologies)
+				for topology,i in topologies.items():
+					table[i] = topology
+				if not store.has(run,"t"):
+					raise ValueError("%s: %s has no trees" % (storeName,run))
+				for key in ("gen","brlenEnds","brlens"):
+					if not sameValues(store._get("t/%s/%s" % (run,key)),source["t/%s/%s" % (run,key)]):
+						raise ValueError("%s: %s tree %s differ" % (storeName,run,key))
+				if len(table) > 0 and not sameValues(store.topologies()[store.topologyIds(run)],np.array(table)[source["t/%s/topology" % run]]):
+					raise ValueError("%s: %s topologies differ" % (storeName,run))
+	finally:
+		store.close()
+
+def packTask( task ):
+	"""
+	Pool task for one directory. Returns a report line for each analysis packed, or the
+	error that stopped it.
+	"""
+	dirName,remove = task
+	reports = []
+	try:
+		for analysis,runs in sorted(analysisFiles(dirName).items()):
+			before = sum([os.path.getsize(f) for r in runs.values() for f in r.values()])
+			storeName,counts = packAnalysis(dirName,analysis,runs)
+			store = MbStore(storeName)
+			for run in counts:
+				for kind in counts[run]:
+					if len(store.gens(run,kind)) != counts[run][kind]:
+						raise ValueError("%s holds %d of %d %s samples" % (storeName,len(store.gens(run,kind)),counts[run][kind],run))
+			store.close()
+			if remove:
+				verifyAnalysis(storeName,runs)
+				for r in runs.values():
+					for f in r.values():
+						os.remove(f)
+			after = os.path.getsize(storeName)
+			reports.append("%s: %d runs, %d bytes to %d (%.1fx)" % (storeName,len(runs),before,after,float(before) / max(after,1)))
+	except (IOError,ValueError,IndexError), err:
+		return reports,"%s: %s" % (dirName,err)
+	return reports,None
+
+class MbStore(object):
+	"""
+	Lazy reader for a store written by pack. Arrays are only read from the file, and
+	decompressed, when first asked for:
+
+	  s.runs ................ Run names ("run1", "run2", ...).
+	  s.has(run,kind) ....... Whether the run's "p" or "t" file was packed.
+	  s.names(run) .......... The .p column names.
+	  s.column(run,name) .... One .p column as an array.
+	  s.gens(run,kind) ...... Generation of each "p" or "t" sample.
+	  s.header(run,kind) .... Text before the first sample (the .t translate block).
+	  s.topologyIds(run) .... Index of each tree's topology in s.topologies().
+	  s.tree(run,i) ......... Tree i, as the newick string MrBayes wrote.
+	  s.trees(run,start,stop,step) .. The trees of a slice of the samples.
+	"""
+	def __init__( self,storeName ):
+		self.storeName = storeName
+		self._npz = np.load(storeName)
+		self._cache = {}
+		self.runs = [str(r) for r in self._get("runs")]
+
+	def _get( self,key ):
+		if key not in self._cache:
+			self._cache[key] = self._npz[key]
+		return self._cache[key]
+
+	def _text( self,key ):
+		return str(self._get(key))
+
+	def close( self ):
+		self._npz.close()
+		self._cache = {}
+
+	def has( self,run,kind ):
+		if kind == "p":
+			return "p/%s/names" % run in self._npz.files
+		return "t/%s/gen" % run in self._npz.files
+
+	def names( self,run ):
+		return [str(n) for n in self._get("p/%s/names" % run)]
+
+	def column( self,run,name ):
+		i = self.names(run).index(name)
+		if i == 0:
+			return self._get("p/%s/Gen" % run)
+		return self._get("p/%s/%d" % (run,i))
+
+	def gens( self,run,kind ):
+		if kind == "p":
+			return self._get("p/%s/Gen" % run)
+		return self._get("t/%s/gen" % run)
+
+	def header( self,run,kind ):
+		return self._text("%s/%s/header" % (kind,run))
+
+	def footer( self,run ):
+		return self._text("t/%s/footer" % run)
+
+	def topologies( self ):
+		return self._get("topologies")
+
+	def topologyIds( self,run ):
+		return self._get("t/%s/topology" % run)
+
+	def tree( self,run,i ):
+		ends = self._get("t/%s/brlenEnds" % run)
+		start = 0
+		if i > 0:
+			start = ends[i - 1]
+		lens = self._get("t/%s/brlens" % run)[start:ends[i]]
+		parts = str(self.topologies()[self.topologyIds(run)[i]]).split(":")
+		newick = [parts[0]]
+		form = {True:":%r",False:":%.7g"}[lens.dtype == np.float64]
+		for j in range(len(lens)):
+			newick.append(form % float(lens[j]))
+			newick.append(parts[j + 1])
+		return "".join(newick)
+
+	def trees( self,run,start=0,stop=None,step=1 ):
+		for i in xrange(*slice(start,stop,step).indices(len(self.gens(run,"t")))):
+			yield self.tree(run,i)
+
+	def unpack( self,outDir,analysis,burnin=0,rate=1 ):
+		"""
+		Writes the runs back out as .p and .t files in outDir, keeping samples burnin,
+		burnin + rate, ... Returns the names of the files written.
+		"""
+		written = []
+		for run in self.runs:
+			base = os.path.join(outDir,analysis)
+			if len(self.runs) > 1:
+				base += "." + run
+			if self.has(run,"p"):
+				names = self.names(run)
+				cols = [self.column(run,n) for n in names]
+				pOut = open(base + ".p",'w')
+				pOut.write(self.header(run,"p"))
+				for i in xrange(burnin,len(cols[0]),rate):
+					pOut.write("\t".join(["%d" % cols[0][i]] + ["%r" % float(c[i]) for c in cols[1:]]) + "\n")
+				pOut.close()
+				written.append(base + ".p")
+			if self.has(run,"t"):
+				gens = self.gens(run,"t")
+				prefix = self._text("t/%s/prefix" % run)
+				tOut = open(base + ".t",'w')
+				tOut.write(self.header(run,"t"))
+				for i in xrange(burnin,len(gens),rate):
+					tOut.write((prefix % gens[i]) + self.tree(run,i) + "\n")
+				tOut.write(self.footer(run))
+				tOut.close()
+				written.append(base + ".t")
+		return written
+
+def readDirs( args ):
+	"""
+	Directories given on the command line, or listed one per line in files given instead.
+	"""
+	dirNames = []
+	for a in args:
+		if os.path.isdir(a):
+			dirNames.append(a)
+		else:
+			dirNames.extend([l.strip() for l in open(a) if l.strip() != ""])
+	return dirNames
+
+if __name__ == "__main__":
+
+	usage = "usage: python mbStore.py pack [-r] [-n procs] dir|dirList ... | unpack [-b burnin] [-s rate] store.npz [outDir] | info store.npz ..."
+	if len(sys.argv) < 2 or sys.argv[1] not in ("pack","unpack","info"):
+		sys.exit(usage)
+	mode = sys.argv[1]
+	try:
+		opts,args = getopt.getopt(sys.argv[2:],"rn:b:s:",["remove","procs=","burnin=","rate="])
+	except getopt.GetoptError, err:
+		print str(err)
+		sys.exit(2)
+	remove = False
+	procs = 1
+	burnin = 0
+	rate = 1
+	for o,a in opts:
+		if o in ("-r","--remove"):
+			remove = True
+		elif o in ("-n","--procs"):
+			procs = int(a)
+		elif o in ("-b","--burnin"):
+			burnin = int(a)
+		elif o in ("-s","--rate"):
+			rate = int(a)
+	if len(args) == 0:
+		sys.exit(usage)
+
+	if mode == "pack":
+		packStart = time.time()
+		dirNames = readDirs(args)
+		pool = Pool(procs)
+		failed = 0
+		for reports,err in pool.imap(packTask,[(d,remove) for d in dirNames]):
+			for report in reports:
+				print report
+			if err is not None:
+				print "Not packed: %s" % err
+				failed += 1
+		pool.close()
+		pool.join()
+		print "Total: %d directories in %.2f secs with %d processes" % (len(dirNames),time.time() - packStart,procs)
+		if failed > 0:
+			sys.exit(1)
+
+	elif mode == "unpack":
+		storeName = args[0]
+		outDir = os.path.dirname(os.path.abspath(storeName))
+		if len(args) > 1:
+			outDir = args[1]
+		analysis = os.path.basename(storeName)[:-len(storeSuffix)]
+		store = MbStore(storeName)
+		for fileName in store.unpack(outDir,analysis,burnin,rate):
+			print fileName
+		store.close()
+
+	else:
+		for storeName in args:
+			store = MbStore(storeName)
+			for run in store.runs:
+				counts = [len(store.gens(run,kind)) if store.has(run,kind) else 0 for kind in ("p","t")]
+				print "%s\t%s\t%d .p samples\t%d .t samples" % (storeName,run,counts[0],counts[1])
+			print "%s\t%d distinct topologies" % (storeName,len(store.topologies()))
+			store.close()
@@ -2,23 +2,31 @@
 
 import sys
 import os
-import subprocess
-import re
+import getopt
+import time
+from multiprocessing import Pool
+import numpy as np
 
-# ----> User-Defined Options <----
-
-if len(sys.argv) ==1:
-	print 'you need the filename as an argument'
-	sys.exit(-1)
-else:
-	empDatName = sys.argv[1]
+###Usage: python repMissPatternsVD.py locus.nex
+###  Run inside a locus directory; reads SeqOutfiles/*.dat and writes SeqOutfiles_wMiss/*.nex
+###Batch Usage: python repMissPatternsVD.py --batch empDataDirectories [--procs n]
+###  Spreads every (locus, replicate) pair across n processes (default 1), then renames
+###  SeqOutfiles to simSeqOutfiles and SeqOutfiles_wMiss to SeqOutfiles in each locus
+###  directory, as addBatchMissPatterns.sh did. Per-locus timings are printed as each locus finishes.
 
 #empDatName = "primates.nex"		# The name of the empirical data set with missing data
 
 # ---> Defining some functions of convenience <---
 
-def shCall( cmd ):
-	subprocess.call(cmd,shell=True)
+def makeDir( path ):
+	if not os.path.isdir(path):
+		os.mkdir(path)
+	
+def datRoot( datFile ):	# Same as `basename datFile .dat`, without the fork
+	root = os.path.basename(datFile)
+	if root.endswith(".dat") and root != ".dat":
+		root = root[:-len(".dat")]
+	return root
 	
 def cd( cmd ):
 	os.chdir(cmd)
@@ -29,54 +37,84 @@ def ls( ):
 		files = files[1:] # To get rid of .DS_Store
 	return files
 
-def findAllPos( string,sub ):	# Only works for non-overlapping substrings
-	return [match.start() for match in re.finditer(sub,string)]
-	
-def findMissPos( nexFile ):
-	inFile = open(nexFile,'r')
-	parLine = inFile.readline()
-	while ( 'matrix' not in parLine ):
-		parLine = inFile.readline()
-	matrixLine = inFile.readline()
-	while not matrixLine.strip():
-		matrixLine = inFile.readline()
-	missPos = []
-	while ( ';' not in matrixLine ):
-		matrixLine = matrixLine.split()[1]
-		gaps = findAllPos(matrixLine,'-')
-		ambigs = findAllPos(matrixLine,'N')
-		miss = findAllPos(matrixLine,'\?')
-		gaps.extend(ambigs)
-		gaps.extend(miss)
-		gaps = sorted(gaps)
-		missPos.append(gaps)
-		matrixLine = inFile.readline()
-	inFile.close()
-	return missPos
-
-def getNexHeader( nexFile ):
-	"""
-	Function to read in and store lines of original nexus file above data matrix
-	"""
-	nexHeader = []
-	nexIn = open(nexFile,'r')
-	readFile = nexIn.read()
-	for line in readFile.splitlines(True):
-		if "nexus" in line:
-			nexHeader.append(line)
-		if "NEXUS" in line:
-			nexHeader.append(line)
-		if "begin data" in line:
-			nexHeader.append(line)
-		if "dimensions" in line:
-			nexHeader.append(line)
-		if "format" in line:
-			nexHeader.append(line)
-		if "matrix" in line:
-			nexHeader.append(line)
-	nexIn.close()
-	return nexHeader
-	
+missChars = "-N?"	# Characters treated as missing data in the empirical matrix
+
+def seqsToBytes( seqs ):
+	"""
+	Function to pack a list of equal-length sequences into a writable taxa x sites
+	array of byte codes. Returns None if the sequences differ in length.
+	"""
+	if ( len(set(map(len,seqs))) > 1 ):
+		return None
+	byteMat = np.frombuffer(bytearray("".join(seqs)),dtype=np.uint8)
+	return byteMat.reshape(len(seqs),-1)
+
+headerKeys = ["nexus","begin data","dimensions","format","matrix"]	# Header lines kept for output
+
+class NexusReader(object):
+	"""
+	Single-pass reader for the empirical nexus file. The file is streamed once and
+	exposes the header lines above the data matrix, the taxon names (in file order),
+	the per-taxon sequences and the missing-data mask. Interleaved matrices are
+	supported by appending each block to the sequence of the taxon named on the line.
+	"""
+	def __init__( self,nexFile ):
+		self.nexFile = nexFile
+		self.header = []
+		self.taxa = []
+		self.seqs = []
+		self._miss = None
+		nexIn = open(nexFile,'r')
+		self._readHeader(nexIn)
+		self._readMatrix(nexIn)
+		nexIn.close()
+
+	def _readHeader( self,nexIn ):
+		for line in nexIn:
+			lowLine = line.lower()
+			for key in headerKeys:
+				if key in lowLine:
+					self.header.append(line)
+					break
+			if "matrix" in lowLine:
+				return
+		sys.exit("No matrix found in %s! Exiting..." % self.nexFile)
+
+	def _readMatrix( self,nexIn ):
+		chunks = {}
+		for line in nexIn:
+			endMatrix = ';' in line
+			if endMatrix:
+				line = line[:line.index(';')]
+			fields = line.split()
+			if len(fields) > 1:
+				name = fields[0]
+				if name not in chunks:
+					self.taxa.append(name)
+					chunks[name] = []
+				chunks[name].extend(fields[1:])
+			if endMatrix:
+				break
+		self.seqs = ["".join(chunks[name]) for name in self.taxa]
+
+	def missMask( self ):
+		if self._miss is None:
+			self._miss = findMissPos(self.seqs)
+			if self._miss is None:
+				sys.exit("Empirical sequences in %s are not all the same length! Exiting..." % self.nexFile)
+		return self._miss
+
+def findMissPos( seqs ):
+	"""
+	Function to return a boolean mask (taxa x sites) that is True wherever the
+	empirical sequences have a gap, N or ?. Returns None for a ragged matrix.
+	"""
+	empMat = seqsToBytes(seqs)
+	if empMat is None:
+		return None
+	missCodes = np.frombuffer(missChars,dtype=np.uint8)
+	return np.in1d(empMat,missCodes).reshape(empMat.shape)
+
 def readMatrix( inStream ):
 	"""
 	Function to read in simulated sequences from a .dat file generated by seq-gen.
@@ -95,57 +133,151 @@ def readMatrix( inStream ):
 		seqs.append(seqDict[i+1])
 	return seqs
 	
-def getTaxNames( nexFile ):
-	nexIn = open(nexFile,'r')
-	parLine = nexIn.readline()
-	while ( 'matrix' not in parLine ):
-		parLine = nexIn.readline()
-	name = nexIn.readline()
-	while not name.strip():
-		name = nexIn.readline()
-	name = name.split()
-	taxa = []
-	while( ";" not in name ):
-		taxa.append(name[0])
-		name = nexIn.readline()
-		name = name.split()
-	return taxa
-	
 def outputMatrixWithMiss( outStream,header,taxa,seqs,miss ):
-	for i in nexHeader:
+	for i in header:
 		outStream.write( i )
 	if ( len(taxa) != len(seqs) ):
 		sys.exit("Number of taxon names different than number of simulated sequences! Exiting...")
-	if ( len(taxa) != len(miss) ):
+	if ( len(taxa) != miss.shape[0] ):
 		sys.exit("Number of taxon names different than number of missing position lists! Exiting...")
-	# Add missing data to sequences
-	for i in range( len(miss) ):
-		for j in miss[i]:
-			seqList = list(seqs[i])
-			seqList[j] = "-"
-			seqs[i] = "".join(seqList)
+	simMat = seqsToBytes(seqs)
+	if ( simMat is None or simMat.shape != miss.shape ):
+		sys.exit("Simulated matrix dimensions differ from the empirical matrix! Exiting...")
+	# Add missing data to all sequences at once
+	simMat[miss] = ord("-")
 	# Output taxon names and sequences to file
 	for i in range( len(taxa) ):
-		outStream.write( "%s		%s\n" % (taxa[i],seqs[i]) )
+		outStream.write( "%s		%s\n" % (taxa[i],simMat[i].tostring()) )
 	outStream.write(";\n")
 	outStream.write("End;\n")
 	
-# ---> End function definitions <---
-	
-shCall("mkdir SeqOutfiles_wMiss")
-miss = findMissPos("%s" % empDatName)
-nexHeader = getNexHeader("%s" % empDatName)
-taxNames = getTaxNames("%s" % empDatName)
-cd("SeqOutfiles")
-dats = ls()
-for j in dats:
-	datIn = open(j,'r')
-	datFileRootIn = subprocess.Popen("basename %s .dat" % j,shell=True,stdout=subprocess.PIPE)
-	datFileRoot = datFileRootIn.communicate()[0].strip()
-	nexOut = open("../SeqOutfiles_wMiss/%s.nex" % datFileRoot,'w')	
+def addMissToReplicate( empNex,datFile,outFile ):
+	"""
+	Function to add the empirical missing data pattern to one simulated .dat file
+	and write the result as a nexus file.
+	"""
+	datIn = open(datFile,'r')
 	matrix = readMatrix(datIn)	# Reads in data matrix and orders taxa by number
-	outputMatrixWithMiss(nexOut,nexHeader,taxNames,matrix,miss)
 	datIn.close()
+	nexOut = open(outFile,'w')
+	outputMatrixWithMiss(nexOut,empNex.header,empNex.taxa,matrix,empNex.missMask())
 	nexOut.close()
-cd("..") # Back out of SeqOutfiles
-	
\ No newline at end of file
+
+cachedNex = {}	# Per-process cache of the most recently read empirical file
+
+def batchTask( task ):
+	"""
+	Pool task for one (locus, replicate) pair. Tasks arrive grouped by locus, so each
+	process only reads a given empirical nexus file once. Returns the locus, when the
+	task started, the time spent and an error message (or None).
+	"""
+	locus,nexFile,datFile,outFile = task
+	taskStart = time.time()
+	try:
+		if nexFile not in cachedNex:
+			cachedNex.clear()
+			cachedNex[nexFile] = NexusReader(nexFile)
+		addMissToReplicate(cachedNex[nexFile],datFile,outFile)
+	except (SystemExit,Exception), err:
+		return (locus,taskStart,time.time() - taskStart,"%s: %s" % (datFile,err))
+	return (locus,taskStart,time.time() - taskStart,None)
+
+def runBatch( dirList,procs ):
+	"""
+	Function to add missing data patterns to every simulated replicate of every locus
+	directory listed in dirList, using a pool of procs processes.
+	"""
+	tasks = []
+	loci = {}
+	for line in open(dirList,'r'):
+		locusDir = line.strip()
+		if not locusDir:
+			continue
+		locus = os.path.basename(os.path.normpath(locusDir))
+		seqDir = os.path.join(locusDir,"SeqOutfiles")
+		outDir = os.path.join(locusDir,"SeqOutfiles_wMiss")
+		if not os.path.isdir(seqDir):
+			sys.stderr.write("%s: no SeqOutfiles directory; skipped\n" % locusDir)
+			continue
+		makeDir(outDir)
+		dats = sorted([d for d in os.listdir(seqDir) if d.endswith(".dat")])
+		for d in dats:
+			outFile = os.path.join(outDir,"%s.nex" % datRoot(d))
+			tasks.append((locus,os.path.join(locusDir,"%s.nex" % locus),os.path.join(seqDir,d),outFile))
+		loci[locus] = {'dir' : locusDir,'reps' : len(dats),'left' : len(dats),'cpu' : 0.0,'start' : None,'errors' : []}
+	batchStart = time.time()
+	pool = Pool(procs)
+	print "locus\treplicates\tcpu_secs\twall_secs"
+	for locus,taskStart,elapsed,err in pool.imap_unordered(batchTask,tasks,4):
+		stats = loci[locus]
+		if stats['start'] is None or taskStart < stats['start']:
+			stats['start'] = taskStart
+		stats['left'] -= 1
+		stats['cpu'] += elapsed
+		if err is not None:
+			stats['errors'].append(err)
+		if stats['left'] == 0:
+			finishLocus(locus,stats,time.time() - stats['start'])
+	pool.close()
+	pool.join()
+	for locus in sorted(loci):
+		if loci[locus]['reps'] == 0:	# Loci with no simulated replicates
+			loci[locus]['errors'].append("%s: no replicates" % os.path.join(loci[locus]['dir'],"SeqOutfiles"))
+			outDir = os.path.join(loci[locus]['dir'],"SeqOutfiles_wMiss")
+			if os.path.isdir(outDir) and len(os.listdir(outDir)) == 0:
+				os.rmdir(outDir)
+			finishLocus(locus,loci[locus],0.0)
+	print "Total: %d replicates from %d loci in %.2f secs with %d processes" % (len(tasks),len(loci),time.time() - batchStart,procs)
+	sys.stdout.flush()
+
+def finishLocus( locus,stats,wall ):
+	"""
+	Function to swap the SeqOutfiles directories of a completed locus and report its timing:
+	the CPU time of its replicates, and the wall time from its first replicate starting to
+	its last finishing.
+	Loci with errors are left as they are so they can be rerun.
+	"""
+	if stats['errors'] or stats['left'] > 0:
+		for err in stats['errors']:
+			sys.stderr.write("%s\n" % err)
+		sys.stderr.write("%s not completed; SeqOutfiles left in place\n" % locus)
+	else:
+		os.rename(os.path.join(stats['dir'],"SeqOutfiles"),os.path.join(stats['dir'],"simSeqOutfiles"))
+		os.rename(os.path.join(stats['dir'],"SeqOutfiles_wMiss"),os.path.join(stats['dir'],"SeqOutfiles"))
+	print "%s\t%d\t%.2f\t%.2f" % (locus,stats['reps'],stats['cpu'],wall)
+	sys.stdout.flush()
+
+# ---> End function definitions <---
+	
+if __name__ == "__main__":
+
+	try:
+		opts,args = getopt.getopt(sys.argv[1:],"b:n:",["batch=","procs="])
+	except getopt.GetoptError, err:
+		print str(err)
+		sys.exit(2)
+	batchList = None
+	procs = 1
+	for o,a in opts:
+		if o in ("-b","--batch"):
+			batchList = a
+		elif o in ("-n","--procs"):
+			procs = int(a)
+
+	if batchList is not None:
+		runBatch(batchList,procs)
+		sys.exit(0)
+
+	if len(args) == 0:
+		print 'you need the filename as an argument'
+		sys.exit(-1)
+	else:
+		empDatName = args[0]
+
+	makeDir("SeqOutfiles_wMiss")
+	empNex = NexusReader(empDatName)
+	cd("SeqOutfiles")
+	dats = ls()
+	for j in dats:
+		addMissToReplicate(empNex,j,"../SeqOutfiles_wMiss/%s.nex" % datRoot(j))
+	cd("..") # Back out of SeqOutfiles
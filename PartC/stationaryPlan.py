@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+###Usage: python stationaryPlan.py [-s samples] [-r nruns] [-n procs] [-o planFile] empDataDirectories
+###Works out, for every directory listed in empDataDirectories, the burnin and subsampling rate
+###that leave samples trees (default 100) spread evenly over the stationary part of its runs,
+###as stationarySubsamplev2.2.sh (nruns=2) and v2.4 (nruns=4) did by trial and error. Each
+###mrconverge.log is read once and the numbers worked out directly, for any number of runs,
+###with the directories spread across procs processes (default 1). The number of runs is the
+###number of .t files in each directory unless given with -r, or of runs with trees in its
+###mbStore.py store (analysis.mb.npz) if the files were packed and removed. The plan is
+###written to planFile (default stationaryPlan), one tab-separated line per directory:
+###  directory nruns ntrees nburn rate burnin samples
+###where nburn is MrConverge's burnin, burnin the one to subsample with, and samples the trees
+###each run will keep. Apply it with: python subsampleBurn.py --keep _old --plan planFile
+
+import sys
+import os
+import getopt
+import glob
+import time
+from multiprocessing import Pool
+
+def readConverge( logFile ):
+	"""
+	Reads the number of trees per run and MrConverge's burnin from mrconverge.log, in one
+	pass that stops once both are found.
+	"""
+	ntrees = None
+	nburn = None
+	logIn = open(logFile,'r')
+	for line in logIn:
+		if ntrees is None and "Determining" in line:
+			ntrees = int(line.split()[4])
+		elif nburn is None and "BURNIN" in line:
+			nburn = int(line.split()[3])
+		if ntrees is not None and nburn is not None:
+			break
+	logIn.close()
+	if ntrees is None or nburn is None:
+		raise ValueError("%s has no tree count or burnin" % logFile)
+	return ntrees,nburn
+
+def planRun( ntrees,nburn,perRun ):
+	"""
+	Returns the (rate,burnin) that keep perRun of a run's ntrees samples, as widely spaced as
+	the nburn..ntrees stationary samples allow and ending at the last one. The subsampler keeps
+	samples burnin, burnin + rate, ..., so burnin is pushed on past nburn until exactly perRun
+	fit. Runs with fewer stationary samples than perRun keep them all.
+	"""
+	stationary = ntrees - nburn
+	if stationary < perRun or stationary < 1:
+		return 1,nburn
+	if perRun == 1:
+		return stationary,ntrees - 1
+	rate = (stationary - 1) / (perRun - 1)
+	return rate,ntrees - ((perRun - 1) * rate + 1)
+
+def storeRuns( dirName ):
+	"""
+	Counts the runs with trees in the mbStore.py stores in dirName.
+	"""
+	nruns = 0
+	for storeName in glob.glob(os.path.join(dirName,"*.mb.npz")):
+		from mbStore import MbStore	# NumPy is only needed for stores
+		store = MbStore(storeName)
+		nruns += len([run for run in store.runs if store.has(run,"t")])
+		store.close()
+	return nruns
+
+def planTask( task ):
+	"""
+	Pool task for one directory. Returns its plan line fields, or the error that stopped it.
+	"""
+	dirName,samples,nruns = task
+	try:
+		if nruns < 1:
+			nruns = len(glob.glob(os.path.join(dirName,"*.t")))
+		if nruns < 1:
+			nruns = storeRuns(dirName)
+		if nruns < 1:
+			raise ValueError("%s has no .t files or stores" % dirName)
+		if samples % nruns != 0:
+			raise ValueError("%d samples don't split evenly over %d runs" % (samples,nruns))
+		ntrees,nburn = readConverge(os.path.join(dirName,"mrconverge.log"))
+		rate,burnin = planRun(ntrees,nburn,samples / nruns)
+		kept = len(range(burnin,ntrees,rate))
+		return (dirName,nruns,ntrees,nburn,rate,burnin,kept),None
+	except (IOError,ValueError,IndexError,ImportError), err:
+		return None,"%s: %s" % (dirName,err)
+
+if __name__ == "__main__":
+
+	try:
+		opts,args = getopt.getopt(sys.argv[1:],"s:r:n:o:",["samples=","nruns=","procs=","plan="])
+	except getopt.GetoptError, err:
+		print str(err)
+		sys.exit(2)
+	samples = 100
+	nruns = 0
+	procs = 1
+	planFile = "stationaryPlan"
+	for o,a in opts:
+		if o in ("-s","--samples"):
+			samples = int(a)
+		elif o in ("-r","--nruns"):
+			nruns = int(a)
+		elif o in ("-n","--procs"):
+			procs = int(a)
+		elif o in ("-o","--plan"):
+			planFile = a
+	if len(args) != 1:
+		sys.exit("usage: python stationaryPlan.py [-s samples] [-r nruns] [-n procs] [-o planFile] empDataDirectories")
+
+	planStart = time.time()
+	dirNames = [l.strip() for l in open(args[0]) if l.strip() != ""]
+	pool = Pool(procs)
+	plans = pool.map(planTask,[(d,samples,nruns) for d in dirNames])
+	pool.close()
+	pool.join()
+
+	planOut = open(planFile,'w')
+	failed = 0
+	for plan,err in plans:
+		if plan is None:
+			print "Not planned: %s" % err
+			failed += 1
+			continue
+		planOut.write("\t".join(map(str,plan)) + "\n")
+		if plan[1] * plan[6] != samples:
+			print "Fewer than %d trees in stationary distribution: %s (%d per run)" % (samples,plan[0],plan[6])
+	planOut.close()
+	print "Planned %d of %d directories in %.2f secs with %d processes" % (len(dirNames) - failed,len(dirNames),time.time() - planStart,procs)
+	if failed > 0:
+		sys.exit(1)
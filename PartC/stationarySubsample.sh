@@ -0,0 +1,15 @@
+#!/bin/bash
+
+# Total number of trees (and parameter samples) to keep from the
+# stationary part of each analysis, split evenly over its runs.
+
+SAMPLES=100
+
+# Number of processes to spread the directories and files across.
+# Defaults to the number of cores PBS assigned to the job.
+
+PROCS=${PBS_NUM_PPN:-1}
+
+python stationaryPlan.py --samples $SAMPLES --procs $PROCS \
+    --plan stationaryPlan empDataDirectories || exit 1
+python subsampleBurn.py --keep _old --plan stationaryPlan --procs $PROCS
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+###Usage: python subsampleBurn.py [-k[--keep] suffix] subsamplingRate burnin [file ...]
+###Plan Usage: python subsampleBurn.py [-k[--keep] suffix] --plan planFile [--procs n]
+###Thins MrBayes .p and .t files in place, as subsamplerBurn3.2.sh did: the first burnin
+###samples of each file are dropped and every subsamplingRate-th sample after that is kept.
+###Each file is read once and the thinned copy written next to it, then renamed over it, so
+###a file is either untouched or fully thinned. Files default to every *.p and *.t in the
+###current directory, so any number of runs are handled. With --keep, the original is kept
+###as file + suffix (e.g. _old, which subsampler_oops.sh puts back), as a hard link where the
+###filesystem allows rather than a copy. With --plan, the rate and burnin for the .p and .t
+###files of each directory are read from the plan stationaryPlan.py wrote, and the files are
+###spread across n processes (default 1). Files with an index from mbIndex.py are thinned by
+###seeking to just the samples kept, and the index is moved to the kept original, if any.
+###A directory whose .p and .t files were packed into an mbStore.py store (analysis.mb.npz)
+###and removed has the thinned files written out from the store instead, which keeps the
+###originals, so --keep doesn't apply. A planned directory with neither is an error.
+
+import sys
+import os
+import getopt
+import glob
+import shutil
+import tempfile
+import time
+from multiprocessing import Pool
+from mbIndex import SampleIndex,fileKind,sampleGen,hasIndex,removeIndex,indexSuffix
+
+def subsample( fileName,rate,burnin,keep ):
+	"""
+	Streams fileName once, writing the header, the thinned samples and any trailing
+	lines (the .t file's "end;") to a temporary file in the same directory, then renames
+	it over fileName. Returns the number of samples read and kept.
+	"""
+	kind = fileKind(fileName)
+	fileDir = os.path.dirname(os.path.abspath(fileName))
+	tmpFd,tmpName = tempfile.mkstemp(prefix=os.path.basename(fileName) + ".",dir=fileDir)
+	nread = 0
+	nkept = 0
+	try:
+		subOut = os.fdopen(tmpFd,'w')
+		if hasIndex(fileName):
+			idx = SampleIndex(fileName)
+			nread = len(idx)
+			subOut.write(idx.header())
+			for line in idx.samples(burnin,None,rate):
+				subOut.write(line)
+				nkept += 1
+			subOut.write(idx.footer())
+		else:
+			fileIn = open(fileName,'r')
+			for line in fileIn:
+				if sampleGen(line,kind) is not None:
+					if nread >= burnin and (nread - burnin) % rate == 0:
+						subOut.write(line)
+						nkept += 1
+					nread += 1
+				else:
+					subOut.write(line)
+			fileIn.close()
+		subOut.close()
+		shutil.copymode(fileName,tmpName)
+		if keep != "":
+			keepName = fileName + keep
+			if os.path.exists(keepName):
+				os.remove(keepName)
+			try:
+				os.link(fileName,keepName)
+			except OSError:
+				shutil.copy2(fileName,keepName)
+			if hasIndex(fileName):
+				os.rename(fileName + indexSuffix,keepName + indexSuffix)
+		removeIndex(fileName)
+		os.rename(tmpName,fileName)
+	except:
+		if os.path.exists(tmpName):
+			os.remove(tmpName)
+		raise
+	return nread,nkept
+
+def subsampleStore( storeName,rate,burnin ):
+	"""
+	Writes the thinned .p and .t files of a store packed by mbStore.py next to it. Returns
+	(file,nread,nkept) for each file written.
+	"""
+	from mbStore import MbStore,storeSuffix	# NumPy is only needed for stores
+	store = MbStore(storeName)
+	analysis = os.path.basename(storeName)[:-len(storeSuffix)]
+	sizes = []
+	for run in store.runs:	# In the order unpack writes them
+		for kind in ("p","t"):
+			if store.has(run,kind):
+				sizes.append(len(store.gens(run,kind)))
+	fileNames = store.unpack(os.path.dirname(storeName),analysis,burnin,rate)
+	store.close()
+	return [(fileNames[i],sizes[i],len(range(burnin,sizes[i],rate))) for i in range(len(fileNames))]
+
+def dirFiles( dirName ):
+	"""
+	The .p and .t files in dirName, or its mbStore.py stores if it has none.
+	"""
+	fileNames = sorted(glob.glob(os.path.join(dirName,"*.p"))) + sorted(glob.glob(os.path.join(dirName,"*.t")))
+	if len(fileNames) == 0:
+		fileNames = sorted(glob.glob(os.path.join(dirName,"*.mb.npz")))
+	return fileNames
+
+def readPlan( planFile ):
+	"""
+	Reads a plan written by stationaryPlan.py into a list of (file,rate,burnin) tasks, one
+	for each .p and .t file (or store) in each planned directory. Raises ValueError for a
+	directory with none.
+	"""
+	tasks = []
+	for line in open(planFile):
+		fields = line.split("\t")
+		if len(fields) < 7:
+			continue
+		dirName = fields[0]
+		rate = int(fields[4])
+		burnin = int(fields[5])
+		fileNames = dirFiles(dirName)
+		if len(fileNames) == 0:
+			raise ValueError("%s has no .p, .t or .mb.npz files" % dirName)
+		for fileName in fileNames:
+			tasks.append((fileName,rate,burnin))
+	return tasks
+
+def thin( fileName,rate,burnin,keep ):
+	"""
+	Thins a .p or .t file, or writes out the thinned files of a store. Returns
+	(file,nread,nkept) for each file thinned.
+	"""
+	if fileName.endswith(".mb.npz"):
+		return subsampleStore(fileName,rate,burnin)
+	nread,nkept = subsample(fileName,rate,burnin,keep)
+	return [(fileName,nread,nkept)]
+
+def planTask( task ):
+	"""
+	Pool task for one file of a plan.
+	"""
+	fileName,rate,burnin,keep = task
+	return "\n".join(["%s: kept %d of %d samples" % (f,nkept,nread) for f,nread,nkept in thin(fileName,rate,burnin,keep)])
+
+if __name__ == "__main__":
+
+	try:
+		opts,args = getopt.getopt(sys.argv[1:],"k:n:",["keep=","plan=","procs="])
+	except getopt.GetoptError, err:
+		print str(err)
+		sys.exit(2)
+	keep = ""
+	planFile = ""
+	procs = 1
+	for o,a in opts:
+		if o in ("-k","--keep"):
+			keep = a
+		elif o == "--plan":
+			planFile = a
+		elif o in ("-n","--procs"):
+			procs = int(a)
+
+	if planFile != "":
+		planStart = time.time()
+		try:
+			tasks = readPlan(planFile)
+		except ValueError, err:
+			sys.exit("%s! Exiting..." % err)
+		pool = Pool(procs)
+		nfiles = 0
+		for report in pool.imap(planTask,[(f,rate,burnin,keep) for f,rate,burnin in tasks]):
+			print report
+			nfiles += len(report.split("\n"))
+		pool.close()
+		pool.join()
+		print "Total: %d files in %.2f secs with %d processes" % (nfiles,time.time() - planStart,procs)
+		sys.exit(0)
+
+	if len(args) < 2:
+		sys.exit("usage: python subsampleBurn.py [-k[--keep] suffix] subsamplingRate burnin [file ...]")
+	rate = int(args[0])
+	burnin = int(args[1])
+	if rate < 1 or burnin < 0:
+		sys.exit("The subsampling rate must be at least 1 and the burnin at least 0! Exiting...")
+
+	fileNames = args[2:]
+	if len(fileNames) == 0:
+		fileNames = dirFiles(".")
+	for fileName in fileNames:
+		if fileKind(fileName) is None and not fileName.endswith(".mb.npz"):
+			sys.exit("%s is not a MrBayes .p or .t file! Exiting..." % fileName)
+
+	for fileName in fileNames:
+		for thinned,nread,nkept in thin(fileName,rate,burnin,keep):
+			print "%s: kept %d of %d samples" % (thinned,nkept,nread)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+###Usage: python benchWq.py [-w workerCounts] [-t taskSecs] [-n tasks] [-b batch] [-d scratchDir]
+###                         [--partD wq.py] [--partABE wq.py]
+###Times the two wq.py dispatchers, with synthetic tasks run in local mode (-L, over ipc
+###sockets): partD, the one in this directory, which answers each worker's REQ with one task
+###and takes its heartbeats and results as further requests on the same REP socket, and
+###partABE, the one used by Parts A, B and E, which answers each REQ with a batch of tasks
+###and takes the results back on a separate PUSH/PULL result manager socket.
+###Every combination of worker count (comma separated, default 1,4,16) and task duration in
+###seconds (comma separated, default 0,0.1, where 0 runs a no-op) is run with each variant.
+###For each run it reports the throughput while tasks were running, the dispatch latency (the
+###gap between a worker finishing one task and starting the next), and the startup and
+###shutdown times around the tasks. Batch sets --batch for the partABE variant.
+
+import sys
+import os
+import getopt
+import shutil
+import subprocess
+import tempfile
+import time
+import json
+import math
+
+def writeTask( scratch,secs ):
+	"""
+	Writes a synthetic task script that sleeps for secs, or does nothing.
+	"""
+	taskFile = os.path.join(scratch,"task.sh")
+	task = open(taskFile,"w")
+	task.write("#!/bin/sh\n")
+	if secs > 0:
+		task.write("sleep %s\n" % secs)
+	task.close()
+	os.chmod(taskFile,0755)
+	return taskFile
+
+def writeList( scratch,ntasks ):
+	"""
+	Writes an input list of ntasks made up file names; the tasks never open them.
+	"""
+	listFile = os.path.join(scratch,"inputs")
+	inputs = open(listFile,"w")
+	for i in range(ntasks):
+		inputs.write("%s\n" % os.path.join(scratch,"input_%d" % i))
+	inputs.close()
+	return listFile
+
+def percentile( values,p ):
+	ordered = sorted(values)
+	return ordered[int(math.ceil(p * len(ordered))) - 1]
+
+def runVariant( variant,wqScript,workers,secs,ntasks,batch,scratchParent ):
+	"""
+	Runs one wq.py dispatcher locally and works out its timings from the results file.
+	"""
+	scratch = tempfile.mkdtemp(dir=scratchParent)
+	try:
+		taskFile = writeTask(scratch,secs)
+		listFile = writeList(scratch,ntasks)
+		resultsFile = os.path.join(scratch,"results.jsonl")
+		if variant == "partD":
+			cmd = [sys.executable,wqScript,"-d",taskFile,"-i",listFile,"-L",str(workers),"-b","1",
+				"-l",os.path.join(scratch,"ledger"),"-r",resultsFile]
+		else:
+			cmd = [sys.executable,wqScript,"-d","-L",str(workers),"--batch",str(batch),taskFile,
+				listFile,os.path.join(scratch,"ledger"),resultsFile]
+		devnull = open(os.devnull,"w")
+		launched = time.time()
+		code = subprocess.call(cmd,stdout=devnull,stderr=devnull,cwd=scratch)
+		exited = time.time()
+		devnull.close()
+		if code != 0:
+			sys.exit("%s exited with code %d! Exiting..." % (" ".join(cmd),code))
+
+		records = [json.loads(l) for l in open(resultsFile) if l.strip() != ""]
+		ran = [r for r in records if r['status'] == "done"]
+		if len(ran) != ntasks:
+			sys.exit("%s ran %d of %d tasks! Exiting..." % (wqScript,len(ran),ntasks))
+
+		# Dispatch latency is the gap between consecutive tasks on the same worker.
+
+		byWorker = {}
+		for r in ran:
+			byWorker.setdefault(r['worker'],[]).append((r['start'],r['end']))
+		gaps = []
+		for w in byWorker:
+			runs = sorted(byWorker[w])
+			for i in range(1,len(runs)):
+				gaps.append(runs[i][0] - runs[i - 1][1])
+
+		first = min([r['start'] for r in ran])
+		last = max([r['end'] for r in ran])
+		result = {'variant':variant,'workers':workers,'secs':secs,'tasks':ntasks,
+			'wall':exited - launched,'throughput':ntasks / max(last - first,1e-9),
+			'startup':first - launched,'shutdown':exited - last,
+			'latency':None,'latency95':None}
+		if len(gaps) > 0:
+			result['latency'] = sum(gaps) / len(gaps)
+			result['latency95'] = percentile(gaps,0.95)
+		return result
+	finally:
+		shutil.rmtree(scratch)
+
+if __name__ == "__main__":
+
+	here = os.path.dirname(os.path.abspath(__file__))
+	try:
+		opts,args = getopt.getopt(sys.argv[1:],"w:t:n:b:d:",["workers=","secs=","tasks=","batch=",
+			"dir=","partD=","partABE="])
+	except getopt.GetoptError, err:
+		print str(err)
+		sys.exit(2)
+	workerCounts = [1,4,16]
+	taskSecs = [0.0,0.1]
+	ntasks = 200
+	batch = 1
+	scratchParent = None
+	scripts = {'partD':os.path.join(here,"wq.py"),
+		'partABE':os.path.join(os.path.dirname(here),"PartE","wq.py")}
+	for o,a in opts:
+		if o in ("-w","--workers"):
+			workerCounts = [int(w) for w in a.split(",")]
+		elif o in ("-t","--secs"):
+			taskSecs = [float(t) for t in a.split(",")]
+		elif o in ("-n","--tasks"):
+			ntasks = int(a)
+		elif o in ("-b","--batch"):
+			batch = int(a)
+		elif o in ("-d","--dir"):
+			scratchParent = a
+		elif o == "--partD":
+			scripts['partD'] = a
+		elif o == "--partABE":
+			scripts['partABE'] = a
+
+	for variant in ["partD","partABE"]:
+		if not os.path.exists(scripts[variant]):
+			sys.exit("Can't find the %s wq.py: %s! Exiting..." % (variant,scripts[variant]))
+
+	print "Tasks per run: %d, partABE batch: %d" % (ntasks,batch)
+	print "%-9s %7s %7s %8s %9s %12s %12s %9s %9s" % ("Variant","Workers","Task s","Wall s",
+		"Tasks/s","Latency ms","p95 ms","Start s","Stop s")
+	for secs in taskSecs:
+		for workers in workerCounts:
+			for variant in ["partD","partABE"]:
+				r = runVariant(variant,scripts[variant],workers,secs,ntasks,batch,scratchParent)
+				if r['latency'] is None:
+					latency = "%12s %12s" % ("-","-")
+				else:
+					latency = "%12.1f %12.1f" % (r['latency'] * 1e3,r['latency95'] * 1e3)
+				print "%-9s %7d %7.2f %8.2f %9.1f %s %9.2f %9.2f" % (variant,workers,secs,r['wall'],
+					r['throughput'],latency,r['startup'],r['shutdown'])
+				sys.stdout.flush()
@@ -41,44 +41,215 @@ Some of the important variables are:
   port .. Port for the dispatcher request socket (default: 5557)
   host .. Host name on which dispatcher is running.
 
+The dispatcher may instead be run on its own as a shared service, for
+instance on a login node, serving several input lists or a directory
+tree of inputs. It then picks a free port and writes it to an endpoint
+file, which workers from any number of PBS jobs read to find it, and
+keeps going until all the work is done however many jobs that takes.
+
 """
 
 import time
 import zmq
 import getopt
 import sys
+import os
 import socket
 import subprocess
-from multiprocessing import Process
+from multiprocessing import Process, Condition, Value
 import re
+import bisect
+import threading
+import tempfile
+import json
+import shutil
+import fnmatch
+import math
 
 
-def shell ( cmd ):
+def shell ( cmd, logbase = None ):
    """
    Submits a shell command for processing, and returns the cmd status
    flag plus the STDIN and STDOUT messages.
 
    Arguments:
 
-      cmd .. The desired shell command line.
+      cmd ...... The desired shell command line.
+      logbase .. If given, stdout and stderr are streamed straight to the
+                 files logbase.out and logbase.err rather than being held
+                 in memory, and only the last lines of each are returned.
 
    Returns:
 
-      3-tuple: True/False for success/failure.
-               List of stdout lines.
-               List of stderr lines.
-   """
-   p = subprocess.Popen( cmd, shell=True, stderr=subprocess.PIPE,
-                         stdout=subprocess.PIPE )
-   x = p.communicate()
-   p.stdout.close()
-   p.stderr.close()
-   if x[1] == '':
-      status = True
+      7-tuple: True/False for success/failure (a zero exit code).
+               List of stdout lines (only the last ones if logging).
+               List of stderr lines (only the last ones if logging).
+               Number of bytes written to stdout.
+               Number of bytes written to stderr.
+               Exit code (negative signal number if killed).
+               Dictionary of the command's resource usage: 'maxrss'
+               (kB), 'utime' and 'stime' (CPU secs).
+   """
+   if logbase is None:
+      out = tempfile.TemporaryFile()
+      err = tempfile.TemporaryFile()
    else:
-      status = False
-      
-   return [ status, x[0].split( '\n' ), x[1].split( '\n' ) ]
+      out = open( logbase + ".out", 'w+' )
+      err = open( logbase + ".err", 'w+' )
+
+   # Reap the command with wait4 rather than Popen.wait so its resource
+   # usage comes back with it.
+
+   p = subprocess.Popen( cmd, shell=True, stderr=err, stdout=out )
+   ( pid, sts, ru ) = os.wait4( p.pid, 0 )
+   if os.WIFSIGNALED( sts ):
+      p.returncode = -os.WTERMSIG( sts )
+   else:
+      p.returncode = os.WEXITSTATUS( sts )
+   usage = { 'maxrss' : ru.ru_maxrss, 'utime' : ru.ru_utime,
+             'stime' : ru.ru_stime }
+
+   outbytes = os.fstat( out.fileno() ).st_size
+   errbytes = os.fstat( err.fileno() ).st_size
+   status = ( p.returncode == 0 )
+
+   if logbase is None:
+      out.seek( 0 )
+      err.seek( 0 )
+      outlines = out.read().split( '\n' )
+      errlines = err.read().split( '\n' )
+      out.close()
+      err.close()
+   else:
+      out.close()
+      err.close()
+      outlines = log_tail( logbase + ".out" )
+      errlines = log_tail( logbase + ".err" )
+
+   return [ status, outlines, errlines, outbytes, errbytes, p.returncode,
+            usage ]
+
+
+def log_tail( filenm, lines = 20 ):
+   """
+   Returns the last lines of a task log file, reading at most the last
+   8 kB of it.
+
+   Arguments:
+
+      filenm .. The log file name.
+      lines ... The maximum number of lines to return.
+   """
+   f = open( filenm, 'r' )
+   f.seek( 0, 2 )
+   f.seek( max( 0, f.tell() - 8192 ) )
+   tail = f.read().split( '\n' )
+   f.close()
+
+   return tail[-lines - 1:]
+
+
+def check_task( check, f, result ):
+   """
+   Runs the output check for a task that exited successfully, and folds
+   its outcome into the task's result.
+
+   Arguments:
+
+      check ... Check command, called with the task input file as its
+                only argument, or '' for none.
+      f ....... The task input file.
+      result .. What shell() returned for the task. Updated in place.
+
+   Returns:
+
+      The check's exit code, or None if it wasn't run.
+   """
+   if check == '' or not result[0]:
+      return None
+
+   c = shell( "%s %s" % ( check, f ) )
+   if not c[0]:
+      result[0] = False
+      result[2] = ( result[2] +
+                    [ "Check failed with exit code %d: %s %s"
+                      % ( c[5], check, f ) ] + c[1] + c[2] )
+
+   return c[5]
+
+
+def stage_task( cmd, f, stagedir, outputs, logbase ):
+   """
+   Runs a task on a copy of its input directory in node-local scratch,
+   so the files it reads and writes while it runs stay off the shared
+   filesystem.
+
+   Arguments:
+
+      cmd ....... The task command.
+      f ......... The task input file.
+      stagedir .. Node-local directory to stage the task in. Created if
+                  need be.
+      outputs ... Shell patterns (such as "*.t") naming the files to copy
+                  back, or an empty list to copy back every file the
+                  task created or changed.
+      logbase ... Passed on to shell().
+
+   The files directly in the input file's directory (not those in any
+   subdirectories) are copied to a new directory under stagedir, and the
+   command is run on the copy of f there. When it exits, successfully or
+   not, the outputs are copied back next to f and the staged copy is
+   removed. Failing to copy the outputs back fails the task.
+
+   Returns:
+
+      What shell() returned for the task.
+   """
+   srcdir = os.path.dirname( os.path.abspath( f ) )
+
+   if not os.path.isdir( stagedir ):
+      try:
+         os.makedirs( stagedir )
+      except OSError:
+         # Another worker got there first.
+         pass
+
+   workdir = tempfile.mkdtemp( prefix = "wq.", dir = stagedir )
+
+   try:
+      staged = {}
+      for name in os.listdir( srcdir ):
+         path = os.path.join( srcdir, name )
+         if os.path.isfile( path ):
+            shutil.copy2( path, workdir )
+            st = os.stat( os.path.join( workdir, name ) )
+            staged[name] = ( st.st_size, st.st_mtime )
+
+      result = shell( "%s %s" % ( cmd, os.path.join( workdir,
+                                                     os.path.basename( f ) ) ),
+                      logbase )
+
+      for name in sorted( os.listdir( workdir ) ):
+         path = os.path.join( workdir, name )
+         if not os.path.isfile( path ):
+            continue
+         if len( outputs ) > 0:
+            wanted = len( [ o for o in outputs
+                            if fnmatch.fnmatch( name, o ) ] ) > 0
+         else:
+            st = os.stat( path )
+            wanted = staged.get( name ) != ( st.st_size, st.st_mtime )
+         if wanted:
+            try:
+               shutil.copy2( path, srcdir )
+            except ( IOError, OSError ), err:
+               result[0] = False
+               result[2] = result[2] + [ "Failed to copy back %s: %s"
+                                         % ( name, err ) ]
+   finally:
+      shutil.rmtree( workdir, ignore_errors = True )
+
+   return result
 
 
 def ipaddrs( host ):
@@ -96,7 +267,657 @@ def ipaddrs( host ):
    return socket.gethostbyaddr(host)[2][0]
 
 
-def dispatcher( port, cmd, files, allworkers, start ):
+def endpoint( host, port ):
+   """
+   Builds the zmq address of the dispatcher socket.
+
+   Arguments:
+
+      host .. IP of the host running the dispatcher.
+      port .. The dispatcher port, or a complete zmq address (such as
+              "ipc:///tmp/wq/dispatcher" when running locally), which is
+              used as is.
+   """
+   if '://' in port:
+      return port
+
+   return "tcp://%s:%s" % ( host, port )
+
+
+def free_port():
+   """
+   Asks the OS for a TCP port nothing is listening on, for a shared
+   dispatcher to bind to.
+
+   Returns:
+
+      The port number, as a string like the default port.
+   """
+   s = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+   s.bind( ( '', 0 ) )
+   port = s.getsockname()[1]
+   s.close()
+
+   return "%d" % ( port )
+
+
+def write_endpoint( endpointnm, address ):
+   """
+   Writes the address of a shared dispatcher for workers to find it by.
+   The file is written under a temporary name and renamed into place,
+   so a worker never reads half of it.
+
+   Arguments:
+
+      endpointnm .. Name of the endpoint file.
+      address ..... Dictionary of the dispatcher 'host' IP and 'port'.
+   """
+   tmpnm = "%s.%d" % ( endpointnm, os.getpid() )
+   tmp = open( tmpnm, 'w' )
+   tmp.write( "%s\n" % ( json.dumps( address ) ) )
+   tmp.close()
+   os.rename( tmpnm, endpointnm )
+
+
+def read_endpoint( endpointnm, wait = 60 ):
+   """
+   Reads the address of a shared dispatcher from its endpoint file.
+
+   Arguments:
+
+      endpointnm .. Name of the endpoint file.
+      wait ........ Seconds to wait for the file to appear, in case the
+                    dispatcher is still starting up.
+
+   Returns:
+
+      Dictionary of the dispatcher 'host' IP and 'port', or None if the
+      file never appeared.
+   """
+   give_up = time.time() + wait
+
+   while not os.path.exists( endpointnm ):
+      if time.time() > give_up:
+         return None
+      time.sleep( 1 )
+
+   f = open( endpointnm, 'r' )
+   address = json.loads( f.read() )
+   f.close()
+
+   return address
+
+
+def read_inputs( inputnms, match ):
+   """
+   Reads the input files to run tasks on.
+
+   Arguments:
+
+      inputnms .. Names of files listing input files one per line, or of
+                  directories to search for input files.
+      match ..... Shell pattern input file names found in a directory
+                  must match (such as "*.bb").
+
+   Returns:
+
+      List of the input file names, in list order. Those found in a
+      directory are sorted by path.
+
+   Raises IOError if a list can't be read.
+   """
+   files = []
+
+   for inputnm in inputnms:
+      if os.path.isdir( inputnm ):
+         found = []
+         for ( dirpath, dirnames, filenames ) in os.walk( inputnm ):
+            for f in fnmatch.filter( filenames, match ):
+               found.append( os.path.abspath( os.path.join( dirpath, f ) ) )
+         files.extend( sorted( found ) )
+      else:
+         infile = open( inputnm, 'r' )
+         files.extend( infile.readlines() )
+         infile.close()
+
+   return files
+
+
+def read_ledger( ledgernm ):
+   """
+   Reads a task ledger written by a previous dispatcher run.
+
+   Arguments:
+
+      ledgernm .. Name of the ledger file. A missing file is treated as
+                  an empty ledger.
+
+   Returns:
+
+      Dictionary mapping each input file to the last status recorded
+      for it ("started", "done", "failed" or "skipped").
+
+   The ledger is an append-only, tab separated log with one line per
+   event:
+
+      time  tasknum  worker  status  file
+   """
+   last = {}
+   try:
+      ledger = open( ledgernm, 'r' )
+   except IOError:
+      return last
+
+   for line in ledger:
+      fields = line.rstrip( '\n' ).split( '\t', 4 )
+      # A partial last line is possible if the job was killed mid write.
+      if len( fields ) == 5:
+         last[fields[4]] = fields[3]
+   ledger.close()
+
+   return last
+
+
+def log_task( ledger, tasknum, worker, status, f ):
+   """
+   Appends one event to the task ledger and flushes it to disk so it
+   survives the job being killed.
+
+   Arguments:
+
+      ledger .... Open ledger file object.
+      tasknum ... The task sequence number (input file line number).
+      worker .... The worker identifier.
+      status .... "started", "done", "failed" or "skipped".
+      f ......... The task input file.
+   """
+   ledger.write( "%.2f\t%d\t%s\t%s\t%s\n"
+                 % ( time.time(), tasknum, worker, status, f ) )
+   ledger.flush()
+
+
+def task_status( mode, status ):
+   """
+   Maps a worker's report on its last task to a ledger status.
+   """
+   if mode == "Skipped":
+      return "skipped"
+   elif status:
+      return "done"
+   else:
+      return "failed"
+
+
+def task_record( worker, host, tasknum, f, mode, result, taskstart,
+                 taskend, logbase ):
+   """
+   Builds the results stream record for one task.
+
+   Arguments:
+
+      worker ..... The worker identifier.
+      host ....... Host name the worker runs on.
+      tasknum .... The task sequence number.
+      f .......... The task input file.
+      mode ....... "Ran", "Skipped", or "Lost" for a task whose worker
+                   died.
+      result ..... What shell() returned, or None if not run.
+      taskstart .. Task start time, or None if skipped.
+      taskend .... Task end time, or None if skipped.
+      logbase .... Task output log files less extension, or None.
+
+   Returns:
+
+      Dictionary of the record fields. The 'status' field is filled in
+      as for the ledger ("done", "failed", "skipped" or "lost").
+   """
+   record = { 'tasknum' : tasknum, 'file' : f, 'worker' : worker,
+              'host' : host, 'start' : taskstart, 'end' : taskend,
+              'elapsed' : None, 'exitcode' : None, 'maxrss' : None,
+              'utime' : None, 'stime' : None, 'stdoutbytes' : None,
+              'stderrbytes' : None, 'stdoutlog' : None,
+              'stderrlog' : None, 'checkcode' : None, 'cores' : None }
+
+   if mode == "Lost":
+      record['status'] = "lost"
+      return record
+   elif result is None:
+      record['status'] = task_status( mode, False )
+      return record
+
+   record['status'] = task_status( mode, result[0] )
+   record['elapsed'] = taskend - taskstart
+   record['stdoutbytes'] = result[3]
+   record['stderrbytes'] = result[4]
+   record['exitcode'] = result[5]
+   record['maxrss'] = result[6]['maxrss']
+   record['utime'] = result[6]['utime']
+   record['stime'] = result[6]['stime']
+   if logbase is not None:
+      record['stdoutlog'] = os.path.abspath( logbase + ".out" )
+      record['stderrlog'] = os.path.abspath( logbase + ".err" )
+
+   return record
+
+
+def log_record( results, record ):
+   """
+   Appends one record to the JSON lines results stream and flushes it
+   to disk.
+
+   Arguments:
+
+      results .. Open results file object.
+      record ... Dictionary from task_record.
+   """
+   results.write( json.dumps( record, sort_keys = True ) + '\n' )
+   results.flush()
+
+
+def read_records( resultsnm ):
+   """
+   Reads a JSON lines results stream.
+
+   Arguments:
+
+      resultsnm .. Name of the results file.
+
+   Returns:
+
+      List of record dictionaries, in the order written.
+   """
+   records = []
+   results = open( resultsnm, 'r' )
+   for line in results:
+      try:
+         records.append( json.loads( line ) )
+      except ValueError:
+         # A partial last line is possible if the job was killed mid write.
+         pass
+   results.close()
+
+   return records
+
+
+def query_results( resultsnm, binsecs, status ):
+   """
+   Summarizes a results stream on stdout.
+
+   Arguments:
+
+      resultsnm .. Name of the results file.
+      binsecs .... Width in seconds of the throughput bins.
+      status ..... If not '', just list the tasknum and file of each task
+                   whose latest record has this status instead.
+
+   A task's latest record decides its status, so tasks rerun by later
+   jobs are counted once.
+   """
+   records = read_records( resultsnm )
+
+   latest = {}
+   for r in records:
+      latest[r['tasknum']] = r
+
+   if status != '':
+      for num in sorted( latest.keys() ):
+         if latest[num]['status'] == status:
+            print( "%d\t%s" % ( num, latest[num]['file'] ) )
+      return
+
+   counts = {}
+   for r in latest.values():
+      counts[r['status']] = counts.get( r['status'], 0 ) + 1
+
+   print( "Results: %s" % ( resultsnm ) )
+   print( "Records: %d  Tasks: %d" % ( len( records ), len( latest ) ) )
+   for s in [ "done", "failed", "skipped", "lost" ]:
+      print( "  %-8s %d" % ( s, counts.get( s, 0 ) ) )
+
+   ran = [ r for r in records if r['exitcode'] is not None ]
+   if len( ran ) == 0:
+      return
+
+   cpu = sum( [ r['utime'] + r['stime'] for r in ran ] )
+   big = max( ran, key = lambda r: r['maxrss'] )
+   print( "Task CPU hours: %.2f" % ( cpu / 3600.0 ) )
+   print( "Largest max RSS: %.1f MB (task %d)"
+          % ( big['maxrss'] / 1024.0, big['tasknum'] ) )
+
+   # Bin the finish times of the successful runs.
+
+   first = min( [ r['start'] for r in ran ] )
+   bins = {}
+   for r in ran:
+      if r['status'] == "done":
+         b = int( ( r['end'] - first ) / binsecs )
+         bins[b] = bins.get( b, 0 ) + 1
+
+   print( "Throughput (tasks done per %d secs):" % ( binsecs ) )
+   total = 0
+   if len( bins ) > 0:
+      for b in range( max( bins.keys() ) + 1 ):
+         total += bins.get( b, 0 )
+         print( "  %s  %6d %8d"
+                % ( time.strftime( "%Y-%m-%d %H:%M:%S",
+                                   time.localtime( first + b * binsecs ) ),
+                    bins.get( b, 0 ), total ) )
+
+
+def host_usage( joined, left, busy, began, now ):
+   """
+   Adds up how busy the workers on each host have been.
+
+   Arguments:
+
+      joined .. Dictionary of worker -> time first heard from.
+      left .... Dictionary of worker -> time told to quit or found dead.
+      busy .... Dictionary of worker -> seconds spent on finished tasks.
+      began ... Dictionary of worker -> start time of the task it is
+                running.
+      now ..... The current time.
+
+   Returns:
+
+      Dictionary of host -> [ workers still working, tasks running,
+      busy seconds, seconds workers have been around ]. Hosts come from
+      the worker names (see worker).
+   """
+   usage = {}
+
+   for w in joined:
+      host = w.rsplit( '_', 2 )[0]
+      u = usage.setdefault( host, [ 0, 0, 0.0, 0.0 ] )
+      if w not in left:
+         u[0] += 1
+      if w in began:
+         u[1] += 1
+         u[2] += now - began[w]
+      u[2] += busy.get( w, 0 )
+      u[3] += left.get( w, now ) - joined[w]
+
+   return usage
+
+
+def write_status( statusnm, starttime, counts, durations, usage, jobend ):
+   """
+   Rewrites the status file with the progress of the run so far, for
+   a look at how a long job is doing while it runs.
+
+   Arguments:
+
+      statusnm .... Name of the status file.
+      starttime ... Time the dispatcher started.
+      counts ...... Dictionary of the number of 'tasks' in the run, and
+                    how many are 'done', 'failed', 'running' and 'queued'.
+      durations ... Elapsed times of the tasks done so far.
+      usage ....... Per host usage, from host_usage.
+      jobend ...... Latest time a worker's job runs out, or None.
+
+   Throughput counts tasks done or failed since the dispatcher started.
+   The projected completion time assumes it keeps up, and is compared
+   with the end of the workers' jobs. The file is written under a
+   temporary name and renamed into place, so it is never seen half
+   written.
+   """
+   now = time.time()
+   hours = max( now - starttime, 1.0 ) / 3600.0
+   finished = counts['done'] + counts['failed']
+   remaining = counts['running'] + counts['queued']
+   rate = finished / hours
+
+   lines = []
+   lines.append( "Updated: %s (running %.2f hours)"
+                 % ( time.strftime( "%Y-%m-%d %H:%M:%S",
+                                    time.localtime( now ) ), hours ) )
+   lines.append( "Tasks: %d  done: %d  failed: %d  running: %d  queued: %d"
+                 % ( counts['tasks'], counts['done'], counts['failed'],
+                     counts['running'], counts['queued'] ) )
+   lines.append( "Throughput: %.1f tasks/hour" % ( rate ) )
+
+   if len( durations ) > 0:
+      ordered = sorted( durations )
+      p95 = ordered[ int( math.ceil( 0.95 * len( ordered ) ) ) - 1 ]
+      lines.append( "Task time: mean %.1f secs, p95 %.1f secs"
+                    % ( sum( ordered ) / len( ordered ), p95 ) )
+
+   if remaining == 0:
+      lines.append( "Projected completion: now" )
+   elif rate > 0:
+      eta = now + remaining / rate * 3600.0
+      lines.append( "Projected completion: %s (in %.2f hours)"
+                    % ( time.strftime( "%Y-%m-%d %H:%M:%S",
+                                       time.localtime( eta ) ),
+                        ( eta - now ) / 3600.0 ) )
+      if jobend is not None:
+         if eta <= jobend:
+            verdict = "should finish"
+         else:
+            verdict = "about %d tasks short" \
+                      % ( remaining - rate * ( jobend - now ) / 3600.0 )
+         lines.append( "Workers' time runs out: %s (%s)"
+                       % ( time.strftime( "%Y-%m-%d %H:%M:%S",
+                                          time.localtime( jobend ) ),
+                           verdict ) )
+   else:
+      lines.append( "Projected completion: unknown (nothing finished yet)" )
+
+   lines.append( "%-24s %8s %8s %8s" % ( "Host", "Workers", "Running",
+                                         "Busy%" ) )
+   for host in sorted( usage ):
+      ( workers, running, busy, span ) = usage[host]
+      lines.append( "%-24s %8d %8d %8.1f"
+                    % ( host, workers, running,
+                        100.0 * busy / max( span, 1e-9 ) ) )
+
+   tmpnm = "%s.%d" % ( statusnm, os.getpid() )
+   tmp = open( tmpnm, 'w' )
+   tmp.write( "\n".join( lines ) + "\n" )
+   tmp.close()
+   os.rename( tmpnm, statusnm )
+
+
+def ledger_durations( ledgernm ):
+   """
+   Extracts task run times from a task ledger.
+
+   Arguments:
+
+      ledgernm .. Name of the ledger file.
+
+   Returns:
+
+      Dictionary mapping each input file to the elapsed time, in
+      seconds, of its most recent successful run.
+   """
+   started = {}
+   durations = {}
+   try:
+      ledger = open( ledgernm, 'r' )
+   except IOError:
+      return durations
+
+   for line in ledger:
+      fields = line.rstrip( '\n' ).split( '\t', 4 )
+      if len( fields ) < 5:
+         continue
+      if fields[3] == "started":
+         started[fields[4]] = float( fields[0] )
+      elif fields[3] == "done" and fields[4] in started:
+         durations[fields[4]] = float( fields[0] ) - started[fields[4]]
+   ledger.close()
+
+   return durations
+
+
+def bb_settings( bbfile ):
+   """
+   Reads the mcmc settings from a MrBayes bayes block.
+
+   Arguments:
+
+      bbfile .. Path to the bayes block (.bb) file given to the task.
+
+   Returns:
+
+      ( settings, nexfile ), where settings is a dictionary of ngen,
+      nruns and nchains, using the MrBayes defaults for any not found,
+      and nexfile is the nexus file named in the block's execute
+      command, or None. Returns None if the file can't be read.
+   """
+   settings = { 'ngen' : 1000000, 'nruns' : 2, 'nchains' : 4 }
+   nexfile = None
+   try:
+      bb = open( bbfile, 'r' )
+   except IOError:
+      return None
+
+   for line in bb:
+      m = re.match( r'\s*execute\s+([^;\s]+)', line, re.I )
+      if m:
+         nexfile = os.path.join( os.path.dirname( bbfile ), m.group( 1 ) )
+      if re.match( r'\s*mcmcp?\s', line, re.I ):
+         for key in settings:
+            m = re.search( r'\b%s\s*=\s*(\d+)' % ( key ), line, re.I )
+            if m:
+               settings[key] = int( m.group( 1 ) )
+   bb.close()
+
+   return ( settings, nexfile )
+
+
+def bb_cost( bbfile ):
+   """
+   Estimates the relative cost of a MrBayes task from its bayes block.
+
+   Arguments:
+
+      bbfile .. Path to the bayes block (.bb) file given to the task.
+
+   Returns:
+
+      ntax * nchar * ngen * nruns * nchains, using the MrBayes defaults
+      for any mcmc setting not found, or 0 if the file can't be read.
+      ntax and nchar come from the header of the nexus file named in
+      the block's execute command.
+   """
+   bb = bb_settings( bbfile )
+   if bb is None:
+      return 0
+   ( settings, nexfile ) = bb
+
+   dims = { 'ntax' : 1, 'nchar' : 1 }
+   if nexfile is not None:
+      try:
+         nex = open( nexfile, 'r' )
+         for line in nex:
+            for key in dims:
+               m = re.search( r'\b%s\s*=\s*(\d+)' % ( key ), line, re.I )
+               if m:
+                  dims[key] = int( m.group( 1 ) )
+            if 'matrix' in line.lower():
+               break
+         nex.close()
+      except IOError:
+         pass
+
+   return ( dims['ntax'] * dims['nchar'] * settings['ngen'] *
+            settings['nruns'] * settings['nchains'] )
+
+
+def bb_cores( bbfile ):
+   """
+   Returns the number of cores a MrBayes task can use, nruns * nchains
+   from its bayes block, or 1 if the file can't be read.
+   """
+   bb = bb_settings( bbfile )
+   if bb is None:
+      return 1
+
+   return bb[0]['nruns'] * bb[0]['nchains']
+
+
+def build_model( tasks, ledgernm ):
+   """
+   Sets up the per-task runtime model used to order tasks and to decide
+   which tasks fit in a worker's remaining time.
+
+   Arguments:
+
+      tasks ...... List of ( tasknum, file ) pairs.
+      ledgernm ... Name of the task ledger holding prior run times.
+
+   Returns:
+
+      The model, a dictionary of:
+         model['costs'] ...... tasknum -> bb_cost, filled in as needed.
+         model['durations'] .. file -> seconds of its last successful run.
+         model['rates'] ...... sorted seconds per unit bb_cost seen so far.
+         model['cores'] ...... tasknum -> bb_cores, filled in as needed.
+   """
+   model = { 'costs' : {}, 'durations' : ledger_durations( ledgernm ),
+             'rates' : [], 'cores' : {} }
+
+   for ( num, f ) in tasks:
+      if f in model['durations']:
+         cost = task_cost( model, num, f )
+         if cost > 0:
+            model['rates'].append( model['durations'][f] / cost )
+   model['rates'].sort()
+
+   return model
+
+
+def task_cost( model, num, f ):
+   """
+   Returns the bb_cost of a task, reading its input only the first time.
+   """
+   if num not in model['costs']:
+      model['costs'][num] = bb_cost( f )
+
+   return model['costs'][num]
+
+
+def task_cores( model, num, f ):
+   """
+   Returns the bb_cores of a task, reading its input only the first time.
+   """
+   if num not in model['cores']:
+      model['cores'][num] = bb_cores( f )
+
+   return model['cores'][num]
+
+
+def observe_time( model, num, f, seconds ):
+   """
+   Adds a completed task's run time to the runtime model.
+   """
+   model['durations'][f] = seconds
+   cost = task_cost( model, num, f )
+   if cost > 0:
+      bisect.insort( model['rates'], seconds / cost )
+
+
+def predict_time( model, num, f ):
+   """
+   Predicts the run time of a task in seconds.
+
+   A task that ran before gets its last run time. Others get their
+   bb_cost scaled by the median seconds per unit cost seen so far.
+   Returns None if neither is available.
+   """
+   if f in model['durations']:
+      return model['durations'][f]
+
+   cost = task_cost( model, num, f )
+   if cost > 0 and len( model['rates'] ) > 0:
+      return cost * model['rates'][len( model['rates'] ) / 2]
+
+   return None
+
+
+def dispatcher( port, cmd, tasks, allworkers, ledgernm, resultsnm, statusnm,
+                model, heartbeat, check, retries, backoff ):
    """
    The dispatcher task, which is run as a separate thread, handles
    distribution of tasks to workers. Workers must request a task
@@ -106,35 +927,98 @@ def dispatcher( port, cmd, files, allworkers, start ):
 
       port ......... The socket on which to listen for work requests.
       cmd .......... Command for workers to execute.
-      files ........ List of input files to distribute.
-      allworkers ... Total number of workers (workers per node * nodes).
-      start ........ The task number to start with - allows skipping
-                     over completed tasks.
+      tasks ........ List of ( tasknum, file ) pairs to distribute.
+      allworkers ... Total number of workers (workers per node * nodes),
+                     or 0 when they aren't known in advance, as for a
+                     shared dispatcher workers may come and go from.
+      ledgernm ..... Name of the task ledger file to append to.
+      resultsnm .... Name of the JSON lines results file to append to.
+      statusnm ..... Name of the status file to keep rewriting.
+      model ........ Runtime model from build_model.
+      heartbeat .... Seconds between worker heartbeats.
+      check ........ Command workers run to check a task's output, or ''.
+      retries ...... Times a failed task is handed out again.
+      backoff ...... Seconds to hold a failed task before its first retry,
+                     doubled for each further retry.
 
    The "dispatcher" reads a list of lines from an input file and
    constructs task messages for the workers. Workers must first issue
    a request to the dispatcher, which then replies with one task
-   message.  When all work is handed out, or the first report of
-   insufficient time is received, the dispatcher starts sending
-   termination messages instead until all workers have been notified
-   to cease. 
+   message. The task sent is the first one still queued whose
+   predicted run time (see predict_time), with a safety margin, fits
+   in the time the worker has left. Tasks with no prediction yet are
+   compared against the longest task time seen so far instead. A
+   worker is sent a termination message once nothing queued fits, or
+   when it reports it had to skip a task, in which case that task is
+   put back on the queue for others. When all work is handed out but
+   some is still running, workers are told to wait and ask again, in
+   case a running task has to be handed out again. Once nothing is
+   left to run, the dispatcher sends termination messages until all
+   workers have been notified to cease.
+
+   Workers send heartbeat messages while running a task. A worker not
+   heard from for 5 heartbeats is presumed dead, and its task is put
+   back at the head of the queue and logged as "lost". Once all work
+   is done, the dispatcher also stops waiting for workers that never
+   made contact after that long. That is also how a dispatcher not told
+   how many workers to expect finishes: it keeps handing out work to
+   whoever asks until all of it is done, then stops once every worker
+   it has heard from has been told to quit or is dead.
+
+   Workers may share a node's cores (see worker). They then report how
+   many are free, and are only sent a task whose core count (bb_cores,
+   capped at the node's cores) fits. When tasks fit in time but not in
+   the free cores, the worker is told to wait for some to free up.
+
+   A task fails if it exits with a nonzero code, or if the check
+   command given it exits with one. A failed task with retries left is
+   put back on the queue once its backoff time is up. Until then,
+   workers out of work are told to wait rather than quit.
+
+   Every task handed out, and the outcome reported for it by the
+   worker on its next request, is appended to the task ledger. The
+   worker's record of each task it handled (see task_record) is also
+   appended to the results file, as are lost tasks.
+
+   Every heartbeat, and once more at the end, the status file is
+   rewritten with the progress so far (see write_status): task counts,
+   throughput, task times, how busy each host's workers are, and when
+   the work should be done compared with when the workers' jobs end.
 
    The request message is a dictionary of:
+       msg['type'] ..... "request", or "heartbeat" while running a task
+                         (only 'worker' and 'tasknum' are also sent).
        msg['worker'] ... name of worker making request.
        msg['maxtime'] .. the maximum execution time it has seen.
                          It is -1 if job time has run out.
+       msg['timeleft'] . seconds of job time the worker has left.
        msg['lasttask'] . the most recent task the worker handled.
+       msg['lastmode'] . "Ran" or "Skipped" for lasttask, or "None".
+       msg['laststatus'] the execution status of lasttask.
+       msg['lasttime'] . the elapsed time of lasttask.
+       msg['lastrecord'] the task_record of lasttask, or None.
+       msg['cores'] .... cores free on the worker's node, or -1 if the
+                         worker doesn't share cores.
+       msg['nodecores']  cores on the worker's node, or -1.
 
    The response message is a dictionary of:
-       msg['cmd'] ...... The command to execute, or "FINI" to quit.
+       msg['cmd'] ...... The command to execute, "FINI" to quit, "WAIT"
+                         to ask again later, or "ACK" for a heartbeat.
        msg['file'] ..... The next line read from the input file.
        msg['maxtime'] .. The longest task time seen so far.
+       msg['predicted']  The time the task is expected to take.
        msg['tasknum'] .. The sequence number of the assigned task.
+       msg['check'] .... The check command, or ''.
+       msg['cores'] .... Cores given to the task, or 0 if the worker
+                         doesn't share cores.
 
    """
    # Only the host running as dispatcher should be calling this.
 
-   host = ipaddrs( socket.gethostname() )
+   if '://' in port:
+      host = None
+   else:
+      host = ipaddrs( socket.gethostname() )
 
    # Initialize a 0mq context
 
@@ -151,99 +1035,342 @@ def dispatcher( port, cmd, files, allworkers, start ):
 
    dispatcher_socket = context.socket( zmq.REP )
    dispatcher_socket.setsockopt( zmq.LINGER, 5000 )
-   dispatcher_socket.bind( "tcp://%s:%s" % ( host, port ) )
+   dispatcher_socket.bind( endpoint( host, port ) )
+
+   # For safety, require the remaining time to be at least 1.25 times
+   # the predicted time, as the workers do.
+
+   margin = 1.25
 
    maxtime = 0
    tasknum = 0
    workers = {}
-   already_notified = 0
+   running = {}
+   notified = {}
+   dead = {}
+   lastbeat = {}
+   pending = list( tasks )
+   delayed = []
+   failures = {}
+   deadtime = 5 * heartbeat
+   idlestart = None
+   joined = {}
+   left = {}
+   busy = {}
+   began = {}
+   jobend = {}
+   durations = []
+   ndone = 0
+   nfailed = 0
+   starttime = time.time()
+   laststatus = 0
 
-   sys.stderr.write ( "Dispatcher:Start:%d\n" % ( start ) )
-   sys.stderr.flush()
+   ledger = open( ledgernm, 'a' )
+   results = open( resultsnm, 'a' )
 
-   # Adjust starting task for 0 offset:
+   sys.stderr.write ( "Dispatcher:Start:%d\n" % ( tasks[0][0] ) )
+   sys.stderr.flush()
 
-   start = start - 1
-   tasknum = start
    lasttask = 0
 
-   for f in files[start:]:
+   dispatcher_poller = zmq.Poller()
+   dispatcher_poller.register( dispatcher_socket, zmq.POLLIN )
+
+   while allworkers < 1 or len( notified ) + len( dead ) < allworkers :
+
+      now = time.time()
+
+      if now - laststatus >= heartbeat :
+         ends = [ jobend[w] for w in jobend if w not in left ]
+         if len( ends ) == 0 :
+            ends = [ None ]
+         write_status( statusnm, starttime,
+                       { 'tasks' : len( tasks ), 'done' : ndone,
+                         'failed' : nfailed, 'running' : len( running ),
+                         'queued' : len( pending ) + len( delayed ) },
+                       durations, host_usage( joined, left, busy, began,
+                                              now ),
+                       max( ends ) )
+         laststatus = now
+
+      # Put the tasks of workers that have gone silent back on the queue.
+
+      for worker in running.keys():
+         if now - lastbeat[worker] > deadtime :
+            ( num, f ) = running.pop( worker )
+            log_task( ledger, num, worker, "lost", f )
+            record = task_record( worker, None, num, f, "Lost", None,
+                                  None, None, None )
+            record['end'] = now
+            log_record( results, record )
+            pending.insert( 0, ( num, f ) )
+            dead[worker] = 1
+            left[worker] = now
+            began.pop( worker, None )
+            sys.stderr.write( "Dispatcher:Lost:%s:%d:%.2f\n"
+                              % ( worker, num, now ) )
+            sys.stderr.flush()
+
+      # Put failed tasks whose backoff is up back on the queue.
+
+      for ( ready, num, f ) in list( delayed ):
+         if now >= ready :
+            delayed.remove( ( ready, num, f ) )
+            pending.insert( 0, ( num, f ) )
+
+      # With all work done, don't wait forever on workers that never
+      # made contact.
+
+      if ( len( pending ) == 0 and len( running ) == 0
+           and len( delayed ) == 0 ) :
+         if idlestart is None :
+            idlestart = now
+         elif now - idlestart > deadtime :
+            if len( [ w for w in workers
+                      if w not in notified and w not in dead ] ) == 0 :
+               break
+      else:
+         idlestart = None
+
+      if not dispatcher_poller.poll( 1000 ) :
+         continue
 
       request = dispatcher_socket.recv_json()
       worker = request['worker']
       workers[worker] = 1
+      lastbeat[worker] = time.time()
+      joined.setdefault( worker, lastbeat[worker] )
+
+      if worker in dead :
+         # Only slow, not dead after all.
+         del dead[worker]
+         left.pop( worker, None )
+
+      if request['type'] == "heartbeat" :
+         dispatcher_socket.send_json( { 'cmd' : "ACK" } )
+         continue
+
+      last = record_result( ledger, results, running, request )
+      jobend[worker] = lastbeat[worker] + request['timeleft']
+
+      if last is not None :
+         busy[worker] = busy.get( worker, 0 ) + request['lasttime']
+         began.pop( worker, None )
+         if last[2] == "done" :
+            observe_time( model, last[0], last[1], request['lasttime'] )
+            durations.append( request['lasttime'] )
+            ndone += 1
+         elif last[2] == "skipped" :
+            pending.insert( 0, ( last[0], last[1] ) )
+         elif last[2] == "failed" and failures.get( last[0], 0 ) < retries :
+            failures[last[0]] = failures.get( last[0], 0 ) + 1
+            wait = backoff * 2 ** ( failures[last[0]] - 1 )
+            delayed.append( ( time.time() + wait, last[0], last[1] ) )
+            sys.stderr.write( "Dispatcher:Retry:%d:%d:%.2f\n"
+                              % ( last[0], failures[last[0]], wait ) )
+            sys.stderr.flush()
+         elif last[2] == "failed" :
+            nfailed += 1
 
-      # Interpret a negative maxtime value as the time up signal.
+      if request['maxtime'] > maxtime :
 
-      if request['maxtime'] >= 0 :
+         maxtime = request['maxtime']
+         sys.stderr.write( "Dispatcher:Maxtime:%s:%.2f:%.2f\n"
+                           % ( worker, maxtime, time.time() ) )
+         sys.stderr.flush()
 
-         if request['maxtime'] > maxtime :
+      # Interpret a negative maxtime value as the time up signal.
+      # Otherwise look for the first queued task that fits.
 
-            maxtime = request['maxtime']
-            sys.stderr.write( "Dispatcher:Maxtime:%s:%.2f:%.2f\n"
-                              % ( worker, maxtime, time.time() ) )
-            sys.stderr.flush()
+      pick = None
+      waitcores = False
 
-         tasknum = tasknum + 1
-         task_message = { 'cmd' : cmd, 'file' : f.strip(),
-                          'maxtime' : maxtime, 'tasknum' : tasknum }
+      if request['maxtime'] >= 0 :
+
+         for i in range( len( pending ) ):
+            ( num, f ) = pending[i]
+            predicted = predict_time( model, num, f )
+            if predicted is None :
+               predicted = maxtime
+            if request['timeleft'] > predicted * margin :
+               if request['cores'] < 0 :
+                  cores = 0
+               else:
+                  cores = min( task_cores( model, num, f ),
+                               request['nodecores'] )
+               if request['cores'] < 0 or cores <= request['cores'] :
+                  pick = i
+                  break
+               waitcores = True
+
+      if pick is not None :
+
+         ( tasknum, f ) = pending.pop( pick )
+         task_message = { 'cmd' : cmd, 'file' : f, 'maxtime' : maxtime,
+                          'predicted' : predicted, 'tasknum' : tasknum,
+                          'check' : check, 'cores' : cores }
+         running[worker] = ( tasknum, f )
+         began[worker] = time.time()
+         log_task( ledger, tasknum, worker, "started", f )
+
+      elif ( request['maxtime'] >= 0 and
+             ( waitcores or ( len( pending ) == 0
+                              and len( running ) + len( delayed ) > 0 ) ) ) :
+
+         task_message = { 'cmd' : "WAIT", 'file' : "None",
+                          'maxtime' : maxtime, 'predicted' : -1,
+                          'tasknum' : tasknum }
 
       else:
 
-         maxtime = -1
-         sys.stderr.write( "Dispatcher:Timeup:%s:%.2f\n"
-                           % ( worker, time.time() ) )
-         sys.stderr.flush()
+         if len( pending ) > 0 :
+            sys.stderr.write( "Dispatcher:Timeup:%s:%.2f\n"
+                              % ( worker, time.time() ) )
+            sys.stderr.flush()
+            if lasttask == 0 or request['lasttask'] < lasttask :
+               lasttask = request['lasttask']
+
          task_message = { 'cmd' : "FINI", 'file' : "None",
-                          'maxtime' : -1, 'tasknum' : tasknum }
-         already_notified += 1
-         lasttask = request['lasttask']
+                          'maxtime' : -1, 'predicted' : -1,
+                          'tasknum' : tasknum }
+         notified[worker] = 1
+         left[worker] = time.time()
 
       dispatcher_socket.send_json( task_message )
-      if maxtime < 0 :
-         break
-
-   # Now make sure all workers have received the shutdown message.
-
-   shutdown = allworkers - already_notified
 
    if lasttask == 0 :
-      # All tasks handed out before any completions received.
-      # Have to assume all will complete.
+      # No worker ran out of time. Have to assume all completed.
       lasttask = tasknum
 
-   if shutdown > 0 :
-      task_message = { 'cmd' : "FINI", 'file' : "None",
-                       'maxtime' : -1, 'tasknum' : tasknum }
-      sys.stderr.write( "Dispatcher:Shutdown:%d\n" % ( shutdown ) )
+   if len( dead ) > 0 :
+      sys.stderr.write( "Dispatcher:Dead:%d\n" % ( len( dead ) ) )
       sys.stderr.flush()
 
-      # There is always a chance multiple assignments went out before
-      # a timeout was received. All should sense time out as well,
-      # so check for that when handling their final requests.
+   ledger.close()
+   results.close()
 
-      for w in range( shutdown ):
+   now = time.time()
+   write_status( statusnm, starttime,
+                 { 'tasks' : len( tasks ), 'done' : ndone,
+                   'failed' : nfailed, 'running' : len( running ),
+                   'queued' : len( pending ) + len( delayed ) },
+                 durations, host_usage( joined, left, busy, began, now ),
+                 None )
 
-         request = dispatcher_socket.recv_json()
+   sys.stderr.write( "Dispatcher:Last:%d\n" % ( lasttask ) )
+   sys.stderr.flush()
 
-         if request['maxtime'] < 0 :
-            if request['lasttask'] < lasttask :
-               lasttask = request['lasttask']
 
-         dispatcher_socket.send_json( task_message )
+def record_result( ledger, results, running, request ):
+   """
+   Records the outcome of the task a worker was last given, as reported
+   in its request, in the ledger and the results stream.
+
+   Arguments:
+
+      ledger .... Open ledger file object.
+      results ... Open results file object.
+      running ... Dictionary of worker -> ( tasknum, file ) in flight.
+      request ... The worker's request message.
+
+   Returns:
+
+      ( tasknum, file, status ) of the task reported on, or None.
+   """
+   worker = request['worker']
+
+   if worker in running and request['lasttask'] == running[worker][0] :
+      ( tasknum, f ) = running.pop( worker )
+      status = task_status( request['lastmode'], request['laststatus'] )
+      log_task( ledger, tasknum, worker, status, f )
+      if request['lastrecord'] is not None:
+         log_record( results, request['lastrecord'] )
+      return ( tasknum, f, status )
+
+   return None
 
-   sys.stderr.write( "Dispatcher:Last:%d\n" % ( lasttask ) )
-   sys.stderr.flush()
+
+def send_heartbeats( context, host, port, workerID, tasknum, heartbeat,
+                     finished ):
+   """
+   Sends heartbeat messages to the dispatcher while a task runs. This
+   is run as a thread by the worker, and uses its own zmq.REQ socket
+   since sockets can't be shared between threads. A heartbeat that
+   isn't answered within a heartbeat leaves the REQ socket unable to
+   send again, so it is closed and a new one connected, and the beats
+   carry on until the task is done.
+
+   Arguments:
+
+      context .... The worker's zmq context.
+      host ....... IP of host running the dispatcher.
+      port ....... The dispatcher port.
+      workerID ... The worker identifier.
+      tasknum .... The task being run.
+      heartbeat .. Seconds between heartbeats.
+      finished ... threading.Event set when the task is done.
+   """
+   beat_socket = context.socket( zmq.REQ )
+   beat_socket.setsockopt( zmq.LINGER, 0 )
+   beat_socket.connect( endpoint( host, port ) )
+
+   while not finished.wait( heartbeat ):
+      beat_socket.send_json( { 'type' : "heartbeat", 'worker' : workerID,
+                               'tasknum' : tasknum } )
+      if not beat_socket.poll( heartbeat * 1000 ):
+         # No answer. The REQ socket can't send again without one, so
+         # start over with a new one.
+         beat_socket.close()
+         beat_socket = context.socket( zmq.REQ )
+         beat_socket.setsockopt( zmq.LINGER, 0 )
+         beat_socket.connect( endpoint( host, port ) )
+         continue
+      beat_socket.recv_json()
+
+   beat_socket.close()
+
+
+def core_pool( cores ):
+   """
+   Sets up the pool of cores shared by the workers on a node.
+
+   Arguments:
+
+      cores .. Number of cores on the node to share out.
+
+   Returns:
+
+      The pool, a dictionary of:
+         pool['cores'] .. the cores on the node.
+         pool['free'] ... shared count of cores not given to a task.
+         pool['lock'] ... condition guarding 'free', notified when cores
+                          are returned.
+   """
+   return { 'cores' : cores, 'free' : Value( 'i', cores, lock = False ),
+            'lock' : Condition() }
 
 
-def worker( wrk_num, host, port, jobtime ):
+def worker( wrk_num, host, port, jobtime, heartbeat, logdir, pool, stagedir,
+            outputs ):
    """
    Defines the worker task. The arguments include:
 
-      wrk_num .. Identifier for the worker on a node.
-      host ..... IP of host running the dispatcher.
-      port ..... The dispatcher port.
-      jobtime .. How many seconds available for all work.
+      wrk_num .... Number of the worker among those started together.
+                   The worker's ID also names its host and the process
+                   that started it, so workers from different jobs on
+                   a node can't be confused.
+      host ....... IP of host running the dispatcher.
+      port ....... The dispatcher port.
+      jobtime .... How many seconds available for all work.
+      heartbeat .. Seconds between heartbeats sent while a task runs.
+      logdir ..... Directory to stream task output to, or '' to hold
+                   it in memory.
+      pool ....... Cores shared by the workers on the node (see
+                   core_pool), or None.
+      stagedir ... Node-local directory to run tasks in (see stage_task),
+                   or '' to run them where their input file is.
+      outputs .... Patterns of the files to copy back from stagedir, or
+                   an empty list for all new or changed files.
 
    The "worker" sends a task request message via a zmq.REQ socket to
    the dispatcher, and waits for a reply. Each reply is a dictionary
@@ -255,6 +1382,21 @@ def worker( wrk_num, host, port, jobtime ):
    results are returned in a second dictionary.  Obviously, the keys
    must agree on both ends. See dispatcher above for a description
    of the request and reply messages.
+
+   While a task runs, a thread sends heartbeats to the dispatcher. If
+   the dispatcher doesn't answer a request within 5 heartbeats, the
+   worker gives up and quits.
+
+   If logdir is set, each task's stdout and stderr are written to
+   logdir/task<tasknum>.out and .err, and only their last lines are
+   printed with the results.
+
+   With a core pool, the worker waits for a free core before asking for
+   work, and reports how many are free. The cores the dispatcher gives
+   the task are taken from the pool until it finishes, and passed to it
+   in the WQ_CORES environment variable. The pool is locked from
+   request to reply so workers on a node can't both claim the same
+   cores.
    """
    # For safety, require the remaining time to be at least 1.25 times
    # the maximum time seen so far to account for some jitter in the
@@ -278,7 +1420,7 @@ def worker( wrk_num, host, port, jobtime ):
    # is the requestor side of the REQ/REP pattern.
 
    task_socket = context.socket( zmq.REQ )
-   task_socket.connect( "tcp://%s:%s" % ( host, port ) )
+   task_socket.connect( endpoint( host, port ) )
    task_poller = zmq.Poller()
    task_poller.register( task_socket, zmq.POLLIN )
 
@@ -286,62 +1428,171 @@ def worker( wrk_num, host, port, jobtime ):
    # variables just in case they are used before otherwise set.
 
    maxtime = 0
-   timeout = 100
+   timeout = 5 * heartbeat * 1000
    running = True
-   workerID = "%s_%d" % ( local, wrk_num )
+   workerID = "%s_%d_%d" % ( local, os.getppid(), wrk_num )
    tasknum = 0
    walltime = 0
    timeup = False
+   lastmode = "None"
+   laststatus = False
+   lasttime = 0.0
+   lastrecord = None
+
+   if logdir != '' and not os.path.isdir( logdir ):
+      try:
+         os.makedirs( logdir )
+      except OSError:
+         # Another worker got there first.
+         pass
 
    while running:
 
+      # Wait for a free core, if sharing them, and hold the pool until
+      # the dispatcher replies.
+
+      if pool is not None :
+         pool['lock'].acquire()
+         while pool['free'].value == 0 :
+            pool['lock'].wait()
+         freecores = pool['free'].value
+         nodecores = pool['cores']
+      else:
+         freecores = -1
+         nodecores = -1
+
       # Send a task request to the displatcher, or report time is up by
       # setting maxtime to a negative value.
 
+      timeleft = jobtime - ( time.time() - starttime )
+
       if timeup :
-         task_socket.send_json( { 'maxtime' : -1.0, 'worker' : workerID,
-                                  'lasttask' : tasknum } )
+         task_socket.send_json( { 'type' : "request",
+                                  'maxtime' : -1.0, 'worker' : workerID,
+                                  'timeleft' : timeleft,
+                                  'lasttask' : tasknum,
+                                  'lastmode' : lastmode,
+                                  'laststatus' : laststatus,
+                                  'lasttime' : lasttime,
+                                  'lastrecord' : lastrecord,
+                                  'cores' : freecores,
+                                  'nodecores' : nodecores } )
       else:
-         task_socket.send_json( { 'maxtime' : maxtime, 'worker' : workerID,
-                                  'lasttask' : tasknum } )
+         task_socket.send_json( { 'type' : "request",
+                                  'maxtime' : maxtime, 'worker' : workerID,
+                                  'timeleft' : timeleft,
+                                  'lasttask' : tasknum,
+                                  'lastmode' : lastmode,
+                                  'laststatus' : laststatus,
+                                  'lasttime' : lasttime,
+                                  'lastrecord' : lastrecord,
+                                  'cores' : freecores,
+                                  'nodecores' : nodecores } )
 
       socks = dict( task_poller.poll( timeout ) )
 
       if socks.get( task_socket ) == zmq.POLLIN:
+         task_message = task_socket.recv_json()
+      else:
+         task_message = None
+
+      if pool is not None :
+         if task_message is not None and task_message['cmd'] not in (
+            "FINI", "WAIT" ) :
+            pool['free'].value -= task_message['cores']
+         pool['lock'].release()
+
+      if task_message is None:
+
+         # The REQ socket can't send again without a reply, and the
+         # dispatcher has presumably gone away, so quit.
+
+         sys.stderr.write( "%s:%s:%.2f\n"
+                           % ( workerID, "NoReply", time.time() - starttime ) )
+         sys.stderr.flush()
+         running = False
+
+      else:
 
          # Looks like we received a task. Process it.
 
-         task_message = task_socket.recv_json()
+         if task_message['cmd'] == "FINI" :
+
+            running = False
+
+         elif task_message['cmd'] == "WAIT" :
 
-         if task_message['cmd'] != "FINI" :
+            # Everything is handed out, but a running task may yet have
+            # to be redone, or nothing fits the free cores. Ask again
+            # later, or sooner if cores free up.
+
+            if pool is not None :
+               pool['lock'].acquire()
+               pool['lock'].wait( heartbeat )
+               pool['lock'].release()
+            else:
+               time.sleep( heartbeat )
+
+         else:
 
             # Construct the command line.
 
             task = "%s %s" % ( task_message['cmd'], task_message['file'] )
 
-            # Deal with job time calculation.
+            # Deal with job time calculation. The dispatcher sends the
+            # time it predicts this particular task will take.
 
             if task_message['maxtime'] > maxtime:
                maxtime = task_message['maxtime']
 
+            predicted = task_message['predicted']
             tasknum = task_message['tasknum']
             walltime = time.time() - starttime
             timeleft = jobtime - walltime
 
             # Apply the margin of error and decide to execute or skip.
 
-            if timeleft > ( maxtime * margin ):
+            if timeleft > ( predicted * margin ):
 
                sys.stderr.write( "%s:%s:%d:%.2f:%.2f\n"
                                  % ( workerID, "Taking", tasknum,
                                      walltime, timeleft ) )
                sys.stderr.flush()
 
-               # Record how long the task takes.
+               # Record how long the task takes, sending heartbeats
+               # while it runs.
+
+               finished = threading.Event()
+               beats = threading.Thread( target = send_heartbeats,
+                                         args = ( context, host, port,
+                                                  workerID, tasknum,
+                                                  heartbeat, finished ) )
+               beats.start()
+               if logdir != '':
+                  logbase = os.path.join( logdir, "task%d" % ( tasknum ) )
+               else:
+                  logbase = None
+
+               if task_message['cores'] > 0 :
+                  os.environ['WQ_CORES'] = "%d" % ( task_message['cores'] )
 
                taskstart = time.time()
-               result = shell( task )
+               if stagedir != '' :
+                  result = stage_task( task_message['cmd'],
+                                       task_message['file'], stagedir,
+                                       outputs, logbase )
+               else:
+                  result = shell( task, logbase )
                taskend = time.time()
+               checkcode = check_task( task_message['check'],
+                                       task_message['file'], result )
+               record = task_record( workerID, local, tasknum,
+                                     task_message['file'], "Ran", result,
+                                     taskstart, taskend, logbase )
+               record['checkcode'] = checkcode
+               record['cores'] = task_message['cores']
+               finished.set()
+               beats.join()
                elapsed = taskend - taskstart
                walltime = taskend - starttime
 
@@ -359,7 +1610,10 @@ def worker( wrk_num, host, port, jobtime ):
                   'walltime' : walltime,
                   'status' : result[0],
                   'stdout' : result[1],
-                  'stderr' : result[2] }
+                  'stderr' : result[2],
+                  'stdoutbytes' : result[3],
+                  'stderrbytes' : result[4],
+                  'logbase' : logbase }
 
             else:
 
@@ -381,14 +1635,26 @@ def worker( wrk_num, host, port, jobtime ):
                   'walltime' : walltime,
                   'status' : False,
                   'stdout' : [ 'Insufficient Time', '' ],
-                  'stderr' : [ 'Time left: %.2f; Max Time: %.2f; Margin: %.2f' %
-                               ( timeleft, maxtime, margin ), '' ] }
+                  'stderr' : [ 'Time left: %.2f; Predicted: %.2f; Margin: %.2f' %
+                               ( timeleft, predicted, margin ), '' ],
+                  'stdoutbytes' : 0,
+                  'stderrbytes' : 0,
+                  'logbase' : None }
+               record = task_record( workerID, local, tasknum,
+                                     task_message['file'], "Skipped", None,
+                                     None, None, None )
+
+            if pool is not None :
+               pool['lock'].acquire()
+               pool['free'].value += task_message['cores']
+               pool['lock'].notify_all()
+               pool['lock'].release()
 
             print_results( results )
-
-         else:
-
-            running = False
+            lastmode = results['mode']
+            laststatus = results['status']
+            lasttime = results['tasktime']
+            lastrecord = record
 
 
 def print_results( results ):
@@ -404,8 +1670,11 @@ def print_results( results ):
       'tasktime' : elapsed time for task, or -1.0.
       'walltime' : the current job walltime.
       'status' : task execution status.
-      'stdout' : task standard output.
-      'stderr' : task standard error.
+      'stdout' : task standard output (last lines only if logging).
+      'stderr' : task standard error (last lines only if logging).
+      'stdoutbytes' : size of the task standard output.
+      'stderrbytes' : size of the task standard error.
+      'logbase' : task output log files less extension, or None.
    """
 
    print( "Task:%d:%s:%s:%s:%s\n"
@@ -421,14 +1690,22 @@ def print_results( results ):
               results['taskend'],
               results['tasktime'],
               results['walltime'] )
+          + "Bytes:%d:%d:%d\n"
+          % ( results['tasknum'],
+              results['stdoutbytes'],
+              results['stderrbytes'] )
           + "Stdout:%d:" % (results['tasknum']) )
    for l in results['stdout']:
       if len( l.strip() ) > 0:
          print( "  %s" % ( l.strip() ) )
+   if results['logbase'] is not None:
+      print( "  (last lines of %s.out)" % ( results['logbase'] ) )
    print( "Stderr:%d:" % (results['tasknum']) )
    for l in results['stderr']:
       if len( l.strip() ) > 0:
          print( "  %s" % ( l.strip() ) )
+   if results['logbase'] is not None:
+      print( "  (last lines of %s.err)" % ( results['logbase'] ) )
    print( '' )
    sys.stdout.flush()
 
@@ -438,8 +1715,19 @@ def Usage():
    print( """
 Usage:  python wq.py -h[--help]
         python [-s[--start] task_num ] -d[--dispatcher] cmd \
-               -a[--allworkers] n -i[--input] filenm
+               -a[--allworkers] n -i[--input] filenm [-i filenm ...]
+               [-l[--ledger] ledgernm] [-e[--endpoint] endpointnm]
+               [--match pattern]
+               [-o[--order] file|longest] [-b[--heartbeat] secs]
+               [-r[--results] resultsnm] [-c[--check] check]
+               [-y[--retries] n] [--backoff secs] [--status statusnm]
         python -w[--workers] n -m[--mothersuperior] ms [-t[--time] walltime] 
+               [-b[--heartbeat] secs] [-g[--logdir] dir]
+               [-n[--cores] n] [-e[--endpoint] endpointnm]
+               [--stage dir [--outputs patterns]]
+        python -L[--local] n -d[--dispatcher] cmd -i[--input] filenm
+               [dispatcher and worker options]
+        python -q[--query] resultsnm [--bin secs] [--list status]
    Help display:
       -h,--help ........ Display this help message.
    Run as dispatcher:
@@ -450,15 +1738,111 @@ Usage:  python wq.py -h[--help]
                              cmd will be called with a single file path as
                              it's only argument.
       -i,--inputs filenm ... Name of file containing input file names to
-                             serve as inputs to cmd, one per task.
+                             serve as inputs to cmd, one per task. May be
+                             given more than once to serve several lists,
+                             or name a directory to search (all the way
+                             down) for input files instead.
+      --match pattern ...... Shell pattern input files found in a
+                             directory must match. Default is "*.bb".
       -a,--allworkers n .... Total workers ( workers per node * nodes ).
+                             May be left out with -e, in which case the
+                             dispatcher serves whoever asks until all the
+                             work is done.
+      -e,--endpoint endpointnm
+                             Run as a shared dispatcher: pick a free port
+                             and write where to find it to endpointnm,
+                             for workers given the same -e (from any
+                             number of jobs) to read. The file is removed
+                             once all the work is done.
+      -l,--ledger ledgernm . Task ledger to append to. Tasks the ledger
+                             shows completed successfully are skipped,
+                             and those that were in flight, failed or
+                             skipped are run again. Default is the first
+                             inputs name with ".ledger" appended.
+                             Remove the ledger to start over.
+      -o,--order mode ...... Order in which tasks are handed out. "file"
+                             (the default) follows the inputs file.
+                             "longest" hands out the tasks expected to
+                             take longest first. Expected times come
+                             from prior runs in the ledger, or from
+                             ntax * nchar * ngen * nruns * nchains when
+                             the input is a MrBayes .bb file.
+      -r,--results resultsnm Results file to append a JSON record per
+                             task to (task, file, worker, host, start and
+                             end times, exit code, max RSS, CPU times,
+                             output sizes and log files). Default is the
+                             first inputs name with ".jsonl" appended.
+      -c,--check check ..... Command run by the worker after a task exits
+                             successfully, with the same file argument. A
+                             nonzero exit code marks the task failed (e.g.
+                             wq_check_mb.sh checks the .t files are
+                             complete). A task otherwise fails only if it
+                             exits with a nonzero code.
+      -y,--retries n ....... Times a failed task is handed out again
+                             within the same job. Default is 0.
+      --backoff secs ....... Seconds before the first retry of a failed
+                             task, doubled for each further retry.
+                             Default is 60.
+      --status statusnm .... Status file rewritten every heartbeat with
+                             the tasks done, running and queued, tasks
+                             per hour, mean and 95th percentile task
+                             time, how busy each host's workers are, and
+                             the projected completion time next to when
+                             the workers' jobs end. Default is the first
+                             inputs name with ".status" appended.
    Run as worker:
       -w,--workers n ........... Run n workers per node.
       -m,--mothersuperior ms ... Host name of mother superior node.
+      -e,--endpoint endpointnm . Instead of -m, find a shared dispatcher
+                                 from the endpoint file it wrote, waiting
+                                 up to a minute for it to appear.
       -t,--time walltime ....... Wallclock time to allow for entire job.
                                  May be expressed as one of the following:
                                     ss, mm:ss, hh:mm:ss, or d:hh:mm:ss.
                                  (note: Torque sets env variable PBS_WALLTIME)
+      -g,--logdir dir .......... Stream each task's stdout and stderr to
+                                 dir/task<n>.out and .err instead of holding
+                                 them in memory. Only the last lines are
+                                 printed with the results.
+      -n,--cores n ............. Share n cores among the node's workers.
+                                 Each task gets nruns * nchains cores from
+                                 its bayes block (at most n), passed to it
+                                 in WQ_CORES, so several small tasks or one
+                                 large one run at a time. -w then sets the
+                                 most tasks run at once. Default is 0, for
+                                 one task per worker without WQ_CORES.
+      --stage dir .............. Run each task in a copy of its input
+                                 file's directory (just the files, not
+                                 subdirectories) made under dir, which
+                                 should be on node-local scratch, then
+                                 copy the outputs back next to the input
+                                 before the check runs. Keeps the I/O of
+                                 running tasks off the shared filesystem.
+      --outputs patterns ....... Comma separated shell patterns of the
+                                 files to copy back, such as
+                                 "*.p,*.t,*.ckp,*.mcmc,*.log". Default
+                                 is every file the task created or
+                                 changed.
+   Dispatcher or worker:
+      -b,--heartbeat secs ...... Seconds between the heartbeats workers send
+                                 while running a task. A worker silent for 5
+                                 heartbeats is presumed dead and its task is
+                                 handed out again. Use the same value for the
+                                 dispatcher and workers. Default is 60.
+   Run locally:
+      -L,--local n ............. Run the dispatcher and n workers on this
+                                 machine, talking over an ipc socket, with
+                                 no need for PBS or ssh. -a and -m aren't
+                                 needed. Any other dispatcher or worker
+                                 option may be given.
+   Query results:
+      -q,--query resultsnm ..... Summarize a results file: task counts by
+                                 status, CPU time, largest memory use and
+                                 tasks completed over time.
+      --bin secs ............... Throughput bin width. Default is 3600.
+      --list status ............ Instead list the task number and file of
+                                 each task whose latest status is "done",
+                                 "failed", "skipped" or "lost".
 
    The dispatcher must be started before any of the workers.
 """ )
@@ -507,16 +1891,40 @@ if __name__ == "__main__":
    port = '54321'
    start = 1
    jobtime = 86400
-   filenm = ''
+   filenms = []
+   match = '*.bb'
+   endpointnm = ''
+   allw = 0
+   ledgernm = ''
+   resultsnm = ''
+   statusnm = ''
+   stagedir = ''
+   outputs = []
+   binsecs = 3600
+   status = ''
+   check = ''
+   retries = 0
+   backoff = 60
+   order = 'file'
+   heartbeat = 60
+   logdir = ''
+   cores = 0
+   local = 0
    ms = ''
+   mode = ''
 
    try:
 
-      opts, args = getopt.getopt( sys.argv[1:], "hd:w:s:i:t:m:a:",
+      opts, args = getopt.getopt( sys.argv[1:], "hd:w:s:i:t:m:a:l:o:b:g:r:q:c:y:n:L:e:",
                                   ['help', 'dispatcher=', 
                                    'workers=', 'start=', 'inputs=',
                                    'time=', 'mothersuperior=',
-				   'allworkers='] )
+				   'allworkers=', 'ledger=', 'order=',
+                                   'heartbeat=', 'logdir=', 'results=',
+                                   'query=', 'bin=', 'list=', 'check=',
+                                   'retries=', 'backoff=', 'cores=',
+                                   'local=', 'endpoint=', 'match=',
+                                   'status=', 'stage=', 'outputs='] )
 
    except getopt.GetoptError, err:
 
@@ -546,7 +1954,80 @@ if __name__ == "__main__":
 
       elif o in ( "-i", "--inputs" ) :
 
-         filenm = a
+         filenms.append( a )
+
+      elif o == "--match" :
+
+         match = a
+
+      elif o in ( "-e", "--endpoint" ) :
+
+         endpointnm = a
+
+      elif o in ( "-l", "--ledger" ) :
+
+         ledgernm = a
+
+      elif o in ( "-o", "--order" ) :
+
+         order = a
+
+      elif o in ( "-b", "--heartbeat" ) :
+
+         heartbeat = int( a )
+
+      elif o in ( "-g", "--logdir" ) :
+
+         logdir = a
+
+      elif o in ( "-r", "--results" ) :
+
+         resultsnm = a
+
+      elif o in ( "-q", "--query" ) :
+
+         mode = 'q'
+         resultsnm = a
+
+      elif o == "--status" :
+
+         statusnm = a
+
+      elif o == "--stage" :
+
+         stagedir = a
+
+      elif o == "--outputs" :
+
+         outputs = [ p for p in a.split( ',' ) if p != '' ]
+
+      elif o == "--bin" :
+
+         binsecs = int( a )
+
+      elif o == "--list" :
+
+         status = a
+
+      elif o in ( "-c", "--check" ) :
+
+         check = a
+
+      elif o in ( "-y", "--retries" ) :
+
+         retries = int( a )
+
+      elif o == "--backoff" :
+
+         backoff = int( a )
+
+      elif o in ( "-n", "--cores" ) :
+
+         cores = int( a )
+
+      elif o in ( "-L", "--local" ) :
+
+         local = int( a )
 
       elif o in ( "-m", "--mothersuperior" ) :
 
@@ -567,9 +2048,45 @@ if __name__ == "__main__":
          print( "Run with -h or --help for usage hints." )
          sys.exit( 1 )
 
+   if heartbeat < 1 :
+      print( "ERROR: --heartbeat must be positive! Have: %d" % ( heartbeat ) )
+      sys.exit( 1 )
+
+   if local != 0 :
+
+      if mode != 'd' or local < 0 :
+         print( "ERROR: --local needs a positive number of workers and "
+                "--dispatcher." )
+         print( "Run with -h or --help for usage hints." )
+         sys.exit( 1 )
+
+      if cores < 0 or jobtime < 1 :
+         print( "ERROR: --cores can't be negative, and --time must be "
+                "positive!" )
+         sys.exit( 1 )
+
+      # Everyone is on this machine, so talk over an ipc socket in a
+      # private directory rather than TCP.
+
+      allw = local
+      ipcdir = tempfile.mkdtemp( prefix = "wq." )
+      port = "ipc://%s" % ( os.path.join( ipcdir, "dispatcher" ) )
+
+   if mode == 'q':
+
+      if binsecs < 1 :
+         print( "ERROR: --bin must be positive! Have: %d" % ( binsecs ) )
+         sys.exit( 1 )
+
+      try:
+         query_results( resultsnm, binsecs, status )
+      except IOError:
+         print( "ERROR: Failed to open results file: \"%s\"" % ( resultsnm ) )
+         sys.exit( 1 )
+
    if mode == 'w':
 
-      if ms == '' :
+      if ms == '' and endpointnm == '' :
          print( "ERROR: Mother superior host name not specified." )
          print( "Run with -h or --help for usage hints." )
          sys.exit( 1 )
@@ -583,34 +2100,67 @@ if __name__ == "__main__":
          print( "ERROR: --jobtime must be positive! Have: %d" % ( jobtime ) )
          sys.exit( 1 )
 
-      # Get hostname of mother superior node.
+      if cores < 0 :
+         print( "ERROR: --cores can't be negative! Have: %d" % ( cores ) )
+         sys.exit( 1 )
 
-      host = ipaddrs( ms )
+      # Get hostname of mother superior node, or where a shared
+      # dispatcher is.
+
+      if endpointnm != '' :
+         address = read_endpoint( endpointnm )
+         if address is None :
+            print( "ERROR: No dispatcher endpoint file: \"%s\""
+                   % ( endpointnm ) )
+            sys.exit( 1 )
+         host = address['host']
+         port = address['port']
+      else:
+         host = ipaddrs( ms )
+
+      if cores > 0 :
+         pool = core_pool( cores )
+      else:
+         pool = None
 
       # Launch the desired number of worker threads.
 
       for wrk_num in range( numw ):
 
          Process( target = worker,
-                  args = ( wrk_num, host, port, jobtime ) ).start()
+                  args = ( wrk_num, host, port, jobtime,
+                           heartbeat, logdir, pool, stagedir,
+                           outputs ) ).start()
 
    if mode == 'd':
 
-      if allw < 1 :
+      if allw < 1 and endpointnm == '' :
          print( "ERROR: --allworkers must be positive! Have: %d" % \
                 ( allw ) )
          sys.exit( 1 )
 
-      # Open the input list file.
+      if len( filenms ) == 0 :
+         print( "ERROR: No --inputs given." )
+         sys.exit( 1 )
+
+      if retries < 0 or backoff < 0 :
+         print( "ERROR: --retries and --backoff can't be negative!" )
+         sys.exit( 1 )
+
+      if order not in ( 'file', 'longest' ) :
+         print( "ERROR: Unknown --order: \"%s\"" % ( order ) )
+         sys.exit( 1 )
+
+      # Read the input lists, numbering the tasks on from one list to
+      # the next.
 
       try:
-         infile = open( filenm, 'r')
-      except IOError:
-         print( "ERROR: Failed to open inputs file: \"%s\"" % ( filenm ) )
+         files = read_inputs( filenms, match )
+      except IOError, err:
+         print( "ERROR: Failed to open inputs file: \"%s\""
+                % ( err.filename ) )
          sys.exit( 1 )
 
-      files = infile.readlines()
-      infile.close()
       tasks = len( files )
 
       # Fire up the dispatcher!
@@ -620,12 +2170,98 @@ if __name__ == "__main__":
                 ( start, tasks ) )
          sys.exit( 1 )
 
-      if tasks > 0:
+      if tasks < 1:
+         print( "ERROR: Inputs appear empty: \"%s\""
+                % ( '", "'.join( filenms ) ) )
+         sys.exit( 1 )
+
+      # Number the tasks by input line, and drop any the ledger shows
+      # were completed by an earlier run.
+
+      if ledgernm == '' :
+         ledgernm = filenms[0].rstrip( '/' ) + ".ledger"
+
+      if resultsnm == '' :
+         resultsnm = filenms[0].rstrip( '/' ) + ".jsonl"
+
+      if statusnm == '' :
+         statusnm = filenms[0].rstrip( '/' ) + ".status"
+
+      last = read_ledger( ledgernm )
+      todo = []
+      for n in range( start, tasks + 1 ):
+         f = files[n - 1].strip()
+         if last.get( f ) != "done" :
+            todo.append( ( n, f ) )
+      inflight = len( [ f for f in last if last[f] == "started" ] )
+
+      sys.stderr.write( "Dispatcher:Resume:%d:%d:%d\n"
+                        % ( tasks - start + 1 - len( todo ), inflight,
+                            len( todo ) ) )
+      sys.stderr.flush()
+
+      model = build_model( todo, ledgernm )
+
+      # Without any history, predict_time has nothing to scale bb_cost
+      # by, but the raw cost is still good enough for ordering.
+
+      if order == 'longest' :
+         predicted = {}
+         for ( num, f ) in todo:
+            predicted[num] = predict_time( model, num, f )
+            if predicted[num] is None :
+               predicted[num] = task_cost( model, num, f )
+         todo.sort( key = lambda t: predicted[t[0]], reverse = True )
+
+      # A shared dispatcher takes any free port, and tells workers
+      # where to find it.
+
+      if endpointnm != '' and local == 0 :
+         port = free_port()
+
+      if len( todo ) > 0:
          dispatcher = Process( target = dispatcher,
-                               args = ( port, cmd, files, allw, start ) )
+                               args = ( port, cmd, todo, allw, ledgernm,
+                                        resultsnm, statusnm, model,
+                                        heartbeat, check, retries,
+                                        backoff ) )
          dispatcher.start()
       else:
-         print( "ERROR: Inputs file appears empty: \"%s\"" % ( filenm ) )
-         sys.exit( 1 )
+         print( "All tasks in \"%s\" are recorded as done in \"%s\"."
+                % ( '", "'.join( filenms ), ledgernm ) )
+
+      if endpointnm != '' and local == 0 and len( todo ) > 0 :
+         host = ipaddrs( socket.gethostname() )
+         write_endpoint( endpointnm, { 'host' : host, 'port' : port } )
+         sys.stderr.write( "Dispatcher:Endpoint:%s:%s\n" % ( host, port ) )
+         sys.stderr.flush()
+         dispatcher.join()
+         os.remove( endpointnm )
+
+      # Running locally, start the workers here too and clean up once
+      # everyone is done.
+
+      if local > 0 :
+
+         if len( todo ) > 0:
+
+            if cores > 0 :
+               pool = core_pool( cores )
+            else:
+               pool = None
+
+            workers = []
+            for wrk_num in range( local ):
+               workers.append( Process( target = worker,
+                                        args = ( wrk_num, None, port, jobtime,
+                                                 heartbeat, logdir, pool,
+                                                 stagedir, outputs ) ) )
+               workers[-1].start()
+
+            dispatcher.join()
+            for w in workers:
+               w.join()
+
+         shutil.rmtree( ipcdir )
 
 # And we're out'a here!
@@ -1,5 +1,11 @@
 #!/bin/bash
 
+# Convergence engine, as set in wq_mrc.sh. mbConverge.py ("python") reads
+# the run files where they are, so only MrConverge ("java") needs the jar
+# and the _rN copies.
+
+ENGINE=python
+
 for f in *.nex
 do
 base=`basename $f .nex`
@@ -10,7 +16,9 @@ cd SeqOutfiles
 	basenex=`basename $nex .nex`
 	cd $basenex
 	cp ../../../mrc.conblock .
+	if [ "${ENGINE}" = "java" ] ; then
 	cp ../../../MrConverge1b2.5.jar .
+	fi
 	sed -i.tmp "s/set filename=data/set filename=$basenex/g" mrc.conblock
 	cd ../
 	done
@@ -18,6 +26,7 @@ cd ../
 cd ../
 done
 
+if [ "${ENGINE}" = "java" ] ; then
 for z in *.nex
 do
 basez=`basename $z .nex`
@@ -51,4 +60,4 @@ cd SeqOutfiles
 cd ../
 cd ../
 done
-
+fi
@@ -27,46 +27,215 @@ The important port and host variables are:
   dport ... Port for the dispatcher request socket (default: 5557)
   cport ... Port for the result_manager control socket (default: 5559)
   rport ... Port for the result_manager result socket (default: 5558)
+  qport ... Port for the dispatcher requeue socket (default: 5560)
   host .... Host name on which dispatcher is running.
 
+Workers send heartbeats to the result_manager while running a task
+(every 60 seconds by default). Tasks held by a worker that goes silent
+for 5 heartbeats are sent back to the dispatcher to be handed out again.
+
+The dispatcher and result_manager may instead be run on their own as a
+shared service, for instance on a login node, serving several input
+lists or a directory tree of inputs. They then pick free ports and
+write them to an endpoint file, which workers from any number of PBS
+jobs read to find them, and keep going until all the work is done
+however many jobs that takes.
+
 """
 
 import time
 import zmq
 import getopt
 import sys
+import os
 import socket
 import subprocess
-from multiprocessing import Process
+from multiprocessing import Process, Condition, Value
 import re
+import threading
+import tempfile
+import json
+import shutil
+import fnmatch
+import math
 
 
-def shell ( cmd ):
+def shell ( cmd, logbase = None ):
    """
    Submits a shell command for processing, and returns the cmd status
    flag and both the STDIN and STDOUT messages.
 
    Arguments:
 
-      cmd .. The desired shell command line.
+      cmd ...... The desired shell command line.
+      logbase .. If given, stdout and stderr are streamed straight to the
+                 files logbase.out and logbase.err rather than being held
+                 in memory, and only the last lines of each are returned.
 
    Returns:
 
-      3-tuple: True/False for success/failure.
-               List of stdout lines.
-               List of stderr lines.
+      7-tuple: True/False for success/failure (a zero exit code).
+               List of stdout lines (only the last ones if logging).
+               List of stderr lines (only the last ones if logging).
+               Number of bytes written to stdout.
+               Number of bytes written to stderr.
+               Exit code (negative signal number if killed).
+               Dictionary of the command's resource usage: 'maxrss'
+               (kB), 'utime' and 'stime' (CPU secs).
    """
-   p = subprocess.Popen( cmd, shell=True, stderr=subprocess.PIPE,
-                         stdout=subprocess.PIPE )
-   x = p.communicate()
-   p.stdout.close()
-   p.stderr.close()
-   if x[1] == '':
-      status = True
+   if logbase is None:
+      out = tempfile.TemporaryFile()
+      err = tempfile.TemporaryFile()
    else:
-      status = False
-      
-   return [ status, x[0].split( '\n' ), x[1].split( '\n' ) ]
+      out = open( logbase + ".out", 'w+' )
+      err = open( logbase + ".err", 'w+' )
+
+   # Reap the command with wait4 rather than Popen.wait so its resource
+   # usage comes back with it.
+
+   p = subprocess.Popen( cmd, shell=True, stderr=err, stdout=out )
+   ( pid, sts, ru ) = os.wait4( p.pid, 0 )
+   if os.WIFSIGNALED( sts ):
+      p.returncode = -os.WTERMSIG( sts )
+   else:
+      p.returncode = os.WEXITSTATUS( sts )
+   usage = { 'maxrss' : ru.ru_maxrss, 'utime' : ru.ru_utime,
+             'stime' : ru.ru_stime }
+
+   outbytes = os.fstat( out.fileno() ).st_size
+   errbytes = os.fstat( err.fileno() ).st_size
+   status = ( p.returncode == 0 )
+
+   if logbase is None:
+      out.seek( 0 )
+      err.seek( 0 )
+      outlines = out.read().split( '\n' )
+      errlines = err.read().split( '\n' )
+      out.close()
+      err.close()
+   else:
+      out.close()
+      err.close()
+      outlines = log_tail( logbase + ".out" )
+      errlines = log_tail( logbase + ".err" )
+
+   return [ status, outlines, errlines, outbytes, errbytes, p.returncode,
+            usage ]
+
+
+def log_tail( filenm, lines = 20 ):
+   """
+   Returns the last lines of a task log file, reading at most the last
+   8 kB of it.
+
+   Arguments:
+
+      filenm .. The log file name.
+      lines ... The maximum number of lines to return.
+   """
+   f = open( filenm, 'r' )
+   f.seek( 0, 2 )
+   f.seek( max( 0, f.tell() - 8192 ) )
+   tail = f.read().split( '\n' )
+   f.close()
+
+   return tail[-lines - 1:]
+
+
+def check_task( check, f, result ):
+    """
+    Runs the output check for a task that exited successfully, and folds
+    its outcome into the task's result. Arguments include:
+
+       check ... Check command, called with the task input file as its
+                 only argument, or '' for none.
+       f ....... The task input file.
+       result .. What shell() returned for the task. Updated in place.
+
+    Returns the check's exit code, or None if it wasn't run.
+    """
+    if check == '' or not result[0]:
+        return None
+
+    c = shell( "%s %s" % ( check, f ) )
+    if not c[0]:
+        result[0] = False
+        result[2] = ( result[2] +
+                      [ "Check failed with exit code %d: %s %s"
+                        % ( c[5], check, f ) ] + c[1] + c[2] )
+
+    return c[5]
+
+
+def stage_task( cmd, f, stagedir, outputs, logbase ):
+    """
+    Runs a task on a copy of its input directory in node-local scratch,
+    so the files it reads and writes while it runs stay off the shared
+    filesystem. Arguments include:
+
+       cmd ....... The task command.
+       f ......... The task input file.
+       stagedir .. Node-local directory to stage the task in. Created if
+                   need be.
+       outputs ... Shell patterns (such as "*.t") naming the files to
+                   copy back, or an empty list to copy back every file
+                   the task created or changed.
+       logbase ... Passed on to shell().
+
+    The files directly in the input file's directory (not those in any
+    subdirectories) are copied to a new directory under stagedir, and
+    the command is run on the copy of f there. When it exits,
+    successfully or not, the outputs are copied back next to f and the
+    staged copy is removed. Failing to copy the outputs back fails the
+    task.
+
+    Returns what shell() returned for the task.
+    """
+    srcdir = os.path.dirname( os.path.abspath( f ) )
+
+    if not os.path.isdir( stagedir ):
+        try:
+            os.makedirs( stagedir )
+        except OSError:
+            # Another worker got there first.
+            pass
+
+    workdir = tempfile.mkdtemp( prefix = "wq.", dir = stagedir )
+
+    try:
+        staged = {}
+        for name in os.listdir( srcdir ):
+            path = os.path.join( srcdir, name )
+            if os.path.isfile( path ):
+                shutil.copy2( path, workdir )
+                st = os.stat( os.path.join( workdir, name ) )
+                staged[name] = ( st.st_size, st.st_mtime )
+
+        result = shell( "%s %s" % ( cmd, os.path.join( workdir,
+                                                       os.path.basename( f ) ) ),
+                        logbase )
+
+        for name in sorted( os.listdir( workdir ) ):
+            path = os.path.join( workdir, name )
+            if not os.path.isfile( path ):
+                continue
+            if len( outputs ) > 0:
+                wanted = len( [ o for o in outputs
+                                if fnmatch.fnmatch( name, o ) ] ) > 0
+            else:
+                st = os.stat( path )
+                wanted = staged.get( name ) != ( st.st_size, st.st_mtime )
+            if wanted:
+                try:
+                    shutil.copy2( path, srcdir )
+                except ( IOError, OSError ), err:
+                    result[0] = False
+                    result[2] = result[2] + [ "Failed to copy back %s: %s"
+                                              % ( name, err ) ]
+    finally:
+        shutil.rmtree( workdir, ignore_errors = True )
+
+    return result
 
 
 def ipaddrs( host ):
@@ -78,17 +247,480 @@ def ipaddrs( host ):
     return socket.gethostbyaddr(host)[2][0]
 
 
-def dispatcher( dport, cmd, files ):
+def endpoint( host, port ):
+    """
+    Builds the zmq address of a socket. Arguments include:
+
+       host .. IP of the host running the dispatcher.
+       port .. The port, or a complete zmq address (such as
+               "ipc:///tmp/wq/dport" when running locally), which is
+               used as is.
+    """
+    if '://' in port:
+        return port
+
+    return "tcp://%s:%s" % ( host, port )
+
+
+def free_ports( n ):
+    """
+    Asks the OS for TCP ports nothing is listening on, for a shared
+    dispatcher and result manager to bind to. Needs a single argument:
+
+       n .. The number of ports wanted.
+
+    The ports are returned as a list of strings, like the default ports.
+    """
+    socks = []
+    for i in range( n ):
+        socks.append( socket.socket( socket.AF_INET, socket.SOCK_STREAM ) )
+        socks[-1].bind( ( '', 0 ) )
+    ports = [ "%d" % ( sock.getsockname()[1] ) for sock in socks ]
+    for sock in socks:
+        sock.close()
+
+    return ports
+
+
+def write_endpoint( endpointnm, address ):
+    """
+    Writes where to find a shared dispatcher and result manager, for
+    workers to read. Arguments include:
+
+       endpointnm .. Name of the endpoint file.
+       address ..... Dictionary of the 'host' IP and the 'dport', 'rport',
+                     'cport' and 'qport' ports.
+
+    The file is written under a temporary name and renamed into place,
+    so a worker never reads half of it.
+    """
+    tmpnm = "%s.%d" % ( endpointnm, os.getpid() )
+    tmp = open( tmpnm, 'w' )
+    tmp.write( "%s\n" % ( json.dumps( address ) ) )
+    tmp.close()
+    os.rename( tmpnm, endpointnm )
+
+
+def read_endpoint( endpointnm, wait = 60 ):
+    """
+    Reads where to find a shared dispatcher and result manager.
+    Arguments include:
+
+       endpointnm .. Name of the endpoint file.
+       wait ........ Seconds to wait for the file to appear, in case the
+                     dispatcher is still starting up.
+
+    Returns the dictionary written by write_endpoint, or None if the
+    file never appeared.
+    """
+    give_up = time.time() + wait
+
+    while not os.path.exists( endpointnm ):
+        if time.time() > give_up:
+            return None
+        time.sleep( 1 )
+
+    f = open( endpointnm, 'r' )
+    address = json.loads( f.read() )
+    f.close()
+
+    return address
+
+
+def read_inputs( inputnms, match ):
+    """
+    Reads the input files to run tasks on. Arguments include:
+
+       inputnms .. Names of files listing input files one per line, or of
+                   directories to search for input files.
+       match ..... Shell pattern input file names found in a directory
+                   must match (such as "*.bb").
+
+    Returns the list of input file names, in list order. Those found in
+    a directory are sorted by path. Raises IOError if a list can't be
+    read.
+    """
+    files = []
+
+    for inputnm in inputnms:
+        if os.path.isdir( inputnm ):
+            found = []
+            for ( dirpath, dirnames, filenames ) in os.walk( inputnm ):
+                for f in fnmatch.filter( filenames, match ):
+                    found.append( os.path.abspath( os.path.join( dirpath,
+                                                                 f ) ) )
+            files.extend( sorted( found ) )
+        else:
+            infile = open( inputnm, 'r' )
+            files.extend( infile.readlines() )
+            infile.close()
+
+    return files
+
+
+def read_ledger( ledgernm ):
+    """
+    Reads a task ledger written by a previous run. Needs a single
+    argument:
+
+       ledgernm .. Name of the ledger file. A missing file is treated
+                   as an empty ledger.
+
+    Returns a dictionary mapping each input file to the last status
+    recorded for it ("started", "done", "failed" or "skipped").
+
+    The ledger is an append-only, tab separated log with one line per
+    event:
+
+       time  tasknum  worker  status  file
+    """
+    last = {}
+    try:
+        ledger = open( ledgernm, 'r' )
+    except IOError:
+        return last
+
+    for line in ledger:
+        fields = line.rstrip( '\n' ).split( '\t', 4 )
+        # A partial last line is possible if the job was killed mid write.
+        if len( fields ) == 5:
+            last[fields[4]] = fields[3]
+    ledger.close()
+
+    return last
+
+
+def log_task( ledger, tasknum, worker, status, f ):
+    """
+    Appends one event to the task ledger and flushes it to disk so it
+    survives the job being killed. Arguments include:
+
+       ledger .... Open ledger file object.
+       tasknum ... The task sequence number (input file line number).
+       worker .... The worker identifier.
+       status .... "started", "done", "failed" or "skipped".
+       f ......... The task input file.
+    """
+    ledger.write( "%.2f\t%d\t%s\t%s\t%s\n"
+                  % ( time.time(), tasknum, worker, status, f ) )
+    ledger.flush()
+
+
+def task_record( worker, host, tasknum, f, result, taskstart, taskend,
+                 logbase ):
+    """
+    Builds the results stream record for one task. Arguments include:
+
+       worker ..... The worker identifier.
+       host ....... Host name the worker runs on.
+       tasknum .... The task sequence number.
+       f .......... The task input file.
+       result ..... What shell() returned, or None if not run.
+       taskstart .. Task start time, or None if not run.
+       taskend .... Task end time, or None if not run.
+       logbase .... Task output log files less extension, or None.
+
+    Returns a dictionary of the record fields. The result manager fills
+    in the 'status' field as for the ledger ("done", "failed", "skipped"
+    or "lost").
+    """
+    record = { 'tasknum' : tasknum, 'file' : f, 'worker' : worker,
+               'host' : host, 'status' : None, 'start' : taskstart,
+               'end' : taskend, 'elapsed' : None, 'exitcode' : None,
+               'maxrss' : None, 'utime' : None, 'stime' : None,
+               'stdoutbytes' : None, 'stderrbytes' : None,
+               'stdoutlog' : None, 'stderrlog' : None, 'checkcode' : None,
+               'cores' : None }
+
+    if result is None:
+        return record
+
+    record['elapsed'] = taskend - taskstart
+    record['stdoutbytes'] = result[3]
+    record['stderrbytes'] = result[4]
+    record['exitcode'] = result[5]
+    record['maxrss'] = result[6]['maxrss']
+    record['utime'] = result[6]['utime']
+    record['stime'] = result[6]['stime']
+    if logbase is not None:
+        record['stdoutlog'] = os.path.abspath( logbase + ".out" )
+        record['stderrlog'] = os.path.abspath( logbase + ".err" )
+
+    return record
+
+
+def log_record( results, record ):
+    """
+    Appends one record to the JSON lines results stream and flushes it
+    to disk. Arguments include:
+
+       results .. Open results file object.
+       record ... Dictionary from task_record.
+    """
+    results.write( json.dumps( record, sort_keys = True ) + '\n' )
+    results.flush()
+
+
+def read_records( resultsnm ):
+    """
+    Reads a JSON lines results stream. Needs a single argument:
+
+       resultsnm .. Name of the results file.
+
+    Returns a list of record dictionaries, in the order written.
+    """
+    records = []
+    results = open( resultsnm, 'r' )
+    for line in results:
+        try:
+            records.append( json.loads( line ) )
+        except ValueError:
+            # A partial last line is possible if the job was killed mid write.
+            pass
+    results.close()
+
+    return records
+
+
+def query_results( resultsnm, binsecs, status ):
+    """
+    Summarizes a results stream on stdout. Arguments include:
+
+       resultsnm .. Name of the results file.
+       binsecs .... Width in seconds of the throughput bins.
+       status ..... If not '', just list the tasknum and file of each task
+                    whose latest record has this status instead.
+
+    A task's latest record decides its status, so tasks rerun by later
+    jobs are counted once.
+    """
+    records = read_records( resultsnm )
+
+    latest = {}
+    for r in records:
+        latest[r['tasknum']] = r
+
+    if status != '':
+        for num in sorted( latest.keys() ):
+            if latest[num]['status'] == status:
+                print( "%d\t%s" % ( num, latest[num]['file'] ) )
+        return
+
+    counts = {}
+    for r in latest.values():
+        counts[r['status']] = counts.get( r['status'], 0 ) + 1
+
+    print( "Results: %s" % ( resultsnm ) )
+    print( "Records: %d  Tasks: %d" % ( len( records ), len( latest ) ) )
+    for s in [ "done", "failed", "skipped", "lost" ]:
+        print( "  %-8s %d" % ( s, counts.get( s, 0 ) ) )
+
+    ran = [ r for r in records if r['exitcode'] is not None ]
+    if len( ran ) == 0:
+        return
+
+    cpu = sum( [ r['utime'] + r['stime'] for r in ran ] )
+    big = max( ran, key = lambda r: r['maxrss'] )
+    print( "Task CPU hours: %.2f" % ( cpu / 3600.0 ) )
+    print( "Largest max RSS: %.1f MB (task %d)"
+           % ( big['maxrss'] / 1024.0, big['tasknum'] ) )
+
+    # Bin the finish times of the successful runs.
+
+    first = min( [ r['start'] for r in ran ] )
+    bins = {}
+    for r in ran:
+        if r['status'] == "done":
+            b = int( ( r['end'] - first ) / binsecs )
+            bins[b] = bins.get( b, 0 ) + 1
+
+    print( "Throughput (tasks done per %d secs):" % ( binsecs ) )
+    total = 0
+    if len( bins ) > 0:
+        for b in range( max( bins.keys() ) + 1 ):
+            total += bins.get( b, 0 )
+            print( "  %s  %6d %8d"
+                   % ( time.strftime( "%Y-%m-%d %H:%M:%S",
+                                      time.localtime( first + b * binsecs ) ),
+                       bins.get( b, 0 ), total ) )
+
+
+def host_usage( joined, left, busy, began, now ):
+    """
+    Adds up how busy the workers on each host have been. Arguments
+    include:
+
+       joined .. Dictionary of worker -> time first heard from.
+       left .... Dictionary of worker -> time it quit or was lost.
+       busy .... Dictionary of worker -> seconds spent on finished tasks.
+       began ... Dictionary of worker -> start time of the task it is
+                 running.
+       now ..... The current time.
+
+    Returns a dictionary of host -> [ workers still working, tasks
+    running, busy seconds, seconds workers have been around ]. Hosts
+    come from the worker names (see worker).
+    """
+    usage = {}
+
+    for w in joined:
+        host = w.rsplit( '_', 2 )[0]
+        u = usage.setdefault( host, [ 0, 0, 0.0, 0.0 ] )
+        if w not in left:
+            u[0] += 1
+        if w in began:
+            u[1] += 1
+            u[2] += now - began[w]
+        u[2] += busy.get( w, 0 )
+        u[3] += left.get( w, now ) - joined[w]
+
+    return usage
+
+
+def write_status( statusnm, starttime, counts, durations, usage, jobend ):
+    """
+    Rewrites the status file with the progress of the run so far, for a
+    look at how a long job is doing while it runs. Arguments include:
+
+       statusnm .... Name of the status file.
+       starttime ... Time the result manager started.
+       counts ...... Dictionary of the number of 'tasks' in the run, and
+                     how many are 'done', 'failed', 'running' and 'queued'.
+       durations ... Elapsed times of the tasks done so far.
+       usage ....... Per host usage, from host_usage.
+       jobend ...... Latest time a worker's job runs out, or None.
+
+    Throughput counts tasks done or failed since the result manager
+    started. The projected completion time assumes it keeps up, and is
+    compared with the end of the workers' jobs. The file is written
+    under a temporary name and renamed into place, so it is never seen
+    half written.
+    """
+    now = time.time()
+    hours = max( now - starttime, 1.0 ) / 3600.0
+    finished = counts['done'] + counts['failed']
+    remaining = counts['running'] + counts['queued']
+    rate = finished / hours
+
+    lines = []
+    lines.append( "Updated: %s (running %.2f hours)"
+                  % ( time.strftime( "%Y-%m-%d %H:%M:%S",
+                                     time.localtime( now ) ), hours ) )
+    lines.append( "Tasks: %d  done: %d  failed: %d  running: %d  queued: %d"
+                  % ( counts['tasks'], counts['done'], counts['failed'],
+                      counts['running'], counts['queued'] ) )
+    lines.append( "Throughput: %.1f tasks/hour" % ( rate ) )
+
+    if len( durations ) > 0:
+        ordered = sorted( durations )
+        p95 = ordered[ int( math.ceil( 0.95 * len( ordered ) ) ) - 1 ]
+        lines.append( "Task time: mean %.1f secs, p95 %.1f secs"
+                      % ( sum( ordered ) / len( ordered ), p95 ) )
+
+    if remaining == 0:
+        lines.append( "Projected completion: now" )
+    elif rate > 0:
+        eta = now + remaining / rate * 3600.0
+        lines.append( "Projected completion: %s (in %.2f hours)"
+                      % ( time.strftime( "%Y-%m-%d %H:%M:%S",
+                                         time.localtime( eta ) ),
+                          ( eta - now ) / 3600.0 ) )
+        if jobend is not None:
+            if eta <= jobend:
+                verdict = "should finish"
+            else:
+                verdict = "about %d tasks short" \
+                          % ( remaining - rate * ( jobend - now ) / 3600.0 )
+            lines.append( "Workers' time runs out: %s (%s)"
+                          % ( time.strftime( "%Y-%m-%d %H:%M:%S",
+                                             time.localtime( jobend ) ),
+                              verdict ) )
+    else:
+        lines.append( "Projected completion: unknown (nothing finished yet)" )
+
+    lines.append( "%-24s %8s %8s %8s" % ( "Host", "Workers", "Running",
+                                          "Busy%" ) )
+    for host in sorted( usage ):
+        ( workers, running, busy, span ) = usage[host]
+        lines.append( "%-24s %8d %8d %8.1f"
+                      % ( host, workers, running,
+                          100.0 * busy / max( span, 1e-9 ) ) )
+
+    tmpnm = "%s.%d" % ( statusnm, os.getpid() )
+    tmp = open( tmpnm, 'w' )
+    tmp.write( "\n".join( lines ) + "\n" )
+    tmp.close()
+    os.rename( tmpnm, statusnm )
+
+
+def bb_cores( bbfile ):
+    """
+    Returns the number of cores a MrBayes task can use, nruns * nchains
+    from the mcmc settings in its bayes block (using the MrBayes defaults
+    of 2 and 4 for any not given), or 1 if the file can't be read.
+    """
+    settings = { 'nruns' : 2, 'nchains' : 4 }
+    try:
+        bb = open( bbfile, 'r' )
+    except IOError:
+        return 1
+
+    for line in bb:
+        if re.match( r'\s*mcmcp?\s', line, re.I ):
+            for key in settings:
+                m = re.search( r'\b%s\s*=\s*(\d+)' % ( key ), line, re.I )
+                if m:
+                    settings[key] = int( m.group( 1 ) )
+    bb.close()
+
+    return settings['nruns'] * settings['nchains']
+
+
+def core_pool( cores ):
+    """
+    Sets up the pool of cores shared by the workers on a node. Needs a
+    single argument:
+
+       cores .. Number of cores on the node to share out.
+
+    Returns the pool, a dictionary of:
+
+       pool['cores'] .. the cores on the node.
+       pool['free'] ... shared count of cores not given to a task.
+       pool['lock'] ... condition guarding 'free', notified when cores
+                        are returned.
+    """
+    return { 'cores' : cores, 'free' : Value( 'i', cores, lock = False ),
+             'lock' : Condition() }
+
+
+def dispatcher( dport, rport, qport, cmd, tasks, check, batch ):
     """
     The dispatcher task. Arguments include:
 
        dport .. The socket on which to listen for work requests.
+       rport .. The result_manager socket to report tasks handed out to.
+       qport .. The socket on which to listen for tasks to requeue.
        cmd .... Command for workers to execute.
-       files .. List of input files to distribute.
-
-    The "dispatcher" function generates a list of commands and input
-    files, and sends them down a zeromq "PUSH" connection to be processed
-    by listening workers, in a round robin load balanced fashion.
+       tasks .. List of ( tasknum, file ) pairs to distribute.
+       check .. Command for workers to check task output with, or ''.
+       batch .. Number of tasks to send per work message.
+
+    The "dispatcher" function keeps a queue of commands and input files,
+    and answers work requests from workers over a zeromq "REP" connection
+    with the next batch of tasks, which a worker runs back to back. Tasks
+    are only handed out when a worker asks for more, so none sit queued
+    behind a long task while other workers go idle. Batches save on
+    messaging for short tasks. Every batch handed out is reported to the
+    result manager in a "handed" message naming the worker, so the tasks
+    can be sent back if the worker dies before finishing them, even
+    before it has started any.
+
+    Tasks lost with dead workers, skipped for lack of time or due a retry
+    are sent back by the result manager and put back on the queue. While
+    the queue is empty, workers are told to "WAIT" and ask again, until
+    the result manager reports all tasks are finished, after which they
+    are told to quit ("FINI").
 
     "Tasks" are defined by loading up a dictionary and sending it to
     the requesting worker, and results are returned as a second
@@ -96,47 +728,146 @@ def dispatcher( dport, cmd, files ):
     """
     # Only the host running as dispatcher should be calling this.
 
-    host = ipaddrs( socket.gethostname() )
+    if '://' in dport:
+        host = None
+    else:
+        host = ipaddrs( socket.gethostname() )
 
     # Initialize a zeromq context
 
     context = zmq.Context()
 
-    # Set up a channel to send work messages over.
+    # Set up a channel to answer work requests over.
+
+    dispatcher_socket = context.socket( zmq.REP )
+    dispatcher_socket.bind( endpoint( host, dport ) )
+
+    # Set up a channel to receive tasks the result manager sends back.
 
-    dispatcher_send = context.socket( zmq.PUSH )
-    dispatcher_send.bind( "tcp://%s:%s" % ( host, dport ) )
+    requeue_receiver = context.socket( zmq.PULL )
+    requeue_receiver.bind( endpoint( host, qport ) )
 
-    # Give everything a second to spin up and connect
+    # Set up a channel to tell the result manager who has which tasks.
 
-    time.sleep( 1 )
+    handed_sender = context.socket( zmq.PUSH )
+    handed_sender.setsockopt( zmq.LINGER, 0 )
+    handed_sender.connect( endpoint( host, rport ) )
 
-    # Load up the dispatcher with task messages.
+    poller = zmq.Poller()
+    poller.register( dispatcher_socket, zmq.POLLIN )
+    poller.register( requeue_receiver, zmq.POLLIN )
 
-    for f in files:
-        work_message = { 'cmd' : cmd, 'file' : f.strip() }
-        dispatcher_send.send_json( work_message )
+    pending = list( tasks )
+    finished = None
 
-    time.sleep( 1 )
+    # Keep answering requests for a few seconds after the result manager
+    # is done, so workers asking for more are told to quit.
 
+    while finished is None or time.time() - finished < 5:
 
-def worker( wrk_num, host, dport, rport, cport, jobtime ):
+        socks = dict( poller.poll( 1000 ) )
+
+        if socks.get( requeue_receiver ) == zmq.POLLIN:
+            requeue_message = requeue_receiver.recv_json()
+            if requeue_message['type'] == "finished":
+                finished = time.time()
+            else:
+                pending.append( ( requeue_message['tasknum'],
+                                  requeue_message['file'] ) )
+
+        if socks.get( dispatcher_socket ) == zmq.POLLIN:
+            request = dispatcher_socket.recv_json()
+            if finished is not None:
+                work_message = { 'cmd' : "FINI", 'tasks' : [],
+                                 'check' : check }
+            elif len( pending ) == 0:
+                work_message = { 'cmd' : "WAIT", 'tasks' : [],
+                                 'check' : check }
+            else:
+                work_message = { 'cmd' : cmd, 'tasks' : pending[:batch],
+                                 'check' : check }
+                del pending[:batch]
+                handed_sender.send_json( {
+                    'type' : "handed",
+                    'worker' : request['worker'],
+                    'tasknums' : [ t[0] for t in work_message['tasks'] ] } )
+            dispatcher_socket.send_json( work_message )
+
+
+def send_heartbeats( context, host, rport, workerID, tasknum, heartbeat,
+                     finished ):
     """
-    Defines the worker task. The arguments include:
+    Sends heartbeat messages to the result manager while a task runs.
+    This is run as a thread by the worker, with its own zmq.PUSH socket
+    since sockets can't be shared between threads. Arguments include:
+
+       context .... The worker's zmq context.
+       host ....... IP of host running the result manager.
+       rport ...... The result_manager port.
+       workerID ... The worker identifier.
+       tasknum .... The task being run.
+       heartbeat .. Seconds between heartbeats.
+       finished ... threading.Event set when the task is done.
+    """
+    beat_sender = context.socket( zmq.PUSH )
+    beat_sender.setsockopt( zmq.LINGER, 0 )
+    beat_sender.connect( endpoint( host, rport ) )
+
+    while not finished.wait( heartbeat ):
+        beat_sender.send_json( { 'type' : "heartbeat", 'worker' : workerID,
+                                 'tasknum' : tasknum } )
 
-       wrk_num ... Identifier for the worker.
-       host ...... IP of host running the dispatcher.
-       dport ..... The dispatcher port.
-       rport ..... The result_manager port.
-       cport ..... The control message port.
-       jobtime ... How many seconds available for all work.
+    beat_sender.close()
 
-    The "worker" function listens on a zeromq PULL connection for "work"
-    from the dispatcher. Each is a dictionary containing a command name
-    and an input file. The result is sent down another zeromq PUSH
+
+def worker( wrk_num, host, dport, rport, cport, jobtime, heartbeat, logdir,
+            pool, stagedir, outputs ):
+    """
+    Defines the worker task. The arguments include:
+
+       wrk_num ..... Number of the worker among those started together.
+       host ........ IP of host running the dispatcher.
+       dport ....... The dispatcher port.
+       rport ....... The result_manager port.
+       cport ....... The control message port.
+       jobtime ..... How many seconds available for all work.
+       heartbeat ... Seconds between heartbeats sent while a task runs.
+       logdir ...... Directory to stream task output to, or '' to hold
+                     it in memory.
+       pool ........ Cores shared by the workers on the node (see
+                     core_pool), or None.
+       stagedir .... Node-local directory to run tasks in (see
+                     stage_task), or '' to run them where their input
+                     file is.
+       outputs ..... Patterns of the files to copy back from stagedir, or
+                     an empty list for all new or changed files.
+
+    The "worker" function asks the dispatcher for "work" over a zeromq
+    REQ connection whenever it has none left. Each reply is a dictionary
+    containing a command name and a batch of ( tasknum, input file )
+    pairs, which are run one after the other, or "WAIT" to ask again in
+    a second, or "FINI" to quit. The result is sent down another zeromq
+    PUSH
     connection to the results manager. A "task" is defined in a dictionary
     set by the dispatcher, and the results are returned in a second
-    dictionary.  Obviously, the keys must agree on both ends.
+    dictionary.  Obviously, the keys must agree on both ends. Before a
+    task is run, a "start" message naming it is sent down the same
+    connection so the result manager can log it as in flight, and while
+    it runs a thread sends heartbeats the same way. A "ready" message is
+    sent when the worker starts, so the result manager can report how
+    long each worker sat idle. If logdir is set,
+    each task's stdout and stderr go to logdir/task<tasknum>.out and .err
+    and only their last lines are returned with the result.
+
+    With a core pool, a task takes nruns * nchains cores (see bb_cores,
+    at most the node's cores) from the pool, waiting until that many are
+    free, and gives them back when done. The count is passed to it in the
+    WQ_CORES environment variable. Heartbeats are sent while waiting, so
+    the worker isn't taken for dead.
+
+    A worker without enough time left for a task skips it, along with
+    the rest of its batch, and quits rather than asking for more, so
+    the result manager can hand the tasks to a worker with time to spare.
 
     The result manager takes a best effort approach to tracking and
     reporting the maximum execution time to all works over the control
@@ -148,9 +879,12 @@ def worker( wrk_num, host, dport, rport, cport, jobtime ):
 
     margin = 1.25
 
-    # Get our host name.
+    # Get our host name, and name ourselves after it and the process
+    # that started us, so workers from different jobs on a node can't
+    # be confused.
 
     local = socket.gethostname()
+    workerID = "%s_%d_%d" % ( local, os.getppid(), wrk_num )
 
     # Get a starting time hack (in seconds since the epoc).
 
@@ -160,27 +894,31 @@ def worker( wrk_num, host, dport, rport, cport, jobtime ):
 
     context = zmq.Context()
 
-    # Set up a channel to receive work from the dispatcher
+    # Set up a channel to request work from the dispatcher
 
-    work_receiver = context.socket( zmq.PULL )
-    work_receiver.connect( "tcp://%s:%s" % ( host, dport ) )
+    work_requester = context.socket( zmq.REQ )
+    work_requester.setsockopt( zmq.LINGER, 0 )
+    work_requester.connect( endpoint( host, dport ) )
 
     # Set up a channel to return result of work to the results reporter
 
     results_sender = context.socket( zmq.PUSH )
-    results_sender.connect( "tcp://%s:%s" % ( host, rport ) )
+    results_sender.connect( endpoint( host, rport ) )
+    results_sender.send_json( { 'type' : "ready",
+                                'worker' : workerID,
+                                'timeleft' : jobtime } )
 
     # Set up a channel to receive control messages over. These include
     # updates to the maximum execution time seen.
 
     control_receiver = context.socket( zmq.SUB )
-    control_receiver.connect( "tcp://%s:%s" % (host, cport ) )
+    control_receiver.connect( endpoint( host, cport ) )
     control_receiver.setsockopt( zmq.SUBSCRIBE, "" )
 
     # Set up a poller for the work and control receiver channels
 
     work_poller = zmq.Poller()
-    work_poller.register( work_receiver, zmq.POLLIN )
+    work_poller.register( work_requester, zmq.POLLIN )
     control_poller = zmq.Poller()
     control_poller.register( control_receiver, zmq.POLLIN )
 
@@ -188,6 +926,13 @@ def worker( wrk_num, host, dport, rport, cport, jobtime ):
 
     maxtime = 0
 
+    if logdir != '' and not os.path.isdir( logdir ):
+        try:
+            os.makedirs( logdir )
+        except OSError:
+            # Another worker got there first.
+            pass
+
     # Loop and accept messages from both channels, acting accordingly.
     # http://zeromq.github.io/pyzmq/api/zmq.html indicates the timeout
     # values used in zmq.poller are in milliseconds, not microseconds.
@@ -195,21 +940,73 @@ def worker( wrk_num, host, dport, rport, cport, jobtime ):
     timeout = 1
 
     running = True
+    batch = []
+    requested = False
+    nextrequest = 0
+    outoftime = False
 
     while running:
 
-        socks = dict( work_poller.poll( timeout ) )
+        # Only ask for more work once the last batch is done.
+
+        if len( batch ) == 0 and outoftime:
 
-        if socks.get( work_receiver ) == zmq.POLLIN:
+           sys.stderr.write( "Worker %s out of time, quitting!\n"
+                             % ( workerID ) )
+           running = False
 
-           # Looks like a message came in on the work_receiver channel.
-           # Check if there is enough time left, then run the command.
+        elif len( batch ) == 0:
 
-           work_message = work_receiver.recv_json()
+           if not requested and time.time() >= nextrequest:
+              work_requester.send_json( {
+                 'type' : "request",
+                 'worker' : workerID } )
+              requested = True
+
+           socks = dict( work_poller.poll( timeout ) )
+
+           if socks.get( work_requester ) == zmq.POLLIN:
+
+              # Looks like the dispatcher answered.
+
+              work_message = work_requester.recv_json()
+              requested = False
+              batch = list( work_message['tasks'] )
+
+              if work_message['cmd'] == "FINI":
+                 sys.stderr.write( "Worker %s received FINI, quitting!\n"
+                                   % ( workerID ) )
+                 running = False
+
+              elif work_message['cmd'] == "WAIT":
+                 nextrequest = time.time() + 1
+
+        if len( batch ) > 0:
+
+           # Check if there is enough time left for the next task in the
+           # batch, then run the command.
+
+           ( tasknum, f ) = batch.pop( 0 )
 
            # Construct the command line.
 
-           task = "%s %s" % ( work_message['cmd'], work_message['file'] )
+           task = "%s %s" % ( work_message['cmd'], f )
+
+           # Wait for the cores the task needs, if sharing them.
+
+           if pool is not None:
+              cores = min( bb_cores( f ), pool['cores'] )
+              pool['lock'].acquire()
+              while pool['free'].value < cores:
+                 pool['lock'].wait( heartbeat )
+                 results_sender.send_json( { 'type' : "heartbeat",
+                                             'worker' : workerID,
+                                             'tasknum' : tasknum } )
+              pool['free'].value -= cores
+              pool['lock'].release()
+              os.environ['WQ_CORES'] = "%d" % ( cores )
+           else:
+              cores = 0
 
            walltime = time.time() - starttime
            timeleft = jobtime - walltime
@@ -218,14 +1015,46 @@ def worker( wrk_num, host, dport, rport, cport, jobtime ):
 
            if timeleft > ( maxtime * margin ):
 
-              sys.stderr.write( "Worker %s_%d (%d secs left) taking: %s\n"
-                                % ( local, wrk_num, timeleft, task ) )
+              sys.stderr.write( "Worker %s (%d secs left) taking: %s\n"
+                                % ( workerID, timeleft, task ) )
+
+              results_sender.send_json( {
+                 'type' : "start",
+                 'worker' : workerID,
+                 'tasknum' : tasknum,
+                 'file' : f } )
 
               # Record how long the task takes.
 
+              finished = threading.Event()
+              beats = threading.Thread( target = send_heartbeats,
+                                        args = ( context, host, rport,
+                                                 workerID,
+                                                 tasknum,
+                                                 heartbeat, finished ) )
+              beats.start()
+              if logdir != '':
+                 logbase = os.path.join( logdir, "task%d"
+                                         % ( tasknum ) )
+              else:
+                 logbase = None
               taskstart = time.time()
-              result = shell( task )
+              if stagedir != '':
+                 result = stage_task( work_message['cmd'], f,
+                                      stagedir, outputs, logbase )
+              else:
+                 result = shell( task, logbase )
               taskend = time.time()
+              checkcode = check_task( work_message['check'],
+                                      f, result )
+              record = task_record( workerID, local,
+                                    tasknum,
+                                    f, result,
+                                    taskstart, taskend, logbase )
+              record['checkcode'] = checkcode
+              record['cores'] = cores
+              finished.set()
+              beats.join()
               elapsed = taskend - taskstart
               walltime = taskend - starttime
 
@@ -233,27 +1062,53 @@ def worker( wrk_num, host, dport, rport, cport, jobtime ):
                  maxtime = elapsed
 
               answer_message = {
-                 'worker' : "%s_%d" % ( local, wrk_num ),
+                 'type' : "result",
+                 'worker' : workerID,
                  'task' : task,
+                 'tasknum' : tasknum,
+                 'file' : f,
+                 'mode' : "Ran",
                  'status' : result[0],
                  'stdout' : result[1],
                  'stderr' : result[2],
+                 'stdoutbytes' : result[3],
+                 'stderrbytes' : result[4],
+                 'logbase' : logbase,
+                 'record' : record,
                  'tasktime' : elapsed,
                  'walltime' : walltime }
            else:
-              sys.stderr.write( "Worker %s_%d (no time left) skipping: %s\n"
-                                % ( local, wrk_num, task ) )
+              sys.stderr.write( "Worker %s (no time left) skipping: %s\n"
+                                % ( workerID, task ) )
+              outoftime = True
 
               answer_message = {
-                 'worker' : "%s_%d" % ( local, wrk_num ),
+                 'type' : "result",
+                 'worker' : workerID,
                  'task' : task,
+                 'tasknum' : tasknum,
+                 'file' : f,
+                 'mode' : "Skipped",
                  'status' : False,
                  'stdout' : [ 'Insufficient Time', '' ],
                  'stderr' : [ 'Time left: %d; Max Time: %d; Margin: %4.2f' %
                               ( timeleft, maxtime, margin ), '' ],
+                 'stdoutbytes' : 0,
+                 'stderrbytes' : 0,
+                 'logbase' : None,
+                 'record' : task_record( workerID, local,
+                                         tasknum,
+                                         f, None,
+                                         None, None, None ),
                  'tasktime' : 0,
                  'walltime' : walltime }
 
+           if pool is not None:
+              pool['lock'].acquire()
+              pool['free'].value += cores
+              pool['lock'].notify_all()
+              pool['lock'].release()
+
            results_sender.send_json( answer_message )
 
         # Now get caught up on all control messages.
@@ -276,8 +1131,8 @@ def worker( wrk_num, host, dport, rport, cport, jobtime ):
 
                  # If "FINISHED", shut down the worker.
 
-                 sys.stderr.write( "Worker %s_%d received FINSHED, quitting!\n"
-                                   % ( local, wrk_num ) )
+                 sys.stderr.write( "Worker %s received FINSHED, quitting!\n"
+                                   % ( workerID ) )
                  running = False
 
               else:
@@ -288,8 +1143,8 @@ def worker( wrk_num, host, dport, rport, cport, jobtime ):
 
                  if tmp > maxtime:
                     maxtime = tmp
-                    sys.stderr.write( "Worker %s_%d: maxtime set to %d\n"
-                                      % ( local, wrk_num, maxtime ) )
+                    sys.stderr.write( "Worker %s: maxtime set to %d\n"
+                                      % ( workerID, maxtime ) )
            else:
 
               # Control channel is empty, so press on.
@@ -297,24 +1152,67 @@ def worker( wrk_num, host, dport, rport, cport, jobtime ):
               chkcontrol = False
 
 
-def result_manager( rport, cport, tasks ):
+def result_manager( rport, cport, qport, tasks, ledgernm, resultsnm,
+                    statusnm, heartbeat, retries, backoff, shared ):
     """
     Defines the result manager with gathers up all the results.
     The arguments include:
 
-       rport ... The request port.
-       cport ... The control port.
-       tasks ... Total number of tasks to expect.
+       rport ....... The request port.
+       cport ....... The control port.
+       qport ....... The dispatcher requeue port.
+       tasks ....... List of ( tasknum, file ) pairs to expect results for.
+       ledgernm .... Name of the task ledger file to append to.
+       resultsnm ... Name of the JSON lines results file to append to.
+       statusnm .... Name of the status file to keep rewriting.
+       heartbeat ... Seconds between worker heartbeats.
+       retries ..... Times a failed task is handed out again.
+       backoff ..... Seconds to hold a failed task before its first retry,
+                     doubled for each further retry.
+       shared ...... True for a shared dispatcher, which workers from
+                     any number of jobs may come and go from.
 
     Results are received as dictionaries from the worker tasks. Obviously,
-    the keys must match up on both ends.
-
-    When all tasks are done, the workers are signaled to shut down.
+    the keys must match up on both ends. Task starts and results are
+    appended to the task ledger as they arrive, and the record of each
+    result (see task_record) to the results file.
+
+    The dispatcher reports each batch it hands out ("handed"), and each
+    result settles one task of it, whichever arrives first. A worker
+    holding tasks without a result that is not heard from for 5
+    heartbeats is presumed dead, whether it was running one, waiting for
+    cores or had not yet started. Its running task is logged as "lost",
+    and it and the rest of its tasks are sent back to the dispatcher to
+    be handed out again.
+
+    A task fails if it exits with a nonzero code, or if the check
+    command given it exits with one. A failed task with retries left is
+    sent back to the dispatcher once its backoff time is up. A task
+    skipped by a worker out of time is sent straight back while other
+    workers remain, and otherwise left for the next job (the ledger
+    shows it skipped). Once every worker is out of time or lost, there
+    is no one left to run the remaining tasks and the job is wound up.
+    A shared dispatcher instead always sends skipped tasks back, and
+    waits for workers from the next job.
+
+    Every heartbeat, and once more at the end, the status file is
+    rewritten with the progress so far (see write_status): task counts,
+    throughput, task times, how busy each host's workers are, and when
+    the work should be done compared with when the workers' jobs end
+    (workers say how long they have in their "ready" message).
+
+    When all tasks are done, the workers are signaled to shut down, and
+    a report of how many tasks each worker ran and how long it was busy
+    and idle is printed. Idle time runs from a worker's "ready" message
+    until it quits or the job ends, less the time spent on tasks.
     """
 
     # Only the host running as dispatcher should be calling this.
 
-    host = ipaddrs( socket.gethostname() )
+    if '://' in rport:
+        host = None
+    else:
+        host = ipaddrs( socket.gethostname() )
 
     # Initialize a zeromq context
 
@@ -323,61 +1221,355 @@ def result_manager( rport, cport, tasks ):
     # Set up a channel to receive results
 
     results_receiver = context.socket( zmq.PULL )
-    results_receiver.bind( "tcp://%s:%s" % ( host, rport ) )
+    results_receiver.bind( endpoint( host, rport ) )
 
     # Set up a channel to send control commands
 
     control_sender = context.socket( zmq.PUB )
-    control_sender.bind( "tcp://%s:%s" % ( host, cport ) )
+    control_sender.bind( endpoint( host, cport ) )
+
+    # Set up a channel to send lost tasks back to the dispatcher
+
+    requeue_sender = context.socket( zmq.PUSH )
+    requeue_sender.setsockopt( zmq.LINGER, 5000 )
+    requeue_sender.connect( endpoint( host, qport ) )
+
+    results_poller = zmq.Poller()
+    results_poller.register( results_receiver, zmq.POLLIN )
 
     # Set up tracking of maximum time.
 
     maxtime = 0
 
-    for task_nbr in range( tasks ):
+    ledger = open( ledgernm, 'a' )
+    results = open( resultsnm, 'a' )
+
+    files = dict( tasks )
+    finished = {}
+    running = {}
+    handed = {}
+    settled = {}
+    lastbeat = {}
+    lastheard = time.time()
+    deadtime = 5 * heartbeat
+    delayed = []
+    failures = {}
+    joined = {}
+    busy = {}
+    ran = {}
+    began = {}
+    quit = {}
+    jobend = {}
+    durations = []
+    ndone = 0
+    nfailed = 0
+    starttime = time.time()
+    laststatus = 0
+
+    while len( finished ) < len( files ):
+
+        now = time.time()
+
+        if now - laststatus >= heartbeat:
+            ends = [ jobend[w] for w in jobend if w not in quit ]
+            if len( ends ) == 0:
+                ends = [ None ]
+            write_status( statusnm, starttime,
+                          { 'tasks' : len( files ), 'done' : ndone,
+                            'failed' : nfailed, 'running' : len( running ),
+                            'queued' : len( files ) - len( finished )
+                                       - len( running ) },
+                          durations, host_usage( joined, quit, busy, began,
+                                                 now ),
+                          max( ends ) )
+            laststatus = now
+
+        # Send back the tasks of workers that have gone silent.
+
+        for w in set( running ) | set( handed ):
+            if now - lastbeat[w] > deadtime:
+                lost = handed.pop( w, {} )
+                if w in running:
+                    tasknum = running.pop( w )
+                    lost[tasknum] = max( lost.get( tasknum, 0 ), 1 )
+                    log_task( ledger, tasknum, w, "lost", files[tasknum] )
+                    record = task_record( w, None, tasknum, files[tasknum],
+                                          None, None, None, None )
+                    record['status'] = "lost"
+                    record['end'] = now
+                    log_record( results, record )
+                    busy[w] = busy.get( w, 0 ) + lastbeat[w] - began.pop( w )
+                for tasknum in sorted( lost ):
+                    for n in range( lost[tasknum] ):
+                        requeue_sender.send_json( { 'type' : "requeue",
+                                                    'tasknum' : tasknum,
+                                                    'file' : files[tasknum] } )
+                sys.stderr.write( "Result manager: worker %s lost tasks %s\n"
+                                  % ( w, " ".join( map( str,
+                                                        sorted( lost ) ) ) ) )
+                quit[w] = lastbeat[w]
+
+        # Send back failed tasks whose backoff is up.
+
+        for ( ready, tasknum ) in list( delayed ):
+            if now >= ready:
+                delayed.remove( ( ready, tasknum ) )
+                requeue_sender.send_json( { 'type' : "requeue",
+                                            'tasknum' : tasknum,
+                                            'file' : files[tasknum] } )
+
+        # Wind up if no worker is left with time to run the rest.
+
+        if not shared and len( quit ) > 0 and len( quit ) == len( joined ):
+            sys.stderr.write( "Result manager: all workers out of time or "
+                              "lost, %d tasks left for the next job\n"
+                              % ( len( files ) - len( finished ) ) )
+            break
+
+        if not results_poller.poll( 1000 ):
+            continue
+
         result_message = results_receiver.recv_json()
+        lastheard = time.time()
+        lastbeat[result_message['worker']] = lastheard
+        joined.setdefault( result_message['worker'], lastheard )
+        if result_message['type'] == "ready":
+            jobend[result_message['worker']] = lastheard + \
+                                               result_message['timeleft']
+            continue
+        if result_message['type'] == "heartbeat":
+            continue
+        if result_message['type'] == "handed":
+            # The worker's own messages may have got here first, so take
+            # off any tasks it has already sent results for.
+            w = result_message['worker']
+            for tasknum in result_message['tasknums']:
+                if settled.get( w, {} ).get( tasknum, 0 ) > 0:
+                    settled[w][tasknum] -= 1
+                else:
+                    handed.setdefault( w, {} )
+                    handed[w][tasknum] = handed[w].get( tasknum, 0 ) + 1
+            continue
+        if result_message['type'] == "start":
+            running[result_message['worker']] = result_message['tasknum']
+            began[result_message['worker']] = lastheard
+            log_task( ledger, result_message['tasknum'],
+                      result_message['worker'], "started",
+                      result_message['file'] )
+            continue
+        if running.get( result_message['worker'] ) == \
+           result_message['tasknum']:
+            del running[result_message['worker']]
+            del began[result_message['worker']]
+        w = result_message['worker']
+        tasknum = result_message['tasknum']
+        if handed.get( w, {} ).get( tasknum, 0 ) > 0:
+            handed[w][tasknum] -= 1
+            if handed[w][tasknum] == 0:
+                del handed[w][tasknum]
+            if len( handed[w] ) == 0:
+                del handed[w]
+        else:
+            settled.setdefault( w, {} )
+            settled[w][tasknum] = settled[w].get( tasknum, 0 ) + 1
+        if result_message['mode'] == "Skipped":
+            status = "skipped"
+        elif result_message['status']:
+            status = "done"
+        else:
+            status = "failed"
+        tasknum = result_message['tasknum']
+        if result_message['mode'] == "Ran":
+            w = result_message['worker']
+            busy[w] = busy.get( w, 0 ) + result_message['tasktime']
+            ran[w] = ran.get( w, 0 ) + 1
+        if status == "done":
+            durations.append( result_message['tasktime'] )
+            ndone += 1
+        if status == "skipped":
+            quit[result_message['worker']] = lastheard
+            if shared or len( quit ) < len( joined ):
+                requeue_sender.send_json( { 'type' : "requeue",
+                                            'tasknum' : tasknum,
+                                            'file' : files[tasknum] } )
+        elif status == "failed" and failures.get( tasknum, 0 ) < retries:
+            failures[tasknum] = failures.get( tasknum, 0 ) + 1
+            wait = backoff * 2 ** ( failures[tasknum] - 1 )
+            delayed.append( ( time.time() + wait, tasknum ) )
+            sys.stderr.write( "Result manager: task %d failed, retry %d "
+                              "in %d secs\n"
+                              % ( tasknum, failures[tasknum], wait ) )
+        else:
+            finished[tasknum] = 1
+            if status == "failed":
+                nfailed += 1
+        log_task( ledger, result_message['tasknum'],
+                  result_message['worker'], status, result_message['file'] )
+        result_message['record']['status'] = status
+        log_record( results, result_message['record'] )
         print( "Worker %s ran: %s" % ( result_message['worker'],
                                        result_message['task'] ) )
         print( "Success: %s" % ( result_message['status'] ) )
         print( "Elapsed time: %d" % ( result_message['tasktime'] ))
         print( "Walltime: %d" % ( result_message['walltime'] )) 
+        print( "Output bytes: %d stdout, %d stderr"
+               % ( result_message['stdoutbytes'],
+                   result_message['stderrbytes'] ) )
         print( "Stdout:" )
         for l in result_message['stdout']:
             if len( l.strip() ) > 0:
                 print( "  %s" % ( l.strip() ) )
+        if result_message['logbase'] is not None:
+            print( "  (last lines of %s.out)" % ( result_message['logbase'] ) )
         print( "Stderr:" )
         for l in result_message['stderr']:
             if len( l.strip() ) > 0:
                 print( "  %s" % ( l.strip() ) )
+        if result_message['logbase'] is not None:
+            print( "  (last lines of %s.err)" % ( result_message['logbase'] ) )
         print( '' )
         if result_message['tasktime'] > maxtime:
            maxtime = result_message['tasktime']
            control_sender.send( "%d"%(maxtime) )
 
-    # Signal to all workers that we are finsihed
+    ledger.close()
+    results.close()
+
+    now = time.time()
+    write_status( statusnm, starttime,
+                  { 'tasks' : len( files ), 'done' : ndone,
+                    'failed' : nfailed, 'running' : len( running ),
+                    'queued' : len( files ) - len( finished )
+                               - len( running ) },
+                  durations, host_usage( joined, quit, busy, began, now ),
+                  None )
+
+    # Report how well the workers were kept busy.
+
+    end = time.time()
+    totalbusy = 0
+    totalspan = 0
+    print( "%-24s %6s %10s %10s %6s" % ( "Worker", "Tasks", "Busy (s)",
+                                         "Idle (s)", "Busy%" ) )
+    for w in sorted( joined ):
+        span = quit.get( w, end ) - joined[w]
+        idle = max( 0, span - busy.get( w, 0 ) )
+        totalbusy += busy.get( w, 0 )
+        totalspan += span
+        print( "%-24s %6d %10.1f %10.1f %6.1f"
+               % ( w, ran.get( w, 0 ), busy.get( w, 0 ), idle,
+                   100.0 * busy.get( w, 0 ) / max( span, 1e-9 ) ) )
+    print( "%-24s %6d %10.1f %10.1f %6.1f"
+           % ( "All", sum( ran.values() ), totalbusy,
+               max( 0, totalspan - totalbusy ),
+               100.0 * totalbusy / max( totalspan, 1e-9 ) ) )
+    print( '' )
+
+    # Signal to all workers and the dispatcher that we are finsihed
 
     control_sender.send( "FINISHED" )
+    requeue_sender.send_json( { 'type' : "finished" } )
     time.sleep( 5 )
 
 
 def Usage():
     global default_jobtime
     print( """
-Usage:  python wq.py -h | -d cmd filelist | -w n ms [walltime] 
+Usage:  python wq.py -h
+                       | -d [-c check] [-y retries] [--backoff secs] [--batch n]
+                            [-i filelist ...] [--match pattern] [-e endpoint]
+                            [--status file] [-L n [-n cores]]
+                            cmd filelist [ledger [results]]
+                       | -w [-n cores] [--stage dir [--outputs patterns]]
+                            n ms [walltime [logdir]]
+                       | -w -e endpoint [-n cores]
+                            [--stage dir [--outputs patterns]]
+                            n [walltime [logdir]]
+                       | -q results [bin|status]
    where:
       -h .. Display this help message.
    or:
       -d ........ Run as dispatcher and result_manager.
+      check ..... Command run by the worker after a task exits
+                  successfully, with the same file argument. A nonzero
+                  exit code marks the task failed (e.g. wq_check_mb.sh
+                  checks the .t files are complete). A task otherwise
+                  fails only if it exits with a nonzero code.
+      retries ... Times a failed task is handed out again within the
+                  same job (default: 0).
+      secs ...... Seconds before the first retry of a failed task,
+                  doubled for each further retry (default: 60).
+      n ......... Tasks to send a worker at a time, which it runs back
+                  to back. Batches cut messaging overhead for many short
+                  tasks (default: 1).
       cmd ....... Absolute path to command (script) to use for task.
                   Will be called with a single file path as argument:
-      filelist .. File containing input file names to operate on.
+      filelist .. File containing input file names to operate on, or a
+                  directory to search (all the way down) for them. More
+                  may be given with -i, with tasks numbered on from one
+                  to the next.
+      pattern ... Shell pattern input files found in a directory must
+                  match (default: "*.bb").
+      endpoint .. Run as a shared dispatcher and result manager: pick
+                  free ports and write where to find them to endpoint,
+                  for workers given the same -e (from any number of
+                  jobs) to read. Skipped tasks are kept for later
+                  workers, and the file is removed once all the work is
+                  done.
+      ledger .... Task ledger to append to (default: filelist.ledger).
+                  Tasks it shows completed successfully are skipped,
+                  and those that were in flight, failed or skipped are
+                  run again. Remove the ledger to start over.
+      results ... JSON lines file to append a record per task to (task,
+                  file, worker, host, start and end times, exit code,
+                  max RSS, CPU times, output sizes and log files).
+                  Default: filelist.jsonl.
+      file ...... Status file rewritten every minute with the tasks
+                  done, running and queued, tasks per hour, mean and
+                  95th percentile task time, how busy each host's
+                  workers are, and the projected completion time next
+                  to when the workers' jobs end (default:
+                  filelist.status).
    or:  
       -w ........ Run workers
       n ......... Number of workers (single node).
       ms ........ Host name of mother superior node.
+      endpoint .. Instead of ms, find a shared dispatcher from the
+                  endpoint file it wrote, waiting up to a minute for it
+                  to appear.
       walltime .. Wallclock time to allow for entire job. May be in
                   the form of ss, mm:ss, hh:mm:ss, or d:hh:mm:ss.
                   (hint: Torque sets PBS_WALLTIME)
+      cores ..... Share this many cores among the node's workers. Each
+                  task gets nruns * nchains cores from its bayes block
+                  (at most cores), passed to it in WQ_CORES, so several
+                  small tasks or one large one run at a time. n then
+                  sets the most tasks run at once. Without it, each
+                  worker runs one task and WQ_CORES isn't set.
+      logdir .... Stream each task's stdout and stderr to logdir/task<n>.out
+                  and .err instead of holding them in memory. Only the
+                  last lines are reported by the result manager.
+      dir ....... Run each task in a copy of its input file's directory
+                  (just the files, not subdirectories) made under dir,
+                  which should be on node-local scratch such as $TMPDIR,
+                  then copy the outputs back next to the input before
+                  the check runs. Keeps the I/O of running tasks off the
+                  shared filesystem.
+      patterns .. Comma separated shell patterns of the files to copy
+                  back, such as "*.p,*.t,*.ckp,*.mcmc,*.log". Default
+                  is every file the task created or changed.
+   or:
+      -L n ...... With -d, also run n workers on this machine, all
+                  talking over ipc sockets, with no need for PBS or ssh.
+                  The -n, --stage and --outputs options may be given as
+                  for -w.
+   or:
+      -q ........ Summarize a results file: task counts by status, CPU
+                  time, largest memory use and tasks completed over time.
+      results ... The results file written by the result manager.
+      bin ....... Throughput bin width in seconds (default: 3600).
+      status .... Instead list the task number and file of each task
+                  whose latest status is done, failed, skipped or lost.
 """ )
     print( "   The default worker jobtime is hardwired to %d secs - 1 day.\n"
            % ( default_jobtime ) )
@@ -425,10 +1617,26 @@ if __name__ == "__main__":
     dport = '5557'
     rport = '5558'
     cport = '5559'
+    qport = '5560'
+    heartbeat = 60
+    check = ''
+    retries = 0
+    backoff = 60
+    batch = 1
+    cores = 0
+    local = 0
+    inputnms = []
+    match = '*.bb'
+    endpointnm = ''
+    statusnm = ''
+    stagedir = ''
+    outputs = []
 
     try:
 
-        opts, args = getopt.getopt( sys.argv[1:], "hdw", [] )
+        opts, args = getopt.getopt( sys.argv[1:], "hdwqc:y:n:L:i:e:",
+                                    [ 'backoff=', 'batch=', 'match=',
+                                      'status=', 'stage=', 'outputs=' ] )
 
     except getopt.GetoptError, err:
 
@@ -446,14 +1654,88 @@ if __name__ == "__main__":
 
             mode = 'w'
 
+        elif o == "-q":
+
+            mode = 'q'
+
+        elif o == "-c":
+
+            check = a
+
+        elif o == "-y":
+
+            retries = int( a )
+
+        elif o == "--backoff":
+
+            backoff = int( a )
+
+        elif o == "--batch":
+
+            batch = max( 1, int( a ) )
+
+        elif o == "-n":
+
+            cores = int( a )
+
+        elif o == "-L":
+
+            local = int( a )
+
+        elif o == "-i":
+
+            inputnms.append( a )
+
+        elif o == "--match":
+
+            match = a
+
+        elif o == "--status":
+
+            statusnm = a
+
+        elif o == "--stage":
+
+            stagedir = a
+
+        elif o == "--outputs":
+
+            outputs = [ p for p in a.split( ',' ) if p != '' ]
+
+        elif o == "-e":
+
+            endpointnm = a
+
         else:
 
             Usage()
             sys.exit( 0 )
 
+    if mode == 'q':
+
+        if len( args ) < 1 or len( args ) > 2:
+            Usage()
+            sys.exit( 0 )
+
+        binsecs = 3600
+        status = ''
+        if len( args ) == 2:
+            if args[1].isdigit():
+                binsecs = max( 1, int( args[1] ) )
+            else:
+                status = args[1]
+
+        query_results( args[0], binsecs, status )
+
     if mode == 'w':
 
-	if len( args ) < 2 or len( args ) > 3:
+        # A shared dispatcher is found from its endpoint file rather than
+        # the mother superior.
+
+        if endpointnm != '':
+            args.insert( 1, None )
+
+	if len( args ) < 2 or len( args ) > 4:
 
 	   Usage()
            sys.exit( 0 )
@@ -461,11 +1743,23 @@ if __name__ == "__main__":
         # Get number of workers, hostname of mother superior node.
 
         numw = int( args[0 ] )
-	host = ipaddrs( args[1] )
+
+        if endpointnm != '':
+            address = read_endpoint( endpointnm )
+            if address is None:
+                print( "No dispatcher endpoint file: %s" % ( endpointnm ) )
+                sys.exit( 1 )
+            host = address['host']
+            dport = address['dport']
+            rport = address['rport']
+            cport = address['cport']
+            qport = address['qport']
+        else:
+            host = ipaddrs( args[1] )
 
 	# Get walltime, if present.
 
-        if len( args ) == 3:
+        if len( args ) >= 3:
 
            jobtime = time2secs( args[2] )
 
@@ -475,38 +1769,140 @@ if __name__ == "__main__":
 
            jobtime = default_jobtime
 
+        # Get the task log directory, if present.
+
+        if len( args ) == 4:
+
+           logdir = args[3]
+
+        else:
+
+           logdir = ''
+
+        if cores > 0:
+            pool = core_pool( cores )
+        else:
+            pool = None
+
         for wrk_num in range( numw ):
 
            Process( target = worker,
                     args = ( wrk_num, host, dport, rport,
-                             cport, jobtime ) ).start()
+                             cport, jobtime, heartbeat, logdir,
+                             pool, stagedir, outputs ) ).start()
 
     if mode == 'd':
 
-        if len( args ) != 2:
+        if len( args ) < 2 or len( args ) > 4:
 	   Usage()
 	   sys.exit( 0 )
 
+        # Everyone is on this machine when running locally, so talk over
+        # ipc sockets in a private directory rather than TCP.
+
+        if local > 0:
+            ipcdir = tempfile.mkdtemp( prefix = "wq." )
+            dport = "ipc://%s" % ( os.path.join( ipcdir, "dport" ) )
+            rport = "ipc://%s" % ( os.path.join( ipcdir, "rport" ) )
+            cport = "ipc://%s" % ( os.path.join( ipcdir, "cport" ) )
+            qport = "ipc://%s" % ( os.path.join( ipcdir, "qport" ) )
+        elif endpointnm != '':
+            ( dport, rport, cport, qport ) = free_ports( 4 )
+
         # Get the command to execute as the task, and the list
         # of input files.
 
         cmd = args[0]
-        infile = open( args[1], 'r' )
-        files = infile.readlines()
-        infile.close()
-        tasks = len( files )
+        files = read_inputs( [ args[1] ] + inputnms, match )
+
+        if len( args ) >= 3:
+            ledgernm = args[2]
+        else:
+            ledgernm = args[1].rstrip( '/' ) + ".ledger"
+
+        if len( args ) == 4:
+            resultsnm = args[3]
+        else:
+            resultsnm = args[1].rstrip( '/' ) + ".jsonl"
+
+        if statusnm == '':
+            statusnm = args[1].rstrip( '/' ) + ".status"
+
+        # Number the tasks by input line, and drop any the ledger shows
+        # were completed by an earlier run.
+
+        last = read_ledger( ledgernm )
+        todo = []
+        for n in range( len( files ) ):
+            f = files[n].strip()
+            if last.get( f ) != "done":
+                todo.append( ( n + 1, f ) )
+        tasks = len( todo )
+
+        sys.stderr.write( "Dispatcher: %d tasks already done, %d were in "
+                          "flight, %d to run\n"
+                          % ( len( files ) - tasks,
+                              len( [ f for f in last
+                                     if last[f] == "started" ] ), tasks ) )
 
         # Fire up the result manager...
 
         result_manager = Process( target = result_manager,
-                                  args = ( rport, cport, tasks ) )
+                                  args = ( rport, cport, qport, todo,
+                                           ledgernm, resultsnm, statusnm,
+                                           heartbeat, retries, backoff,
+                                           endpointnm != '' ) )
         result_manager.start()
 
         # Fire up the dispatcher!
 
         if tasks > 0:
             dispatcher = Process( target = dispatcher,
-                                  args = ( dport, cmd, files ) )
+                                  args = ( dport, rport, qport, cmd, todo,
+                                           check, batch ) )
             dispatcher.start()
-        else:
+        elif len( files ) == 0:
             Usage()
+
+        # Tell workers where to find a shared dispatcher, and take the
+        # notice down once all the work is done.
+
+        if endpointnm != '' and local == 0 and tasks > 0:
+            host = ipaddrs( socket.gethostname() )
+            write_endpoint( endpointnm, { 'host' : host, 'dport' : dport,
+                                          'rport' : rport, 'cport' : cport,
+                                          'qport' : qport } )
+            sys.stderr.write( "Dispatcher: serving %s at %s, ports %s %s "
+                              "%s %s\n" % ( endpointnm, host, dport, rport,
+                                             cport, qport ) )
+            result_manager.join()
+            os.remove( endpointnm )
+
+        # Running locally, start the workers here too and clean up once
+        # everyone is done.
+
+        if local > 0:
+
+            if cores > 0:
+                pool = core_pool( cores )
+            else:
+                pool = None
+
+            workers = []
+            if tasks > 0:
+                for wrk_num in range( local ):
+                    workers.append( Process( target = worker,
+                                             args = ( wrk_num, None, dport,
+                                                      rport, cport,
+                                                      default_jobtime,
+                                                      heartbeat, '',
+                                                      pool, stagedir,
+                                                      outputs ) ) )
+                    workers[-1].start()
+
+            result_manager.join()
+            for w in workers:
+                w.join()
+            if tasks > 0:
+                dispatcher.join()
+            shutil.rmtree( ipcdir )
@@ -16,7 +16,19 @@ FILE=$1
 DIR=`dirname ${FILE}`
 BASE=`basename ${FILE}`
 
-CMD="java -jar MrConverge1b2.5.jar ${FILE}"
+# Convergence engine: "python" runs mbConverge.py (kept next to this
+# script) on the original run files; "java" runs MrConverge, which needs
+# the jar and the _rN copies of the run files set up in each directory.
+# Use the same setting as the setup script.
+
+ENGINE=python
+SCRIPTDIR=`dirname $0`
+
+if [ "${ENGINE}" = "java" ] ; then
+   CMD="java -jar MrConverge1b2.5.jar ${FILE}"
+else
+   CMD="python ${SCRIPTDIR}/mbConverge.py ${FILE}"
+fi
 cd $DIR
 
 # For testing purposes, use "if false". For production, use "if true"